@@ -20,20 +20,22 @@
 
 # %%
 import os
+import sys
 import subprocess
 import fitz  # PyMuPDF
 import json
 import re
-import easyocr
 import numpy as np
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-import cv2
-from sentence_transformers import SentenceTransformer
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct, Filter, FieldCondition, MatchValue, MatchAny
-from sklearn.metrics.pairwise import cosine_similarity
 import uuid
-_OCR_READER = None
+import time
+import random
+import heapq
+import threading
+from collections import OrderedDict, deque
+# Heavy dependencies (easyocr, cv2, torch via sentence_transformers, qdrant_client,
+# langchain_text_splitters) are imported lazily inside the stage that needs them,
+# so loading cached chunks does not pay for OCR or model imports.
+_ENCODER_WORKER = None
 
 
 # %%
@@ -54,7 +56,27 @@ def debug_print_chunking(text_added, image_added):
 
 
 # %%
-def add_text_chunk(text_splitter, text_content, page_num, all_metadata, pdf_path):
+def get_chunk_id(chunk):
+    """
+    Stable identifier of a chunk, derived from its patent, type, page, position and content
+    (and the page content hash of drawing sheets, whose content may not change with the drawing).
+    Used as the Qdrant point id and as the row key of the embeddings file.
+    Args:
+        chunk (dict): The chunk dictionary
+
+    Returns:
+        str: The chunk's UUID string (the stored "id" when present)
+    """
+    if chunk.get("id"):
+        return chunk["id"]
+    key = "|".join(str(chunk.get(field, "")) for field in ("patent", "type", "page", "chunk_number", "content"))
+    if chunk.get("page_hash"):
+        key += "|" + chunk["page_hash"]
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+
+# %%
+def add_text_chunk(text_splitter, text_content, page_num, all_metadata, pdf_path, errors=None):
     """
     Add a text chunk to the metadata.
     Args:
@@ -62,6 +84,7 @@ def add_text_chunk(text_splitter, text_content, page_num, all_metadata, pdf_path
         page_num (int): The page number of the chunk
         all_metadata (dict): The metadata dictionary
         pdf_path (str): The path to the PDF file
+        errors (list): Optional list the error message is appended to on failure
 
     Returns:
         bool: True if the text chunk was added successfully, False otherwise
@@ -72,44 +95,485 @@ def add_text_chunk(text_splitter, text_content, page_num, all_metadata, pdf_path
         if text_content.strip():
             text_chunks = text_splitter.split_text(text_content)
             for i, chunk in enumerate(text_chunks):
-                all_metadata[pdf_path]["chunks"].append({
+                text_chunk = {
                     "type": "text",
                     "page": page_num + 1,
                     "chunk_number": i,
-                    "content": chunk.strip()
-                })
+                    "content": chunk.strip(),
+                    "patent": pdf_path
+                }
+                text_chunk["id"] = get_chunk_id(text_chunk)
+                all_metadata[pdf_path]["chunks"].append(text_chunk)
     except Exception as e:
         print(f"Error converting text chunk: {e}")
+        if errors is not None:
+            errors.append(f"text chunk: {e}")
         return False
     return True
 
 
 # %%
+# === STRUCTURE-AWARE CHUNKING ===
+# Section headings of US patents, matched at the start of a line (uppercase headings only,
+# except for the claims preamble). Order matters: the first match wins.
+PATENT_SECTION_HEADINGS = [
+    ("abstract", r"(\(57\)\s*)?ABSTRACT( OF THE DISCLOSURE)?$"),
+    ("figure_captions", r"(BRIEF )?DESCRIPTION OF (THE )?(DRAWINGS?|FIGURES)"),
+    ("description", r"(DETAILED DESCRIPTION|DESCRIPTION OF (THE )?(PREFERRED )?EMBODIMENTS?)"),
+    ("summary", r"(BRIEF )?SUMMARY"),
+    ("background", r"(FIELD|BACKGROUND|TECHNICAL FIELD|CROSS[- ]REFERENCES?|(DESCRIPTION OF )?(THE )?(RELATED|PRIOR) ART)"),
+    ("other", r"CERTIFICATE OF CORRECTION"),
+    ("claims", r"(?i:(what is claimed is|i claim|we claim|the invention claimed is|claims)\s*:?)$"),
+]
+# Running headers repeated at the top of every page ("US 6,285,999 B1", column numbers, ...)
+PAGE_HEADER_PATTERN = r"(US\s*[\d,]+\s*[AB]\d|U\.S\. Patent|Sheet \d+ of \d+|\d{1,3}|[A-Z][a-z]{2}\. \d{1,2}, \d{4})$"
+
+
+def match_section_heading(line):
+    """Return the section a heading line opens, or None if the line is not a heading."""
+    if len(line) > 80:
+        return None
+    for section, pattern in PATENT_SECTION_HEADINGS:
+        if (section == "claims" or line.isupper()) and re.match(pattern, line):
+            return section
+    return None
+
+
+# %%
+def split_patent_sections(page_texts):
+    """
+    Walk the text of the whole patent and cut it into section segments: one per section run,
+    one per claim inside the claims and one per figure inside the brief description of the drawings.
+    
+    Args:
+        page_texts (list): (1-based page number, page text) pairs in page order
+        
+    Returns:
+        list: Segments {"section", "claim_number", "figure", "lines": [(page, line), ...]}
+    """
+    segments = []
+    section = "front_matter"
+    current = None
+    next_claim = 1
+    for page_number, text in page_texts:
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        # Drop the running header of the page
+        while lines and re.match(PAGE_HEADER_PATTERN, lines[0]):
+            lines.pop(0)
+        after_heading = False
+        for line in lines:
+            heading = match_section_heading(line)
+            if heading:
+                section, current, after_heading = heading, None, True
+                if heading == "claims":
+                    next_claim = 1
+                continue
+            if after_heading and line.isupper() and len(line) < 60:
+                continue  # Second line of a wrapped heading
+            after_heading = False
+
+            new_segment = current is None
+            claim_number = figure = None
+            if section == "claims":
+                match = re.match(r"(\d+)\s*\.\s+\S", line)
+                # Claims are numbered consecutively, which rules out numbered lists inside a claim
+                if match and int(match.group(1)) == next_claim:
+                    claim_number, new_segment = next_claim, True
+                    next_claim += 1
+                elif current is not None:
+                    claim_number = current["claim_number"]
+            elif section == "figure_captions":
+                match = re.match(r"FIGS?\.\s*(\d+[A-Z]?)", line)
+                if match:
+                    figure, new_segment = match.group(1), True
+                elif current is not None:
+                    figure = current["figure"]
+            if new_segment:
+                current = {"section": section, "claim_number": claim_number, "figure": figure, "lines": []}
+                segments.append(current)
+            current["lines"].append((page_number, line))
+        # The abstract fills the rest of the front page only
+        if section == "abstract":
+            section, current = "front_matter", None
+    return segments
+
+
+# %%
+def chunk_patent_structure(page_texts, pdf_path, text_splitter):
+    """
+    Chunk a patent along its structure instead of page by page: sections (abstract, background,
+    summary, figure captions, detailed description, claims) are chunked across page boundaries,
+    every claim and every figure caption starts a chunk of its own, and chunks never mix sections.
+    
+    Args:
+        page_texts (list): (1-based page number, page text) pairs in page order
+        pdf_path (str): The path to the PDF file
+        text_splitter: Splitter used for segments longer than one chunk
+        
+    Returns:
+        list: Text chunks with the usual fields plus "section", and "claim_number" / "parent_claim"
+              for claims or "figure" for figure captions. "page" is the page the chunk starts on.
+    """
+    import bisect
+    chunks = []
+    page_chunk_counts = {}
+    for segment in split_patent_sections(page_texts):
+        text = ""
+        offsets, pages = [], []
+        for page_number, line in segment["lines"]:
+            offsets.append(len(text))
+            pages.append(page_number)
+            text += line + "\n"
+        cursor = 0
+        for piece in text_splitter.split_text(text):
+            position = text.find(piece, cursor)
+            position = cursor if position < 0 else position
+            cursor = position + 1
+            page_number = pages[bisect.bisect_right(offsets, position) - 1]
+            # Numbered within the start page, so an edit elsewhere in the patent keeps this chunk's id
+            page_chunk_counts[page_number] = page_chunk_counts.get(page_number, -1) + 1
+            chunk = {
+                "type": "text",
+                "page": page_number,
+                "chunk_number": page_chunk_counts[page_number],
+                "content": piece.strip(),
+                "patent": pdf_path,
+                "section": segment["section"]
+            }
+            if segment["claim_number"] is not None:
+                chunk["claim_number"] = segment["claim_number"]
+                parent = re.search(r"\b(?:of|in|to) claim (\d+)", text[:200])
+                chunk["parent_claim"] = int(parent.group(1)) if parent else None
+            if segment["figure"] is not None:
+                chunk["figure"] = segment["figure"]
+            chunk["id"] = get_chunk_id(chunk)
+            chunks.append(chunk)
+    return chunks
+
+
+# %%
+# === MODEL RESOURCES ===
+# Heavyweight models (EasyOCR, SentenceTransformer / CLIP encoders) are loaded through acquire_model,
+# which records the resident size of every model and keeps the total under a memory budget by
+# unloading the least recently used models; models idle for longer than idle_seconds are unloaded too.
+# Load/unload events are kept in MODEL_EVENTS (like LLM_CALL_LOG), current sizes in model_resources().
+MODEL_RESOURCE_CONFIG = {
+    "memory_budget_mb": float(os.environ.get("PATENT_RAG_MODEL_BUDGET_MB", 0)),  # 0 = no limit
+    "idle_seconds": float(os.environ.get("PATENT_RAG_MODEL_IDLE_SECONDS", 0)),   # 0 = keep idle models
+}
+_LOADED_MODELS = OrderedDict()  # name -> {"model", "bytes", "last_used", "loaded_at"}, least recently used first
+_MODEL_LOCK = threading.RLock()
+_MODEL_JANITOR = None
+# {"time", "event" ("load"/"unload"), "model", "bytes", "resident_bytes", "seconds", "reason"}
+MODEL_EVENTS = deque(maxlen=1000)
+
+
+def configure_model_resources(memory_budget_mb=None, idle_seconds=None):
+    """
+    Change the memory budget and/or idle timeout of the loaded models, and apply them right away.
+    
+    Args:
+        memory_budget_mb (float): Total resident size of the loaded models (0 = no limit)
+        idle_seconds (float): Unload models not used for this long (0 = never)
+    """
+    if memory_budget_mb is not None:
+        MODEL_RESOURCE_CONFIG["memory_budget_mb"] = float(memory_budget_mb)
+    if idle_seconds is not None:
+        MODEL_RESOURCE_CONFIG["idle_seconds"] = float(idle_seconds)
+    release_models()
+    _start_model_janitor()
+
+
+def _process_rss():
+    """Resident set size of this process in bytes (0 where /proc is not available)."""
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def model_nbytes(model):
+    """Size of a model's weights: torch parameters and buffers (EasyOCR: its detector and recognizer)."""
+    modules = [model] if hasattr(model, "parameters") else [getattr(model, name) for name in ("detector", "recognizer")
+                                                               if hasattr(getattr(model, name, None), "parameters")]
+    return sum(tensor.numel() * tensor.element_size() for module in modules
+               for tensor in list(module.parameters()) + list(module.buffers()))
+
+
+def _unload_model(name, reason):
+    entry = _LOADED_MODELS.pop(name)
+    MODEL_EVENTS.append({"time": time.time(), "event": "unload", "model": name, "bytes": entry["bytes"],
+                         "resident_bytes": sum(e["bytes"] for e in _LOADED_MODELS.values()), "seconds": 0.0, "reason": reason})
+    print(f"♻️  Unloaded {name} ({entry['bytes'] / 2**20:.0f} MB, {reason})")
+    # The memory is returned once callers drop their references too
+    del entry
+    import gc
+    gc.collect()
+
+
+def release_models(keep=None):
+    """
+    Unload idle models and, while the loaded models exceed the memory budget, the least recently used ones.
+    
+    Args:
+        keep (str): Name of a model that must stay loaded (the one just requested)
+    """
+    with _MODEL_LOCK:
+        idle_seconds = MODEL_RESOURCE_CONFIG["idle_seconds"]
+        if idle_seconds > 0:
+            now = time.time()
+            for name in [n for n, e in _LOADED_MODELS.items() if n != keep and now - e["last_used"] > idle_seconds]:
+                _unload_model(name, f"idle {idle_seconds:.0f}s")
+        budget = MODEL_RESOURCE_CONFIG["memory_budget_mb"] * 2**20
+        if budget > 0:
+            for name in list(_LOADED_MODELS):
+                if sum(e["bytes"] for e in _LOADED_MODELS.values()) <= budget:
+                    break
+                if name != keep:
+                    _unload_model(name, "memory budget")
+
+
+def _model_janitor():
+    """Background thread: unload idle models even when no other model is requested."""
+    global _MODEL_JANITOR
+    while True:
+        with _MODEL_LOCK:
+            idle_seconds = MODEL_RESOURCE_CONFIG["idle_seconds"]
+            if idle_seconds <= 0:  # Idle unloading was turned off
+                _MODEL_JANITOR = None
+                return
+        time.sleep(min(max(0.5, idle_seconds / 4), 30.0))
+        release_models()
+
+
+def _start_model_janitor():
+    """Start the janitor thread if idle models are to be unloaded and it is not running."""
+    global _MODEL_JANITOR
+    with _MODEL_LOCK:
+        if _MODEL_JANITOR is None and MODEL_RESOURCE_CONFIG["idle_seconds"] > 0:
+            _MODEL_JANITOR = threading.Thread(target=_model_janitor, name="model-janitor", daemon=True)
+            _MODEL_JANITOR.start()
+
+
+def acquire_model(name, loader):
+    """
+    Get a loaded model, loading it with loader() on first use (or after it was unloaded).
+    
+    Args:
+        name (str): Model key, e.g. "easyocr" or "sentence:all-MiniLM-L6-v2:torch"
+        loader (callable): Returns the loaded model
+        
+    Returns:
+        The model
+    """
+    with _MODEL_LOCK:
+        if name in _LOADED_MODELS:
+            entry = _LOADED_MODELS[name]
+            entry["last_used"] = time.time()
+            _LOADED_MODELS.move_to_end(name)
+            return entry["model"]
+        release_models()
+        rss_before, start = _process_rss(), time.perf_counter()
+        model = loader()
+        # Weight size where it can be measured, otherwise the growth of the process
+        size = model_nbytes(model) or max(0, _process_rss() - rss_before)
+        _LOADED_MODELS[name] = {"model": model, "bytes": size, "last_used": time.time(), "loaded_at": time.time()}
+        MODEL_EVENTS.append({"time": time.time(), "event": "load", "model": name, "bytes": size,
+                             "resident_bytes": sum(e["bytes"] for e in _LOADED_MODELS.values()),
+                             "seconds": time.perf_counter() - start, "reason": "requested"})
+        release_models(keep=name)
+        _start_model_janitor()
+        return model
+
+
+def model_resources():
+    """
+    Loaded models, least recently used first.
+    
+    Returns:
+        list: [{"model", "mb", "idle_seconds"}] (mb: resident size attributed to the model)
+    """
+    with _MODEL_LOCK:
+        now = time.time()
+        return [{"model": name, "mb": entry["bytes"] / 2**20, "idle_seconds": now - entry["last_used"]}
+                for name, entry in _LOADED_MODELS.items()]
+
 
 # %%
 def get_ocr_reader():
-    """Singleton pattern to create reader only once"""
-    global _OCR_READER
-    if _OCR_READER is None:
+    """The shared EasyOCR reader (loaded on first use, see acquire_model)."""
+    def load():
+        import easyocr
         print("Initializing EasyOCR reader (this may take a moment)...")
-        _OCR_READER = easyocr.Reader(['en'])
-    return _OCR_READER
+        return easyocr.Reader(['en'])
+    return acquire_model("easyocr", load)
+
+
+# %%
+_ONNX_UNAVAILABLE = set()  # Models whose ONNX export failed to load
+
+
+def get_sentence_model(model_name="all-MiniLM-L6-v2", backend="torch"):
+    """
+    Load a SentenceTransformer model once per process and reuse it (see acquire_model).
+    Args:
+        model_name (str): SentenceTransformer model name
+        backend (str): "torch" - default PyTorch model
+                       "onnx"  - ONNX Runtime on CPU (needs optimum[onnxruntime], falls back to torch)
+                       "int8"  - PyTorch on CPU with int8 dynamically quantized Linear layers
+
+    Returns:
+        SentenceTransformer: The loaded model
+    """
+    if backend == "onnx" and model_name in _ONNX_UNAVAILABLE:
+        backend = "torch"
+    
+    def load():
+        from sentence_transformers import SentenceTransformer
+        print(f"Loading SentenceTransformer model: {model_name} ({backend})")
+        if backend == "onnx":
+            model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        elif backend == "int8":
+            import torch
+            model = SentenceTransformer(model_name, device="cpu")
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            model = SentenceTransformer(model_name)
+        return model
+    try:
+        return acquire_model(f"sentence:{model_name}:{backend}", load)
+    except Exception as e:
+        if backend != "onnx":
+            raise
+        # Fall back to the torch model, loaded (and budgeted) once under its own key
+        print(f"⚠️  ONNX backend unavailable ({e}), using torch")
+        _ONNX_UNAVAILABLE.add(model_name)
+        return get_sentence_model(model_name, "torch")
+
+
+# %%
+def _init_encoder_worker(model_name, backend, num_threads):
+    """Process-pool initializer: load the encoder once per worker process."""
+    global _ENCODER_WORKER
+    import torch
+    torch.set_num_threads(num_threads)
+    _ENCODER_WORKER = get_sentence_model(model_name, backend)
+
+
+def _encode_in_worker(texts, batch_size):
+    """Encode one slice of (length-sorted) texts inside a worker process."""
+    return _ENCODER_WORKER.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+
+
+# %%
+def encode_texts(model, texts, batch_size=32, workers=1, model_name=None, backend="torch", show_progress_bar=False):
+    """
+    Encode texts in length-sorted batches, optionally spread over several CPU processes.
+    Sorting by length puts similar-length texts in the same batch so less padding is computed;
+    rows are returned in the original order.
+    Args:
+        model: Loaded encoder (used when workers == 1)
+        texts (list): Texts to encode
+        batch_size (int): Texts per forward pass
+        workers (int): Number of encoder processes (each loads its own copy of the model)
+        model_name (str): Model name the worker processes load (required when workers > 1)
+        backend (str): Encoder backend the worker processes load (see get_sentence_model)
+        show_progress_bar (bool): Show the SentenceTransformer progress bar (single process only)
+
+    Returns:
+        np.ndarray: Embeddings of shape (len(texts), vector_size)
+    """
+    order = np.argsort([-len(text) for text in texts], kind="stable")
+    sorted_texts = [texts[i] for i in order]
+
+    if workers > 1 and model_name and len(texts) > batch_size:
+        import importlib
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Worker functions must be importable by name in the spawned processes (also from the notebook)
+        worker_module = importlib.import_module("Patent_RAG") if __name__ == "__main__" else sys.modules[__name__]
+        # A few tasks per worker, each a whole number of batches, keeps the workers evenly loaded
+        task_size = batch_size * max(1, -(-len(texts) // (batch_size * workers * 4)))
+        slices = [sorted_texts[i:i + task_size] for i in range(0, len(sorted_texts), task_size)]
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+        print(f"Encoding {len(texts)} texts with {workers} worker processes ({num_threads} threads each)...")
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=worker_module._init_encoder_worker,
+                                 initargs=(model_name, backend, num_threads)) as pool:
+            parts = list(pool.map(worker_module._encode_in_worker, slices, [batch_size] * len(slices)))
+        sorted_embeddings = np.concatenate(parts)
+    else:
+        sorted_embeddings = np.asarray(model.encode(sorted_texts, batch_size=batch_size,
+                                                    show_progress_bar=show_progress_bar))
+
+    embeddings = np.empty_like(sorted_embeddings)
+    embeddings[order] = sorted_embeddings
+    return embeddings
+
+
+# %%
+def cosine_similarity(a, b):
+    """
+    Cosine similarity between every row of a and every row of b
+    (NumPy version of sklearn.metrics.pairwise.cosine_similarity).
+    Args:
+        a (array-like): Matrix of shape (n, dim)
+        b (array-like): Matrix of shape (m, dim)
+
+    Returns:
+        np.ndarray: Similarity matrix of shape (n, m)
+    """
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return a @ b.T
+
+
+# %%
+def encode_images(model, image_paths, batch_size=16):
+    """
+    Embed drawing sheet PNGs with a CLIP-style SentenceTransformer (e.g. "clip-ViT-B-32"),
+    which maps images and text into the same vector space.
+    
+    Args:
+        model: SentenceTransformer image model (see get_sentence_model)
+        image_paths (list): Paths of the images to embed
+        batch_size (int): Images per forward pass
+        
+    Returns:
+        np.ndarray: float32 matrix of shape (len(image_paths), vector_size)
+    """
+    from PIL import Image
+    vectors = []
+    for start in range(0, len(image_paths), batch_size):
+        images = [Image.open(path).convert("RGB") for path in image_paths[start:start + batch_size]]
+        vectors.append(np.asarray(model.encode(images, batch_size=batch_size, show_progress_bar=False), dtype=np.float32))
+        for image in images:
+            image.close()
+    return np.vstack(vectors)
 
 
 # %%
-def ocr_text_extraction (page, image_indicator=False):
+def ocr_text_extraction (page, image_indicator=False, clip=None):
     """
     Extract text from a page using OCR.
     Args:
         page (fitz.Page): The page to extract the text from
+        image_indicator (bool): Also try rotated text (drawing sheets)
+        clip (fitz.Rect): Optional page area to read instead of the whole page
     
     Returns:
         str: The extracted text
     """
     try:
+        import cv2
         reader = get_ocr_reader()
         # Page extraction pre - processing and cleaning:
-        pix = page.get_pixmap(dpi=300)
+        pix = page.get_pixmap(dpi=300, clip=clip)
         img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
         if pix.n == 4:
             img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
@@ -140,14 +604,16 @@ def ocr_text_extraction (page, image_indicator=False):
 
 
 # %%
-def sheet_descriptions(page, image_path, page_num, model="llava:7b", max_chars=300):
+def sheet_descriptions(page, image_path, page_num, model="llava:7b", max_chars=300, image_text=None):
     """
-    Convert an image to text using Llava via subprocess.
+    Convert an image to text using Llava (through the configured LLM backend).
     Args:
+        page (fitz.Page): The page of the sheet (only used to OCR it when image_text is not given)
         image_path (str): Path to the image file
         page_num (int): The page number of the chunk
-        model (str): The model to use for text extraction (ignored in subprocess version)
+        model (str): The model to use for text extraction
         max_chars (int): The maximum number of characters to return
+        image_text (str): OCR text of the sheet if already known (skips the OCR pass)
     
     Returns:
         dict: A dictionary containing the image description and metadata
@@ -156,7 +622,8 @@ def sheet_descriptions(page, image_path, page_num, model="llava:7b", max_chars=3
     if not os.path.exists(image_path):
         print(f"❌ Image file not found: {image_path}")
         return None
-    image_text = ocr_text_extraction(page, image_indicator=True)
+    if image_text is None:
+        image_text = ocr_text_extraction(page, image_indicator=True)
     prompt = (
         f"Image: {image_path}\n"
         f"Image text: {image_text}\n"
@@ -180,25 +647,11 @@ def sheet_descriptions(page, image_path, page_num, model="llava:7b", max_chars=3
     )
 
     try:
-        # Construct the llava command
-        cmd = ["ollama","run","llava:7b"]
-
-        # Run the command and capture output
-        process = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding="utf-8",     # ← add this
-            errors="replace"      # ← and this (never crash on odd bytes)
-        )
-
-        # Send prompt to stdin
-        stdout, stderr = process.communicate(input=prompt)
-
-        if process.returncode != 0:
-            print(f"❌ Llava process failed: {stderr}")
+        # Ask llava through the configured backend
+        try:
+            stdout = scheduled_generate(model, prompt, timeout=300, images=[image_path], priority="ingest")
+        except RuntimeError as e:
+            print(f"❌ Llava process failed: {e}")
             return None
 
         text = stdout.strip()
@@ -224,15 +677,130 @@ def sheet_descriptions(page, image_path, page_num, model="llava:7b", max_chars=3
 
 
 # %%
-def add_image_chunk(page, page_num, all_metadata, output_dir, pdf_path):
+# === IMAGE STORE ===
+# Drawing sheets are stored by content: the file name is the sha256 of the rendered pixels, in
+# directories sharded by the first hash characters (<store>/ab/cd/<hash>.png). An identical sheet
+# of another patent (family members) is stored once and its LLaVA description is reused from
+# the <hash>.json sidecar. Chunks refer to a sheet by "image_hash" (+ "image_store", the store root).
+IMAGE_STORE_CONFIG = {
+    "format": "png",          # "png" or "webp" (lossless, smaller; falls back to png without WebP support)
+    "thumbnail_size": 256,    # longest side of on-demand thumbnails
+}
+
+
+def image_store_path(image_hash, store_dir, extension=None):
+    """
+    Path of a stored image. Without an extension, the stored file of either format is returned
+    (the configured format's path if none exists yet).
+    """
+    shard_dir = os.path.join(store_dir, image_hash[:2], image_hash[2:4])
+    if extension is None:
+        for candidate in (IMAGE_STORE_CONFIG["format"], "png", "webp"):
+            if os.path.exists(os.path.join(shard_dir, f"{image_hash}.{candidate}")):
+                return os.path.join(shard_dir, f"{image_hash}.{candidate}")
+        extension = IMAGE_STORE_CONFIG["format"]
+    return os.path.join(shard_dir, f"{image_hash}.{extension}")
+
+
+def store_sheet_image(pix, store_dir, image_format=None):
+    """
+    Store a rendered sheet in the content-addressed image store (written once per distinct image).
+    
+    Args:
+        pix (fitz.Pixmap): The rendered page
+        store_dir (str): Root of the image store
+        image_format (str): "png" or "webp" (default: IMAGE_STORE_CONFIG["format"])
+        
+    Returns:
+        tuple: (image hash, path of the stored file)
+    """
+    import hashlib
+    image_format = image_format or IMAGE_STORE_CONFIG["format"]
+    image_hash = hashlib.sha256(f"{pix.width}x{pix.height}x{pix.n}|".encode("ascii") + pix.samples).hexdigest()
+    existing = image_store_path(image_hash, store_dir)
+    if os.path.exists(existing):
+        return image_hash, existing
+    png_bytes = pix.tobytes("png")
+    if image_format == "webp":
+        from PIL import Image, features
+        import io
+        if features.check("webp"):
+            buffer = io.BytesIO()
+            Image.open(io.BytesIO(png_bytes)).save(buffer, format="WEBP", lossless=True, method=6)
+            png_bytes = buffer.getvalue()
+        else:
+            print("⚠️  Pillow has no WebP support, storing PNG")
+            image_format = "png"
+    image_path = image_store_path(image_hash, store_dir, image_format)
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    # Concurrent writers of the same sheet write identical bytes; the rename makes the file appear whole
+    with open(image_path + f".{os.getpid()}.tmp", 'wb') as f:
+        f.write(png_bytes)
+    os.replace(image_path + f".{os.getpid()}.tmp", image_path)
+    return image_hash, image_path
+
+
+def chunk_image_path(chunk, store_dir="extracted_images"):
+    """Image file of a sheet chunk: resolved from its hash, or the stored path of chunks from older runs."""
+    if chunk.get("image_hash"):
+        return image_store_path(chunk["image_hash"], chunk.get("image_store", store_dir))
+    return chunk.get("image_path", "")
+
+
+def image_thumbnail(chunk, max_size=None):
+    """
+    Path of a thumbnail of a sheet chunk, created on first request (stored next to the image
+    as <hash>_<size>.png).
+    
+    Args:
+        chunk (dict): Sheet chunk (with "image_hash")
+        max_size (int): Longest side in pixels (default: IMAGE_STORE_CONFIG["thumbnail_size"])
+    """
+    from PIL import Image
+    max_size = max_size or IMAGE_STORE_CONFIG["thumbnail_size"]
+    image_path = chunk_image_path(chunk)
+    thumbnail_path = f"{os.path.splitext(image_path)[0]}_{max_size}.png"
+    if not os.path.exists(thumbnail_path):
+        with Image.open(image_path) as image:
+            image.thumbnail((max_size, max_size))
+            image.save(thumbnail_path + ".tmp", format="PNG", optimize=True)
+        os.replace(thumbnail_path + ".tmp", thumbnail_path)
+    return thumbnail_path
+
+
+def stored_sheet_description(image_hash, store_dir):
+    """LLaVA description of a stored sheet from an earlier patent, or None."""
+    sidecar = os.path.splitext(image_store_path(image_hash, store_dir))[0] + ".json"
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar, 'r', encoding='utf-8') as f:
+        return json.load(f).get("description")
+
+
+def save_sheet_description(image_hash, store_dir, description):
+    """Keep a sheet's description next to the image, for identical sheets of other patents."""
+    sidecar = os.path.splitext(image_store_path(image_hash, store_dir))[0] + ".json"
+    with open(sidecar + f".{os.getpid()}.tmp", 'w', encoding='utf-8') as f:
+        json.dump({"description": description}, f, ensure_ascii=False)
+    os.replace(sidecar + f".{os.getpid()}.tmp", sidecar)
+
+
+# %%
+def add_image_chunk(page, page_num, all_metadata, output_dir, pdf_path, errors=None, describe=True, page_hash=None):
     """
     Add an image chunk to the metadata.
     Args:
         page (fitz.Page): The page to extract the image from
         page_num (int): The page number of the chunk
         all_metadata (dict): The metadata dictionary
-        output_dir (str): The output directory
+        output_dir (str): Root of the content-addressed image store (see store_sheet_image)
         pdf_path (str): The path to the PDF file
+        errors (list): Optional list the error message is appended to on failure
+        describe (bool): Describe the sheet with LLaVA. If False only the sheet's OCR text is
+                         stored; the description can then be generated lazily at query time
+                         (see create_sheet_describer) or skipped when drawings are retrieved by
+                         their image vectors
+        page_hash (str): Content hash of the page (see page_content_hash), part of the chunk id
 
     Returns:
         bool: True if the image chunk was added successfully, False otherwise
@@ -240,41 +808,311 @@ def add_image_chunk(page, page_num, all_metadata, output_dir, pdf_path):
     print("Converting image chunk")
     try:
         pix = page.get_pixmap()
-        img_data = pix.tobytes("png")
-        image_filename = f'{pdf_path.replace(".pdf", "")}_page_{page_num + 1}.png'
-        image_path = os.path.join(output_dir, image_filename)
-        with open(image_path, 'wb') as f:
-            f.write(img_data)
-        all_metadata[pdf_path]['chunks'].append(sheet_descriptions(page, image_path, page_num + 1))
+        image_hash, image_path = store_sheet_image(pix, output_dir)
+        # An identical sheet of another patent was already described
+        description = stored_sheet_description(image_hash, output_dir) if describe else None
+        if description:
+            print(f"Reusing the description of identical sheet {image_hash[:12]}")
+            image_chunk = {"type": "image_description", "page": page_num + 1, "content": description}
+        elif describe:
+            image_chunk = sheet_descriptions(page, image_path, page_num + 1)
+            if image_chunk is not None:
+                save_sheet_description(image_hash, output_dir, image_chunk["content"])
+        else:
+            ocr_text = ocr_text_extraction(page, image_indicator=True).strip()
+            image_chunk = {
+                "type": "image_description",
+                "page": page_num + 1,
+                "content": ocr_text or f"Drawing sheet, page {page_num + 1}",
+                "ocr_text": ocr_text,
+                "described": False
+            }
+        if image_chunk is None:
+            raise RuntimeError(f"no sheet description for page {page_num + 1}")
+        # Chunks refer to the sheet by its content hash, not by a file path
+        image_chunk.pop("image_path", None)
+        image_chunk["image_hash"] = image_hash
+        image_chunk["image_store"] = output_dir
+        image_chunk["patent"] = pdf_path
+        if page_hash:
+            image_chunk["page_hash"] = page_hash
+        image_chunk["id"] = get_chunk_id(image_chunk)
+        all_metadata[pdf_path]['chunks'].append(image_chunk)
     except Exception as e:
         print(f"Error converting image chunk: {e}")
+        if errors is not None:
+            errors.append(f"image chunk: {e}")
         return False
 
     return True
 
 
 # %%
-def extract_text_and_images_from_patent(pdf_path, output_dir="extracted_images"):
+# === PAGE CLASSIFICATION ===
+SHEET_PATTERN = r'sheet\s+.+?\s+of\s+.+?(?=[\.\n]|$)'
+
+
+def page_layout_signals(page, thumbnail_dpi=36):
+    """
+    Collect cheap layout signals of a page from the PDF structure and a low-res thumbnail.
+    
+    Args:
+        page (fitz.Page): The page to inspect
+        thumbnail_dpi (int): Resolution of the grayscale thumbnail
+        
+    Returns:
+        dict: text_chars, text_area_ratio, image_count, image_area_ratio, drawing_count,
+              ink_ratio (dark thumbnail pixels), text_row_ratio (share of inked thumbnail
+              rows dense enough to be lines of text) and header_lines (separate lines of ink in
+              the top 12% of the page; drawing sheets have just their running header there)
+    """
+    page_area = abs(page.rect) or 1.0
+    blocks = page.get_text("blocks")
+    text = "".join(block[4] for block in blocks if block[6] == 0)
+    text_area = sum(abs(fitz.Rect(block[:4]) & page.rect) for block in blocks if block[6] == 0 and block[4].strip())
+    images = page.get_image_info()
+    image_area = sum(abs(fitz.Rect(image["bbox"]) & page.rect) for image in images)
+
+    pix = page.get_pixmap(dpi=thumbnail_dpi, colorspace=fitz.csGRAY)
+    thumbnail = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width] < 200
+    # Lines of text produce many ink/paper transitions per row, drawings only a few
+    transitions = np.count_nonzero(np.diff(thumbnail.view(np.int8), axis=1), axis=1)
+    inked_rows = np.count_nonzero(transitions)
+    header_rows = np.count_nonzero(thumbnail[:int(pix.height * 0.12)], axis=1) > 0
+    header_lines = int(np.count_nonzero(np.diff(header_rows.astype(np.int8)) == 1) + (header_rows[:1].sum()))
+
+    return {
+        "text": text,
+        "text_chars": len(text.strip()),
+        "text_area_ratio": min(text_area / page_area, 1.0),
+        "image_count": len(images),
+        "image_area_ratio": min(image_area / page_area, 1.0),
+        "drawing_count": len(page.get_drawings()),
+        "ink_ratio": float(thumbnail.mean()),
+        "text_row_ratio": float(np.count_nonzero(transitions >= 30 * thumbnail_dpi / 36) / inked_rows) if inked_rows else 0.0,
+        "header_lines": header_lines
+    }
+
+
+# %%
+def classify_page(page, min_text_chars=50, scanned_text_ratio=0.5, scanned_drawing_ratio=0.2):
+    """
+    Decide which pipeline a page goes to without running OCR on the whole page:
+    - "text": the page has a real text layer (split as it is)
+    - "scanned": a scanned page of text (OCR, then split)
+    - "drawing": a drawing sheet (rendered and described by LLaVA)
+    - "blank": nothing to extract
+    Only scanned pages that the thumbnail cannot place get an OCR pass, and only of the
+    header strip that carries "Sheet X of Y" (when that OCR fails or reads nothing, the
+    thumbnail decides after all).
+    
+    Args:
+        page (fitz.Page): The page to classify
+        min_text_chars (int): Minimum text layer size for a page to count as born-digital
+        scanned_text_ratio (float): text_row_ratio above which a scanned page is text
+        scanned_drawing_ratio (float): text_row_ratio below which a scanned page is a drawing
+        
+    Returns:
+        tuple: (kind, signals) where signals is the dict from page_layout_signals
+    """
+    signals = page_layout_signals(page)
+
+    if signals["text_chars"] >= min_text_chars:
+        if re.search(SHEET_PATTERN, signals["text"], flags=re.IGNORECASE):
+            kind = "drawing"
+        elif (signals["text_area_ratio"] < 0.1 and signals["text_row_ratio"] < scanned_text_ratio
+              and (signals["drawing_count"] >= 10 or signals["image_area_ratio"] >= 0.5)):
+            kind = "drawing"  # a figure with labels but no sheet header
+        else:
+            kind = "text"
+    elif signals["ink_ratio"] < 0.001 and not signals["drawing_count"]:
+        kind = "blank"
+    elif signals["image_area_ratio"] < 0.5:
+        kind = "drawing"  # vector artwork without a text layer
+    elif signals["text_row_ratio"] >= scanned_text_ratio:
+        kind = "scanned"
+    elif signals["text_row_ratio"] < scanned_drawing_ratio:
+        kind = "drawing"
+    else:
+        # Ambiguous scan (e.g. a front page with text and a figure): read just the header strip
+        header = fitz.Rect(page.rect.x0, page.rect.y0, page.rect.x1, page.rect.y0 + page.rect.height * 0.12)
+        try:
+            header_text = ocr_text_extraction(page, clip=header) or ""
+        except Exception:
+            header_text = ""
+        if header_text.strip():
+            kind = "drawing" if re.search(SHEET_PATTERN, header_text, flags=re.IGNORECASE) else "scanned"
+        else:
+            # No OCR result: a header strip holding a single line is the running header of a drawing sheet
+            # (front pages and text pages carry several lines of bibliographic data / text there)
+            kind = "drawing" if signals["header_lines"] == 1 else "scanned"
+
+    del signals["text"]
+    return kind, signals
+
+
+# %%
+def process_page(page, page_num, text_splitter, all_metadata, output_dir, pdf_path, keep_text=False, describe_sheets=True,
+                 page_hash=None):
+    """
+    Chunk a single page and record its outcome in all_metadata[pdf_path]["pages"].
+    The page's new chunks replace any chunks left from an earlier attempt, so a retried
+    page never duplicates chunks.
+    
+    Args:
+        page (fitz.Page): The page to process
+        page_num (int): The 0-based page number
+        text_splitter: Text splitter used for text pages
+        all_metadata (dict): The metadata dictionary
+        output_dir (str): Directory to save extracted images
+        pdf_path (str): The path to the PDF file
+        keep_text (bool): Store the page text in its page entry instead of chunking it
+                          (the structure-aware chunker chunks the whole document at the end)
+        describe_sheets (bool): Describe drawing sheets with LLaVA (see add_image_chunk)
+        page_hash (str): Content hash of the page, recorded in its page entry (see page_content_hash)
+        
+    Returns:
+        bool: True if the page was processed successfully, False otherwise
+    """
+    page_metadata = {pdf_path: {"chunks": []}}
+    errors = []
+    image_added = False
+    text_added = False
+    kind = None
+    classify_ms = None
+    text_content = None
+    try:
+        # Route the page by its layout instead of OCR-ing it first
+        start = time.perf_counter()
+        kind, _ = classify_page(page)
+        classify_ms = round((time.perf_counter() - start) * 1000, 2)
+        print(f"[{kind}, {classify_ms:.0f} ms]", end=" ")
+
+        if kind == "drawing":
+            image_added = add_image_chunk(page, page_num, page_metadata, output_dir, pdf_path, errors, describe=describe_sheets,
+                                          page_hash=page_hash)
+        elif kind in ("text", "scanned"):
+            text_content = page.get_text() if kind == "text" else ocr_text_extraction(page)
+            if keep_text:
+                text_added = bool(text_content.strip())
+            else:
+                text_added = add_text_chunk(text_splitter, text_content, page_num, page_metadata, pdf_path, errors)
+    except Exception as e:
+        print(f"Error processing page {page_num + 1}: {e}")
+        errors.append(str(e))
+    debug_print_chunking(text_added, image_added)
+
+    entry = all_metadata[pdf_path]
+    previous = entry["pages"].get(str(page_num + 1), {})
+    success = not errors
+    if success:
+        entry["chunks"] = [c for c in entry["chunks"] if c and c["page"] != page_num + 1]
+        entry["chunks"].extend(page_metadata[pdf_path]["chunks"])
+        entry["chunks"].sort(key=lambda c: c["page"])
+    entry["pages"][str(page_num + 1)] = {
+        "status": "done" if success else "failed",
+        "error": "; ".join(errors) if errors else None,
+        "attempts": previous.get("attempts", 0) + 1,
+        "kind": kind,
+        "classify_ms": classify_ms,
+        "hash": page_hash
+    }
+    if keep_text and success and text_content:
+        entry["pages"][str(page_num + 1)]["text"] = text_content
+    return success
+
+
+# %%
+def page_content_hash(page):
+    """
+    Hash of everything drawn on a page: its content stream(s) and the raw data of its images.
+    Cheap (nothing is rendered) and unchanged when an amended PDF leaves the page as it was.
+    
+    Args:
+        page (fitz.Page): The page to hash
+        
+    Returns:
+        str: Hex SHA-256 digest
+    """
+    import hashlib
+    digest = hashlib.sha256(f"{page.rect}|{page.rotation}|".encode())
+    digest.update(page.read_contents())
+    for image in page.get_images(full=True):
+        digest.update(page.parent.xref_stream_raw(image[0]) or b"")
+    return digest.hexdigest()
+
+
+def changed_pages(pdf_path, entry):
+    """
+    Compare a PDF with the page hashes recorded for it in the chunk store.
+    
+    Args:
+        pdf_path (str): Path to the patent PDF file
+        entry (dict): The PDF's entry in all_metadata (see extract_text_and_images_from_patent)
+        
+    Returns:
+        list: 1-based numbers of the pages that are new, changed, removed or have no recorded hash
+    """
+    doc = fitz.open(pdf_path)
+    recorded = entry.get("pages", {})
+    changed = [page_num + 1 for page_num in range(len(doc))
+               if recorded.get(str(page_num + 1), {}).get("hash") != page_content_hash(doc[page_num])]
+    changed += sorted(int(page) for page in recorded if int(page) > len(doc))
+    doc.close()
+    return changed
+
+
+# %%
+def extract_text_and_images_from_patent(pdf_path, output_dir="extracted_images", metadata_file=None, pages=None, chunking="structure",
+                                        describe_sheets=True):
     """
     Extract text and images from a patent PDF file.
     
     Args:
         pdf_path (str): Path to the patent PDF file
-        output_dir (str): Directory to save extracted images
-        enable_ocr (bool): Whether to use OCR for pages with minimal text (SLOW!)
+        output_dir (str): Root of the content-addressed store of the drawing sheets (see store_sheet_image)
+        metadata_file (str): Optional chunk store. Every processed page is appended to the PDF's
+                             checkpoint log (see page_checkpoint_path), which is merged into the
+                             store once the PDF is done. If a partial run of this PDF is recorded,
+                             processing resumes from the first unprocessed page and previously
+                             failed pages are retried.
+        pages (list): Optional 1-based page numbers to (re)process; other pages are left as they are.
+                      Without it, pages whose content hash differs from the recorded one (an amended
+                      PDF) are re-processed, and pages the PDF no longer has are dropped
+        chunking (str): "structure" chunks the text of the whole patent by section and claim
+                        (see chunk_patent_structure); "page" splits every page on its own
+        describe_sheets (bool): Run LLaVA on every drawing sheet. Set to False to store only the
+                                sheets' OCR text and describe them lazily at query time
+                                (create_sheet_describer), or when drawings are retrieved by CLIP
+                                image vectors (create_vector_store(image_model_name=...))
     
     Returns:
-        list: List of chunks with metadata in the format:
-              {"type": "text", "page": page_number, "content": text or image_path}
-              {"type": "image", "page": page_number, "image_description": image_description, "content": image_path}
+        dict: {pdf_path: {"chunks": [...], "pages": {page: status}, "complete": bool}} where chunks are:
+              {"type": "text", "page": page_number, "content": text}
+              {"type": "image_description", "page": page_number, "content": description, "image_hash": sha256,
+               "image_store": output_dir}  (file: chunk_image_path(chunk))
     """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
 
     doc = fitz.open(pdf_path)
     total_pages = len(doc)
     all_metadata = {pdf_path: {
-                      "chunks": []}}
+                      "chunks": [],
+                      "pages": {},
+                      "complete": False}}
+
+    # Resume from the checkpointed state of this PDF, if any
+    if metadata_file:
+        checkpoint_file = page_checkpoint_path(metadata_file, pdf_path)
+        existing = load_checkpointed_entry(metadata_file, pdf_path)
+        if existing:
+            all_metadata[pdf_path] = existing
+            done = sum(1 for status in existing["pages"].values() if status["status"] == "done")
+            print(f"Resuming {pdf_path}: {done}/{total_pages} pages already processed")
+    entry = all_metadata[pdf_path]
     
     separators = [
     "\n\n",  # First try to split on double newlines (paragraphs)
@@ -296,66 +1134,191 @@ def extract_text_and_images_from_patent(pdf_path, output_dir="extracted_images")
 
     print(f"Processing {total_pages} pages...")
     
+    # Pages removed from an amended PDF
+    removed = [int(page) for page in entry["pages"] if int(page) > total_pages]
+    if removed:
+        print(f"♻️  Dropping {len(removed)} page(s) no longer in {pdf_path}: {sorted(removed)}")
+        entry["chunks"] = [c for c in entry["chunks"] if c and c["page"] <= total_pages]
+        for page in removed:
+            del entry["pages"][str(page)]
+    
+    changed = 0
     for page_num in range(total_pages):
+        status = entry["pages"].get(str(page_num + 1))
         page = doc[page_num]
+        page_hash = page_content_hash(page)
+        if pages is not None:
+            if page_num + 1 not in pages:
+                continue
+        elif status and status["status"] == "done":
+            if status.get("hash") == page_hash:
+                continue
+            changed += 1  # Amended page: its old chunks are replaced by process_page
         print(f"📄 Processing page {page_num + 1}/{total_pages}...", end=" ")
-        
-        # Extract text from page pdf plain text
-        text_content = page.get_text()
-        if not text_content.strip():
-            text_content = ocr_text_extraction(page)
+        process_page(page, page_num, text_splitter, all_metadata, output_dir, pdf_path,
+                     keep_text=chunking == "structure", describe_sheets=describe_sheets, page_hash=page_hash)
 
-        matches = re.findall(r'sheet\s+.+?\s+of\s+.+?(?=[\.\n]|$)', text_content, flags=re.IGNORECASE)
-        image_added = False
-        text_added = False
-        if matches:
-            image_added = add_image_chunk(page, page_num, all_metadata, output_dir, pdf_path)
-        else:
-            text_added = add_text_chunk(text_splitter, text_content, page_num, all_metadata, pdf_path)
-        debug_print_chunking(text_added, image_added)
+        # Per-page commit: a crash or timeout later on only loses the page in progress
+        if metadata_file:
+            append_page_checkpoint(entry, page_num + 1, checkpoint_file)
 
     # Close the document
     doc.close()
-    print(f"Extraction complete! Found {len([c for c in all_metadata[pdf_path]['chunks'] if c['type'] == 'text'])} text chunks and {len([c for c in all_metadata[pdf_path]['chunks'] if c['type'] == 'image'])} images.")
+    if changed:
+        print(f"♻️  {changed} changed page(s) re-processed")
+    if chunking == "structure":
+        rechunk_patent_structure(entry, pdf_path)
+    failed = sorted(int(page) for page, status in entry["pages"].items() if status["status"] == "failed")
+    entry["complete"] = not failed and len(entry["pages"]) >= total_pages
+    if metadata_file:
+        save_chunks_metadata(all_metadata, metadata_file)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+    if failed:
+        print(f"⚠️  {len(failed)} page(s) failed and will be retried on the next run: {failed}")
+    classified = [status for status in entry["pages"].values() if status.get("classify_ms") is not None]
+    if classified:
+        kinds = {}
+        for status in classified:
+            kinds[status["kind"]] = kinds.get(status["kind"], 0) + 1
+        print(f"Page classification: {', '.join(f'{count} {kind}' for kind, count in sorted(kinds.items()))} "
+              f"({sum(status['classify_ms'] for status in classified) / len(classified):.1f} ms/page)")
+    print(f"Extraction complete! Found {len([c for c in entry['chunks'] if c['type'] == 'text'])} text chunks and {len([c for c in entry['chunks'] if c['type'] == 'image_description'])} images.")
     
     return all_metadata
 
 
-
 # %%
-def save_chunks_metadata(chunks, metadata_file="all_metadata.json"):
+def rechunk_patent_structure(entry, pdf_path):
     """
-    Save the chunks metadata to a JSON file.
-    If file exists, merge new data with existing data.
+    Re-chunk all stored page texts of a patent at once so chunks can cross page boundaries
+    (see chunk_patent_structure). The text chunks of those pages are replaced in place.
     
     Args:
-        chunks (dict): Dictionary with PDF path as key and chunk data as value
-        metadata_file (str): Path to save the metadata file
+        entry (dict): The PDF's entry in all_metadata, with page texts in its page entries
+        pdf_path (str): The path to the PDF file
     """
-    # Load existing data if file exists
-    existing_data = {}
-    if os.path.exists(metadata_file):
-        try:
-            with open(metadata_file, 'r', encoding='utf-8', errors='replace') as f:
-                existing_data = json.load(f)
-            print(f"Loaded existing data from {metadata_file}")
-        except (json.JSONDecodeError, Exception) as e:
-            print(f"Warning: Could not load existing data ({e}), starting fresh")
-            existing_data = {}
-    
-    # Merge new chunks with existing data
-    existing_data.update(chunks)
-    
-    # Save combined data
-    with open(metadata_file, 'w', encoding='utf-8', errors='replace') as f:
-        json.dump(existing_data, f, indent=2, ensure_ascii=False)
-        
-    print(f"Metadata saved to {metadata_file}")
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    # Structure segments are split on PDF lines only, so a claim number or a sentence
+    # start never ends up in a chunk of its own
+    structure_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=500,
+        chunk_overlap=100,
+        length_function=len,
+        separators=["\n", " ", ""]
+    )
+    page_texts = [(int(page), status["text"]) for page, status in sorted(entry["pages"].items(), key=lambda item: int(item[0]))
+                  if status.get("text")]
+    structured_pages = {page for page, _ in page_texts}
+    entry["chunks"] = [c for c in entry["chunks"] if c and not (c["type"] == "text" and c["page"] in structured_pages)]
+    entry["chunks"].extend(chunk_patent_structure(page_texts, pdf_path, structure_splitter))
+    entry["chunks"].sort(key=lambda c: c["page"])
 
 
 # %%
-def load_chunks_metadata(metadata_file="all_metadata.json"):
-    """
+def page_checkpoint_path(metadata_file, pdf_path):
+    """Append-only log of the pages of a PDF processed since its entry in the chunk store was last saved."""
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return f"{metadata_file}.{stem}.pages.jsonl"
+
+
+def append_page_checkpoint(entry, page_number, checkpoint_file):
+    """Append a page's status and chunks to the checkpoint log (cost independent of the corpus size)."""
+    record = {"page": page_number, "status": entry["pages"][str(page_number)],
+              "chunks": [c for c in entry["chunks"] if c and c["page"] == page_number]}
+    with open(checkpoint_file, 'a', encoding='utf-8', errors='replace') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def load_checkpointed_entry(metadata_file, pdf_path):
+    """
+    A PDF's entry in the chunk store with the pages of its checkpoint log applied on top.
+    A torn last line (crash mid-write) is ignored.
+    
+    Returns:
+        dict: The entry ({"chunks", "pages", "complete"}), or None if nothing is recorded
+    """
+    entry = (load_chunks_metadata(metadata_file) or {}).get(pdf_path)
+    if entry is not None and "pages" not in entry:
+        entry = None
+    checkpoint_file = page_checkpoint_path(metadata_file, pdf_path)
+    if not os.path.exists(checkpoint_file):
+        return entry
+    entry = entry or {"chunks": [], "pages": {}, "complete": False}
+    with open(checkpoint_file, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            entry["chunks"] = [c for c in entry["chunks"] if c and c["page"] != record["page"]] + record["chunks"]
+            entry["pages"][str(record["page"])] = record["status"]
+    entry["chunks"].sort(key=lambda c: c["page"])
+    entry["complete"] = False
+    return entry
+
+
+# %%
+def retry_failed_pages(pdf_path, metadata_file="all_metadata.json", output_dir="extracted_images"):
+    """
+    Re-run only the pages recorded as failed for a PDF in the chunk store.
+    
+    Args:
+        pdf_path (str): Path to the patent PDF file
+        metadata_file (str): The chunk store holding the page checkpoints
+        output_dir (str): Directory to save extracted images
+        
+    Returns:
+        dict: The updated metadata of the PDF (see extract_text_and_images_from_patent)
+    """
+    entry = load_checkpointed_entry(metadata_file, pdf_path) or {}
+    failed = [int(page) for page, status in entry.get("pages", {}).items() if status["status"] == "failed"]
+    if not failed:
+        print(f"No failed pages recorded for {pdf_path}")
+        return {pdf_path: entry}
+    print(f"Retrying {len(failed)} failed page(s) of {pdf_path}: {sorted(failed)}")
+    return extract_text_and_images_from_patent(pdf_path, output_dir, metadata_file=metadata_file, pages=failed)
+
+
+# %%
+def save_chunks_metadata(chunks, metadata_file="all_metadata.json", verbose=True):
+    """
+    Save the chunks metadata to a JSON file.
+    If file exists, merge new data with existing data.
+    The file is replaced atomically, so an interrupted save never corrupts the store.
+    
+    Args:
+        chunks (dict): Dictionary with PDF path as key and chunk data as value
+        metadata_file (str): Path to save the metadata file
+        verbose (bool): Print progress messages
+    """
+    # Load existing data if file exists
+    existing_data = {}
+    if os.path.exists(metadata_file):
+        try:
+            with open(metadata_file, 'r', encoding='utf-8', errors='replace') as f:
+                existing_data = json.load(f)
+            if verbose:
+                print(f"Loaded existing data from {metadata_file}")
+        except (json.JSONDecodeError, Exception) as e:
+            print(f"Warning: Could not load existing data ({e}), starting fresh")
+            existing_data = {}
+    
+    # Merge new chunks with existing data
+    existing_data.update(chunks)
+    
+    # Save combined data
+    with open(metadata_file + ".tmp", 'w', encoding='utf-8', errors='replace') as f:
+        json.dump(existing_data, f, indent=2, ensure_ascii=False)
+    os.replace(metadata_file + ".tmp", metadata_file)
+        
+    if verbose:
+        print(f"Metadata saved to {metadata_file}")
+
+
+# %%
+def load_chunks_metadata(metadata_file="all_metadata.json"):
+    """
     Load chunks metadata from JSON file.
     
     Args:
@@ -382,7 +1345,209 @@ def load_chunks_metadata(metadata_file="all_metadata.json"):
 
 # %%
 # === STEP 2: VECTOR STORE ===
-def create_vector_store(chunks, model_name="all-MiniLM-L6-v2", collection_name="patent_chunks"):
+def embeddings_index_path(embeddings_file):
+    """Path of the JSON chunk-id index stored next to an embeddings .npy file."""
+    return os.path.splitext(embeddings_file)[0] + "_index.json"
+
+
+# %%
+def save_embeddings(embeddings, chunk_ids, embeddings_file="embeddings.npy", model_name="all-MiniLM-L6-v2", dtype="float32", backend="torch"):
+    """
+    Persist chunk embeddings as a .npy matrix plus an aligned chunk-id index,
+    so other processes can memory-map them instead of re-encoding.
+    
+    Args:
+        embeddings (np.ndarray): Matrix of shape (num_chunks, vector_size)
+        chunk_ids (list): Chunk id of every row, in row order
+        embeddings_file (str): Path of the .npy file
+        model_name (str): Model that produced the embeddings
+        dtype (str): "float32" or "float16" (half the disk/RAM, ~3 significant digits)
+        backend (str): Encoder backend that produced the embeddings
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=dtype)
+    index = {
+        "model": model_name,
+        "backend": backend,
+        "dtype": dtype,
+        "shape": list(embeddings.shape),
+        "ids": list(chunk_ids)
+    }
+    # Write to temporary files first so readers never see a half-written matrix
+    with open(embeddings_file + ".tmp", 'wb') as f:
+        np.save(f, embeddings)
+    with open(embeddings_index_path(embeddings_file) + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(embeddings_file + ".tmp", embeddings_file)
+    os.replace(embeddings_index_path(embeddings_file) + ".tmp", embeddings_index_path(embeddings_file))
+    print(f"Saved {embeddings.shape[0]} {dtype} embeddings to {embeddings_file}")
+
+
+# %%
+def load_embeddings(embeddings_file="embeddings.npy", mmap=True):
+    """
+    Load persisted embeddings. With mmap=True the matrix is a read-only memory map:
+    nothing is deserialized or copied, and processes reading the same file share
+    one copy through the OS page cache.
+    
+    Args:
+        embeddings_file (str): Path of the .npy file
+        mmap (bool): Memory-map the matrix instead of reading it into RAM
+        
+    Returns:
+        tuple: (embeddings matrix, index dict with "model", "backend", "dtype", "shape", "ids")
+        (None, None): If the files don't exist
+    """
+    index_file = embeddings_index_path(embeddings_file)
+    if not os.path.exists(embeddings_file) or not os.path.exists(index_file):
+        return None, None
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    matrix = np.load(embeddings_file, mmap_mode="r" if mmap else None)
+    return matrix, index
+
+
+# %%
+def lookup_embeddings(embedding_store, chunk_ids):
+    """
+    Fetch the embedding rows of the given chunk ids from a loaded embeddings store.
+    
+    Args:
+        embedding_store (tuple): (matrix, index) as returned by load_embeddings, or a sharded
+                                 store from open_vector_shards
+        chunk_ids (list): Chunk ids to fetch
+        
+    Returns:
+        np.ndarray: float32 matrix of shape (len(chunk_ids), vector_size)
+    """
+    if isinstance(embedding_store, dict):
+        return sharded_lookup_embeddings(embedding_store, chunk_ids)
+    matrix, index = embedding_store
+    if "rows" not in index:
+        index["rows"] = {chunk_id: row for row, chunk_id in enumerate(index["ids"])}
+    rows = [index["rows"][chunk_id] for chunk_id in chunk_ids]
+    return np.asarray(matrix[rows], dtype=np.float32)
+
+
+# %%
+def merge_embeddings(chunk_ids, embedding_store, encode):
+    """
+    Embeddings of chunk_ids, taking the rows already in embedding_store and encoding only the rest.
+    
+    Args:
+        chunk_ids (list): Chunk ids in row order
+        embedding_store (tuple): (matrix, index) as returned by load_embeddings, or (None, None)
+        encode (callable): encode(positions) -> matrix for the positions of chunk_ids missing from the store
+        
+    Returns:
+        tuple: (float32 matrix of shape (len(chunk_ids), vector_size), number of encoded rows)
+    """
+    matrix, index = embedding_store
+    rows = {chunk_id: row for row, chunk_id in enumerate(index["ids"])} if index is not None else {}
+    missing = [position for position, chunk_id in enumerate(chunk_ids) if chunk_id not in rows]
+    encoded = np.asarray(encode(missing), dtype=np.float32) if missing else None
+    vector_size = encoded.shape[1] if encoded is not None else matrix.shape[1]
+    embeddings = np.zeros((len(chunk_ids), vector_size), dtype=np.float32)
+    known = [position for position, chunk_id in enumerate(chunk_ids) if chunk_id in rows]
+    if known:
+        embeddings[known] = matrix[[rows[chunk_ids[position]] for position in known]]
+    if missing:
+        embeddings[missing] = encoded
+    return embeddings, len(missing)
+
+
+# %%
+# Named vectors of the patent_chunks collection
+TEXT_VECTOR = "text"
+IMAGE_VECTOR = "image"
+
+
+def embed_chunks(chunks, chunk_ids, model, model_name="all-MiniLM-L6-v2", embeddings_file=None, embeddings_dtype="float32",
+                 encoder_backend="torch", batch_size=32, encode_workers=1, image_model_name=None):
+    """
+    Text (and optional image) embeddings of the chunks. Rows of an existing embeddings file are
+    reused by chunk id, so after an amendment only new or changed chunks are encoded.
+    See create_vector_store for the arguments.
+    
+    Returns:
+        tuple: (text embeddings matrix, {chunk_id: image vector} of the drawing sheets)
+    """
+    texts = [chunk['content'] for chunk in chunks]
+    
+    # Reuse persisted embeddings when they match these chunks, otherwise encode
+    embeddings, index = load_embeddings(embeddings_file) if embeddings_file else (None, None)
+    if (index is not None and index["ids"] == chunk_ids and index["model"] == model_name
+            and index.get("backend", "torch") == encoder_backend):
+        print(f"Memory-mapped {len(chunk_ids)} embeddings from {embeddings_file}")
+    else:
+        if index is not None and (index["model"] != model_name or index.get("backend", "torch") != encoder_backend):
+            embeddings, index = None, None  # Vectors of another model can't be mixed in
+        embeddings, encoded = merge_embeddings(chunk_ids, (embeddings, index), lambda positions: encode_texts(
+            model, [texts[position] for position in positions], batch_size=batch_size, workers=encode_workers,
+            model_name=model_name, backend=encoder_backend, show_progress_bar=True))
+        print(f"Encoded {encoded} text and image chunks ({len(chunk_ids) - encoded} reused)")
+        if embeddings_file:
+            save_embeddings(embeddings, chunk_ids, embeddings_file, model_name, embeddings_dtype, encoder_backend)
+    
+    # Optional image vectors of the drawing sheets (CPU CLIP model)
+    image_vectors = {}
+    if image_model_name:
+        sheets = [(chunk_id, chunk_image_path(chunk)) for chunk_id, chunk in zip(chunk_ids, chunks)
+                  if chunk['type'] == 'image_description' and os.path.exists(chunk_image_path(chunk))]
+        sheet_ids = [chunk_id for chunk_id, _ in sheets]
+        image_file = embeddings_file.replace(".npy", "_image.npy") if embeddings_file else None
+        sheet_embeddings, sheet_index = load_embeddings(image_file) if image_file else (None, None)
+        if sheet_index is None or sheet_index["ids"] != sheet_ids or sheet_index["model"] != image_model_name:
+            if sheet_index is not None and sheet_index["model"] != image_model_name:
+                sheet_embeddings, sheet_index = None, None
+            print(f"Embedding drawing sheets with {image_model_name}...")
+            sheet_embeddings = merge_embeddings(sheet_ids, (sheet_embeddings, sheet_index), lambda positions: encode_images(
+                get_sentence_model(image_model_name), [sheets[position][1] for position in positions]))[0] if sheets else np.zeros((0, 0))
+            if image_file and sheets:
+                save_embeddings(sheet_embeddings, sheet_ids, image_file, image_model_name)
+        image_vectors = {chunk_id: vector for chunk_id, vector in zip(sheet_ids, sheet_embeddings)}
+    return embeddings, image_vectors
+
+
+def chunk_payload(chunk, chunk_index):
+    """Payload stored with a chunk's vectors: the fields retrieval returns and filters on."""
+    return {
+        "type": chunk["type"],
+        "page": chunk["page"],
+        "content": chunk["content"],
+        "chunk_index": chunk_index,
+        "patent": chunk.get("patent", ""),
+        "section": chunk.get("section"),
+        "claim_number": chunk.get("claim_number"),
+        "parent_claim": chunk.get("parent_claim"),
+        "figure": chunk.get("figure")
+    }
+
+
+def index_payload_fields(client, collection_name):
+    """Index the payload fields retrieval filters on (a no-op for local / in-memory Qdrant, which filters by scanning)."""
+    import warnings
+    from qdrant_client.http.models import PayloadSchemaType
+    with warnings.catch_warnings():
+        # Local Qdrant warns on every index it is asked to build
+        warnings.filterwarnings("ignore", message="Payload indexes have no effect in the local Qdrant")
+        for field_name, field_schema in (("type", PayloadSchemaType.KEYWORD), ("section", PayloadSchemaType.KEYWORD),
+                                         ("claim_number", PayloadSchemaType.INTEGER), ("patent", PayloadSchemaType.KEYWORD)):
+            client.create_payload_index(collection_name, field_name=field_name, field_schema=field_schema)
+
+
+def chunk_point(chunk, chunk_id, chunk_index, embedding, image_vectors):
+    """Qdrant point of one chunk: named text (and image) vectors plus the payload retrieval filters on."""
+    from qdrant_client.http.models import PointStruct
+    return PointStruct(
+        id=chunk_id,  # Stable chunk ID (same key as the embeddings file rows)
+        vector={TEXT_VECTOR: embedding.astype(np.float32).tolist(),  # Convert numpy array to list
+                **({IMAGE_VECTOR: image_vectors[chunk_id].tolist()} if chunk_id in image_vectors else {})},
+        payload=chunk_payload(chunk, chunk_index)
+    )
+
+
+def create_vector_store(chunks, model_name="all-MiniLM-L6-v2", collection_name="patent_chunks", embeddings_file=None, embeddings_dtype="float32",
+                        encoder_backend="torch", batch_size=32, encode_workers=1, image_model_name=None):
     """
     Create vector store using SentenceTransformer and Qdrant.
     
@@ -392,24 +1557,36 @@ def create_vector_store(chunks, model_name="all-MiniLM-L6-v2", collection_name="
                           (passed default "all-MiniLM-L6-v2" which is popular and balanced
                           embedding vector size 384)
         collection_name (str): Qdrant collection name
+        embeddings_file (str): Optional .npy file. If it holds embeddings for exactly these chunks
+                               and model they are memory-mapped instead of re-encoded, otherwise
+                               the new embeddings are saved there.
+        embeddings_dtype (str): dtype used when saving the embeddings file ("float32" / "float16")
+        encoder_backend (str): "torch", "onnx" or "int8" (see get_sentence_model)
+        batch_size (int): Texts per encoder forward pass
+        encode_workers (int): Number of CPU processes used to encode the chunks
+        image_model_name (str): Optional CLIP-style model (e.g. "clip-ViT-B-32"). Every drawing
+                                sheet PNG then also gets an "image" vector next to its "text" vector,
+                                and its embeddings are kept in <embeddings_file>_image.npy
         
     Returns:
         tuple: (qdrant_client, sentence_transformer_model)
     """
+    from qdrant_client import QdrantClient
+    from qdrant_client.http.models import Distance, VectorParams
+
     print(f"\n=== Step 2: Creating Vector Store ===")
 
     # Initialize SentenceTransformer
-    print(f"Loading SentenceTransformer model: {model_name}")
-    model = SentenceTransformer(model_name)
-    
-    # Extract text content for encoding
-    texts = [chunk['content'] for chunk in chunks]
+    model = get_sentence_model(model_name, encoder_backend)
     
-    # Create embeddings
-    print("Creating embeddings for all text and image chunks...")
-    embeddings = model.encode(texts, show_progress_bar=True)
+    chunk_ids = [get_chunk_id(chunk) for chunk in chunks]
+    embeddings, image_vectors = embed_chunks(chunks, chunk_ids, model, model_name, embeddings_file, embeddings_dtype,
+                                             encoder_backend, batch_size, encode_workers, image_model_name)
     vector_size = embeddings.shape[1]
-    print(f"Created embeddings: {embeddings.shape[0]} vectors of size {vector_size}")
+    print(f"Embeddings ready: {embeddings.shape[0]} vectors of size {vector_size}")
+    vectors_config = {TEXT_VECTOR: VectorParams(size=vector_size, distance=Distance.COSINE)}
+    if image_vectors:
+        vectors_config[IMAGE_VECTOR] = VectorParams(size=len(next(iter(image_vectors.values()))), distance=Distance.COSINE)
     
     # Initialize in-memory (RAM) Qdrant client
     print("Setting up in-memory Qdrant vector database...")
@@ -422,31 +1599,22 @@ def create_vector_store(chunks, model_name="all-MiniLM-L6-v2", collection_name="
     # 4. COSINE: cosine similarity
     # 5. id: unique identifier for each point
     # 6. vector: embedding vector
+    # 7. named vectors: "text" for every chunk, "image" for drawing sheets when an image model is used
     client.create_collection(
         collection_name=collection_name,
-        vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE),
+        vectors_config=vectors_config,
     )
+    index_payload_fields(client, collection_name)
     print(f"Created Qdrant collection: {collection_name}")
     
     # Prepare points for insertion
-    points = []
     # Each chunk and its corresponding embedding are zipped together
     # and then enumerated to get the index and the chunk and embedding
-    # the index is used to create a unique ID for each point
+    # the chunk id is the unique ID of each point
     # the chunk is used to create the payload
     # the embedding is used to create the vector
-    for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-        point = PointStruct(
-            id=str(uuid.uuid4()),  # Unique ID for each point
-            vector=embedding.tolist(),  # Convert numpy array to list
-            payload={
-                "type": chunk["type"],
-                "page": chunk["page"],
-                "content": chunk["content"],
-                "chunk_index": i
-            }
-        )
-        points.append(point)
+    points = [chunk_point(chunk, chunk_ids[i], i, embedding, image_vectors)
+              for i, (chunk, embedding) in enumerate(zip(chunks, embeddings))]
     
     # Insert vectors into Qdrant
     client.upsert(
@@ -460,11 +1628,634 @@ def create_vector_store(chunks, model_name="all-MiniLM-L6-v2", collection_name="
     return client, model
 
 
+# %%
+def update_vector_store(client, model, chunks, model_name="all-MiniLM-L6-v2", collection_name="patent_chunks", embeddings_file=None,
+                        patent=None, encoder_backend="torch", batch_size=32, image_model_name=None):
+    """
+    Bring an existing collection in line with the chunks of an amended patent: points whose chunk
+    no longer exists are deleted and points of new chunks are inserted, unchanged points are kept
+    (only their "chunk_index" payload is moved to the chunk's new position, if it changed).
+    Only the new chunks are encoded: with an embeddings file its rows are reused by chunk id
+    and the file is brought up to date (see embed_chunks).
+    
+    Args:
+        client: Qdrant client holding the collection (from create_vector_store)
+        model: SentenceTransformer model
+        chunks (list): The patent's current chunks
+        patent (str): Only points of this patent are candidates for deletion (default: the chunks' patent)
+        Other arguments as in create_vector_store
+        
+    Returns:
+        tuple: (number of deleted points, number of inserted points)
+    """
+    from qdrant_client.http.models import Filter, FieldCondition, MatchValue, PointIdsList, SetPayload, SetPayloadOperation
+    
+    if patent is None:
+        patent = next((chunk.get('patent') for chunk in chunks if chunk.get('patent')), "")
+    chunk_ids = [get_chunk_id(chunk) for chunk in chunks]
+    
+    # Point ids (and their chunk_index) currently stored for the patent
+    existing, offset = {}, None
+    while True:
+        records, offset = client.scroll(collection_name, limit=1024, offset=offset, with_payload=["chunk_index"], with_vectors=False,
+                                        scroll_filter=Filter(must=[FieldCondition(key="patent", match=MatchValue(value=patent))]))
+        existing.update((str(record.id), (record.payload or {}).get("chunk_index")) for record in records)
+        if offset is None:
+            break
+    
+    stale = set(existing) - set(chunk_ids)
+    if stale:
+        client.delete(collection_name, points_selector=PointIdsList(points=sorted(stale)))
+    new_positions = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in existing]
+    if new_positions:
+        if embeddings_file:
+            # Full call: reuses the file's rows (encodes only the new chunks) and keeps the file complete
+            embeddings, image_vectors = embed_chunks(chunks, chunk_ids, model, model_name, embeddings_file,
+                                                     encoder_backend=encoder_backend, batch_size=batch_size,
+                                                     image_model_name=image_model_name)
+            rows = new_positions
+        else:
+            embeddings, image_vectors = embed_chunks([chunks[i] for i in new_positions], [chunk_ids[i] for i in new_positions],
+                                                     model, model_name, encoder_backend=encoder_backend, batch_size=batch_size,
+                                                     image_model_name=image_model_name)
+            rows = range(len(new_positions))
+        client.upsert(collection_name=collection_name,
+                      points=[chunk_point(chunks[i], chunk_ids[i], i, embeddings[row], image_vectors)
+                              for i, row in zip(new_positions, rows)])
+    # Kept points whose chunk moved (pages inserted or removed before it)
+    moved = [SetPayloadOperation(set_payload=SetPayload(payload={"chunk_index": i}, points=[chunk_id]))
+             for i, chunk_id in enumerate(chunk_ids) if chunk_id in existing and existing[chunk_id] != i]
+    if moved:
+        client.batch_update_points(collection_name, update_operations=moved)
+    print(f"♻️  Vector store updated: {len(stale)} points deleted, {len(new_positions)} inserted, "
+          f"{len(chunk_ids) - len(new_positions)} kept ({len(moved)} renumbered)")
+    return len(stale), len(new_positions)
+
+
+# %%
+# === COLUMNAR EXPORT ===
+# Chunks, their payload fields and their text embeddings as columns: one Arrow/Parquet table
+# (pyarrow, optional) for analytics, and the source of bulk_load_vector_store, which rebuilds the
+# collection from whole column batches instead of one PointStruct per chunk.
+PAYLOAD_COLUMNS = ["type", "page", "content", "chunk_index", "patent", "section", "claim_number", "parent_claim", "figure"]
+
+
+def chunk_columns(chunks, embeddings):
+    """
+    Columns of the chunks: "id", the payload fields of chunk_payload, "image_hash" and the
+    embedding matrix under "embedding".
+    """
+    payloads = [chunk_payload(chunk, i) for i, chunk in enumerate(chunks)]
+    columns = {"id": [get_chunk_id(chunk) for chunk in chunks]}
+    for field in PAYLOAD_COLUMNS:
+        columns[field] = [payload[field] for payload in payloads]
+    columns["image_hash"] = [chunk.get("image_hash") for chunk in chunks]
+    columns["embedding"] = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(chunks), -1)
+    return columns
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow
+    except ImportError as e:
+        raise ImportError("Parquet export needs pyarrow (pip install pyarrow)") from e
+
+
+def export_chunks_parquet(chunks, embeddings, parquet_file="chunks.parquet", model_name="all-MiniLM-L6-v2", row_group_size=16384):
+    """
+    Write chunks, payload fields and text embeddings to a Parquet file (zstd-compressed).
+    The embeddings are a fixed-size list<float32> column, so readers get them back as one matrix.
+    
+    Args:
+        chunks (list): Chunk dictionaries
+        embeddings (np.ndarray): Text embeddings of the chunks, in chunk order
+        parquet_file (str): Output file
+        model_name (str): Model that produced the embeddings (file metadata)
+        row_group_size (int): Rows per Parquet row group
+    """
+    pa = _import_pyarrow()
+    columns = chunk_columns(chunks, embeddings)
+    matrix = columns.pop("embedding")
+    arrays = {name: pa.array(values) for name, values in columns.items()}
+    for name in ("page", "chunk_index", "claim_number", "parent_claim"):
+        arrays[name] = pa.array(columns[name], type=pa.int32())
+    arrays["embedding"] = pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), matrix.shape[1])
+    table = pa.table(arrays).replace_schema_metadata({"model": model_name, "dim": str(matrix.shape[1])})
+    pa.parquet.write_table(table, parquet_file + ".tmp", compression="zstd", row_group_size=row_group_size)
+    os.replace(parquet_file + ".tmp", parquet_file)
+    print(f"✅ Exported {len(chunks)} chunks ({matrix.shape[1]}-dim embeddings) to {parquet_file}")
+
+
+def read_chunks_parquet(parquet_file, columns=None):
+    """
+    Read an exported Parquet file back as columns (see chunk_columns).
+    
+    Args:
+        parquet_file (str): File written by export_chunks_parquet
+        columns (list): Optional subset of columns to read (e.g. ["patent", "page", "embedding"])
+        
+    Returns:
+        dict: Column name -> list, and "embedding" -> float32 matrix (no per-row conversion)
+    """
+    pa = _import_pyarrow()
+    table = pa.parquet.read_table(parquet_file, columns=columns)
+    result = {}
+    for name in table.column_names:
+        column = table.column(name).combine_chunks()
+        if name == "embedding":
+            result[name] = column.flatten().to_numpy(zero_copy_only=False).reshape(len(column), column.type.list_size)
+        else:
+            result[name] = column.to_pylist()
+    return result
+
+
+def bulk_load_vector_store(columns, client=None, collection_name="patent_chunks", batch_size=4096, model_name="all-MiniLM-L6-v2"):
+    """
+    Rebuild the vector store from columns (chunk_columns / read_chunks_parquet, or a Parquet file
+    path) in large batches: vectors are handed to Qdrant as numpy blocks, without a PointStruct
+    or a float list per chunk. Image vectors are not part of the columns.
+    
+    Args:
+        columns (dict or str): Columns, or the path of a Parquet export
+        client: Existing Qdrant client (default: a new in-memory one)
+        collection_name (str): Collection to (re)create
+        batch_size (int): Points per upload batch
+        model_name (str): SentenceTransformer model for the returned query encoder
+        
+    Returns:
+        tuple: (qdrant_client, sentence_transformer_model) like create_vector_store
+    """
+    from qdrant_client import QdrantClient
+    from qdrant_client.http.models import Distance, VectorParams
+    if isinstance(columns, str):
+        columns = read_chunks_parquet(columns)
+    matrix = columns["embedding"]
+    client = client or QdrantClient(":memory:")
+    if client.collection_exists(collection_name):
+        client.delete_collection(collection_name)
+    client.create_collection(collection_name=collection_name,
+                             vectors_config={TEXT_VECTOR: VectorParams(size=matrix.shape[1], distance=Distance.COSINE)})
+    index_payload_fields(client, collection_name)
+    bulk_upload_columns(client, collection_name, columns, batch_size)
+    print(f"✅ Bulk-loaded {len(matrix)} vectors into Qdrant collection {collection_name}")
+    return client, get_sentence_model(model_name)
+
+
+def bulk_upload_columns(client, collection_name, columns, batch_size=4096):
+    """Upload columns (see chunk_columns) into an existing collection, batch_size points per request."""
+    matrix = columns["embedding"]
+    fields = [field for field in PAYLOAD_COLUMNS if field in columns]
+    for start in range(0, len(matrix), batch_size):
+        end = min(start + batch_size, len(matrix))
+        payloads = [dict(zip(fields, values)) for values in zip(*(columns[field][start:end] for field in fields))]
+        client.upload_collection(collection_name, vectors={TEXT_VECTOR: matrix[start:end]}, payload=payloads,
+                                 ids=columns["id"][start:end], batch_size=batch_size, wait=True)
+
+
+# %%
+# === DISTRIBUTED INGESTION ===
+# A coordinator enqueues per-patent (or per-page) jobs; stateless workers on any host sharing the
+# queue and the store directory lease jobs, run extraction / OCR / descriptions / embedding and
+# commit the results. Jobs are delivered at least once (an expired lease is handed to another
+# worker), so every write is idempotent: results are keyed by patent/page and replaced atomically,
+# embeddings are keyed by chunk id, and Qdrant points by their stable chunk id.
+def _sqlite_open(path):
+    import sqlite3
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+        key TEXT PRIMARY KEY, kind TEXT, job_group TEXT, payload TEXT, status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0, lease_owner TEXT, lease_until REAL, error TEXT, created REAL, updated REAL)""")
+    return connection
+
+
+def _sqlite_enqueue(connection, key, kind, payload, group=None):
+    cursor = connection.execute(
+        "INSERT OR IGNORE INTO jobs (key, kind, job_group, payload, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+        (key, kind, group, json.dumps(payload), time.time(), time.time()))
+    return cursor.rowcount == 1
+
+
+def _sqlite_claim(connection, owner, lease_seconds):
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")  # One claimer at a time
+    try:
+        row = connection.execute(
+            "SELECT key, kind, job_group, payload, attempts FROM jobs WHERE status = 'pending' "
+            "OR (status = 'leased' AND lease_until < ?) ORDER BY created, key LIMIT 1", (now,)).fetchone()
+        if row is not None:
+            connection.execute("UPDATE jobs SET status = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1, "
+                               "updated = ? WHERE key = ?", (owner, now + lease_seconds, now, row[0]))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    return {"key": row[0], "kind": row[1], "group": row[2], "payload": json.loads(row[3]), "attempts": row[4] + 1, "owner": owner}
+
+
+def _sqlite_renew(connection, job, lease_seconds):
+    cursor = connection.execute("UPDATE jobs SET lease_until = ? WHERE key = ? AND status = 'leased' AND lease_owner = ?",
+                                (time.time() + lease_seconds, job["key"], job["owner"]))
+    return cursor.rowcount == 1
+
+
+def _sqlite_reset(connection, key, statuses=("failed",)):
+    cursor = connection.execute(f"UPDATE jobs SET status = 'pending', attempts = 0, lease_owner = NULL, error = NULL, updated = ? "
+                                f"WHERE key = ? AND status IN ({', '.join('?' * len(statuses))})", (time.time(), key, *statuses))
+    return cursor.rowcount == 1
+
+
+def _sqlite_open_jobs(connection, group):
+    return connection.execute("SELECT COUNT(*) FROM jobs WHERE job_group = ? AND status IN ('pending', 'leased')",
+                              (group,)).fetchone()[0]
+
+
+def _sqlite_complete(connection, job):
+    connection.execute("UPDATE jobs SET status = 'done', lease_owner = NULL, error = NULL, updated = ? "
+                       "WHERE key = ? AND status != 'done'", (time.time(), job["key"]))
+    if job["group"] is None:
+        return False
+    return _sqlite_open_jobs(connection, job["group"]) == 0  # Failed jobs of the group are settled too
+
+
+def _sqlite_fail(connection, job, error, max_attempts):
+    status = "failed" if job["attempts"] >= max_attempts else "pending"
+    cursor = connection.execute("UPDATE jobs SET status = ?, lease_owner = NULL, error = ?, updated = ? "
+                                "WHERE key = ? AND status = 'leased' AND lease_owner = ?",
+                                (status, error, time.time(), job["key"], job["owner"]))
+    return status if cursor.rowcount == 1 else "lost"  # The lease expired and the job went to another worker
+
+
+def _sqlite_close(connection):
+    connection.close()
+
+
+def _sqlite_status(connection):
+    counts = dict(connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    failed = connection.execute("SELECT key, error FROM jobs WHERE status = 'failed' ORDER BY key").fetchall()
+    return {"counts": counts, "failed": dict(failed)}
+
+
+JOB_QUEUE_BACKENDS = {
+    "sqlite": {"open": _sqlite_open, "enqueue": _sqlite_enqueue, "claim": _sqlite_claim, "renew": _sqlite_renew,
+               "complete": _sqlite_complete, "fail": _sqlite_fail, "reset": _sqlite_reset, "open_jobs": _sqlite_open_jobs,
+               "status": _sqlite_status, "close": _sqlite_close},
+}
+
+
+def open_job_queue(path="ingestion_queue.db", backend="sqlite"):
+    """
+    Open (or create) an ingestion job queue.
+    
+    Args:
+        path (str): Location of the queue (the SQLite database file for the "sqlite" backend)
+        backend (str): Key of JOB_QUEUE_BACKENDS
+        
+    Returns:
+        dict: Queue handle passed to the other job queue functions
+    """
+    if backend not in JOB_QUEUE_BACKENDS:
+        raise ValueError(f"Unknown job queue backend '{backend}' (choose from {', '.join(JOB_QUEUE_BACKENDS)})")
+    return {"backend": backend, "path": path, "connection": JOB_QUEUE_BACKENDS[backend]["open"](path)}
+
+
+def _queue_call(queue, operation, *args):
+    return JOB_QUEUE_BACKENDS[queue["backend"]][operation](queue["connection"], *args)
+
+
+def close_job_queue(queue):
+    """Close the connection of a queue handle from open_job_queue."""
+    _queue_call(queue, "close")
+
+
+def enqueue_ingestion_jobs(queue, pdf_paths, per_page=False, retry_failed=False):
+    """
+    Coordinator: enqueue the ingestion of patents. Jobs are keyed by the PDF's content hash, so
+    re-enqueuing an unchanged patent is a no-op while an amended PDF is ingested again.
+    
+    Args:
+        queue (dict): Handle from open_job_queue
+        pdf_paths (list): PDF paths, readable by every worker (shared filesystem)
+        per_page (bool): One job per page instead of per patent; the worker settling the last
+                         page of a patent enqueues its "finalize" job (chunking + embedding)
+        retry_failed (bool): Hand the failed jobs of unchanged patents to the workers again
+        
+    Returns:
+        int: Number of jobs added (or reset)
+    """
+    def enqueue(key, kind, payload, group=None):
+        if _queue_call(queue, "enqueue", key, kind, payload, group):
+            return 1
+        return int(retry_failed and _queue_call(queue, "reset", key))
+    
+    added = 0
+    for pdf_path in pdf_paths:
+        pdf_hash = file_fingerprint(pdf_path)[:16]
+        if not per_page:
+            added += enqueue(f"patent:{pdf_path}:{pdf_hash}", "patent", {"pdf_path": pdf_path, "pdf_hash": pdf_hash})
+            continue
+        doc = fitz.open(pdf_path)
+        total_pages = len(doc)
+        doc.close()
+        for page_num in range(total_pages):
+            added += enqueue(f"page:{pdf_path}:{pdf_hash}:{page_num + 1}", "page",
+                             {"pdf_path": pdf_path, "pdf_hash": pdf_hash, "page": page_num + 1, "total_pages": total_pages},
+                             f"pages:{pdf_path}:{pdf_hash}")
+    print(f"Enqueued {added} ingestion job(s) for {len(pdf_paths)} patent(s)")
+    return added
+
+
+def _enqueue_finalize_job(queue, job):
+    """The last page job of a patent is settled (done or failed): (re-)run the patent's finalize job."""
+    key = f"finalize:{job['group'][len('pages:'):]}"
+    if not _queue_call(queue, "enqueue", key, "finalize", job["payload"]):
+        _queue_call(queue, "reset", key, ("done", "failed"))  # Pages were retried: merge them again
+
+
+def job_queue_status(queue):
+    """Number of jobs per status and the errors of failed jobs: {"counts": {...}, "failed": {key: error}}."""
+    return _queue_call(queue, "status")
+
+
+def ingestion_store_paths(store_dir, pdf_path):
+    """Locations of a patent's results in the shared store directory."""
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return {
+        "metadata": os.path.join(store_dir, "chunks", f"{stem}.json"),  # all_metadata format, one patent
+        "pages": os.path.join(store_dir, "pages", stem),                # per-page results of per-page jobs
+        "images": os.path.join(store_dir, "images"),
+        "embeddings": os.path.join(store_dir, "embeddings", f"{stem}_embeddings.npy"),
+    }
+
+
+def _commit_patent_vectors(entry, pdf_path, paths, options):
+    """Embed the patent's chunks (reusing rows by chunk id) and upsert them to a shared Qdrant, if configured."""
+    chunks = entry["chunks"]
+    if not options.get("embed", True) or not chunks:
+        return
+    model_name = options.get("model_name", "all-MiniLM-L6-v2")
+    model = get_sentence_model(model_name)
+    os.makedirs(os.path.dirname(paths["embeddings"]), exist_ok=True)
+    chunk_ids = [get_chunk_id(chunk) for chunk in chunks]
+    embeddings, _ = embed_chunks(chunks, chunk_ids, model, model_name, embeddings_file=paths["embeddings"],
+                                 image_model_name=options.get("image_model_name"))
+    if options.get("qdrant_url"):
+        from qdrant_client import QdrantClient
+        from qdrant_client.http.models import Distance, VectorParams, PayloadSchemaType
+        client = QdrantClient(url=options["qdrant_url"])
+        collection_name = options.get("collection_name", "patent_chunks")
+        if not client.collection_exists(collection_name):
+            client.create_collection(collection_name, vectors_config={
+                TEXT_VECTOR: VectorParams(size=embeddings.shape[1], distance=Distance.COSINE)})
+            client.create_payload_index(collection_name, field_name="patent", field_schema=PayloadSchemaType.KEYWORD)
+        update_vector_store(client, model, chunks, model_name, collection_name, embeddings_file=paths["embeddings"],
+                            patent=pdf_path, image_model_name=options.get("image_model_name"))
+
+
+def _ingest_patent_job(job, store_dir, options):
+    pdf_path = job["payload"]["pdf_path"]
+    paths = ingestion_store_paths(store_dir, pdf_path)
+    os.makedirs(os.path.dirname(paths["metadata"]), exist_ok=True)
+    # The per-patent chunk file doubles as the extraction checkpoint: a re-delivered job resumes
+    all_metadata = extract_text_and_images_from_patent(pdf_path, paths["images"], metadata_file=paths["metadata"],
+                                                       describe_sheets=options.get("describe_sheets", True))
+    entry = all_metadata[pdf_path]
+    if not entry["complete"]:
+        raise RuntimeError(f"{pdf_path}: some pages failed")
+    _commit_patent_vectors(entry, pdf_path, paths, options)
+
+
+def _ingest_page_job(job, store_dir, options):
+    pdf_path, page_number = job["payload"]["pdf_path"], job["payload"]["page"]
+    paths = ingestion_store_paths(store_dir, pdf_path)
+    os.makedirs(paths["pages"], exist_ok=True)
+    os.makedirs(paths["images"], exist_ok=True)
+    page_metadata = {pdf_path: {"chunks": [], "pages": {}}}
+    doc = fitz.open(pdf_path)
+    try:
+        page = doc[page_number - 1]
+        print(f"📄 Processing page {page_number} of {pdf_path}...", end=" ")
+        success = process_page(page, page_number - 1, None, page_metadata, paths["images"], pdf_path, keep_text=True,
+                               describe_sheets=options.get("describe_sheets", True), page_hash=page_content_hash(page))
+    finally:
+        doc.close()
+    if not success:
+        raise RuntimeError(page_metadata[pdf_path]["pages"][str(page_number)]["error"])
+    # Page results of an amended PDF never mix with those of the old version
+    page_dir = os.path.join(paths["pages"], job["payload"].get("pdf_hash", ""))
+    os.makedirs(page_dir, exist_ok=True)
+    page_file = os.path.join(page_dir, f"{page_number}.json")
+    with open(page_file + ".tmp", 'w', encoding='utf-8', errors='replace') as f:
+        json.dump(page_metadata[pdf_path], f, ensure_ascii=False)
+    os.replace(page_file + ".tmp", page_file)
+
+
+def _finalize_patent_job(job, store_dir, options):
+    pdf_path, total_pages = job["payload"]["pdf_path"], job["payload"]["total_pages"]
+    paths = ingestion_store_paths(store_dir, pdf_path)
+    page_dir = os.path.join(paths["pages"], job["payload"].get("pdf_hash", ""))
+    entry = {"chunks": [], "pages": {}, "complete": False}
+    failed = []
+    for page_number in range(1, total_pages + 1):
+        page_file = os.path.join(page_dir, f"{page_number}.json")
+        if not os.path.exists(page_file):
+            # The page job failed for good: merge the other pages, like a local extraction does
+            entry["pages"][str(page_number)] = {"status": "failed", "error": "page job failed (see ingest.py status)",
+                                                "attempts": 0, "kind": None, "classify_ms": None, "hash": None}
+            failed.append(page_number)
+            continue
+        with open(page_file, 'r', encoding='utf-8', errors='replace') as f:
+            page_result = json.load(f)
+        entry["chunks"].extend(page_result["chunks"])
+        entry["pages"].update(page_result["pages"])
+    entry["chunks"].sort(key=lambda c: c["page"])
+    rechunk_patent_structure(entry, pdf_path)
+    entry["complete"] = not failed
+    os.makedirs(os.path.dirname(paths["metadata"]), exist_ok=True)
+    save_chunks_metadata({pdf_path: entry}, paths["metadata"], verbose=False)
+    _commit_patent_vectors(entry, pdf_path, paths, options)
+    if failed:
+        print(f"⚠️  {pdf_path}: merged without the failed page(s) {failed} (retry with ingest.py enqueue --retry-failed)")
+
+
+INGESTION_JOB_HANDLERS = {
+    "patent": _ingest_patent_job,
+    "page": _ingest_page_job,
+    "finalize": _finalize_patent_job,
+}
+
+
+def run_ingestion_worker(queue, store_dir="ingestion_store", worker_id=None, lease_seconds=900, max_attempts=3,
+                         poll_interval=2.0, exit_when_idle=True, max_jobs=None, **options):
+    """
+    Stateless ingestion worker: lease jobs from the queue, run them and commit their results to
+    store_dir until the queue is empty. Run any number of these on hosts sharing queue and store.
+    
+    Args:
+        queue (dict): Handle from open_job_queue
+        store_dir (str): Shared directory the results are written to (see ingestion_store_paths)
+        worker_id (str): Lease owner name (default: host:pid)
+        lease_seconds (float): A job whose worker stops renewing its lease for this long is handed to
+                               another worker (the lease is renewed while the job runs)
+        max_attempts (int): Deliveries of a job before it is marked failed
+        poll_interval (float): Seconds to wait for new jobs when the queue is empty
+        exit_when_idle (bool): Return when no job is available instead of polling forever
+        max_jobs (int): Optional number of jobs after which the worker exits
+        **options: describe_sheets, embed, model_name, image_model_name, qdrant_url, collection_name
+        
+    Returns:
+        int: Number of jobs completed
+    """
+    import socket
+    import threading
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    completed = 0
+    while max_jobs is None or completed < max_jobs:
+        job = _queue_call(queue, "claim", worker_id, lease_seconds)
+        if job is None:
+            if exit_when_idle:
+                break
+            time.sleep(poll_interval)
+            continue
+        print(f"\n🛠️  {worker_id}: {job['key']} (attempt {job['attempts']})")
+        
+        # Keep the lease alive from a separate connection while the job runs
+        stop = threading.Event()
+        def heartbeat():
+            renew_queue = open_job_queue(queue["path"], queue["backend"])
+            try:
+                while not stop.wait(lease_seconds / 3):
+                    _queue_call(renew_queue, "renew", job, lease_seconds)
+            finally:
+                close_job_queue(renew_queue)
+        renewer = threading.Thread(target=heartbeat, daemon=True)
+        renewer.start()
+        try:
+            INGESTION_JOB_HANDLERS[job["kind"]](job, store_dir, options)
+        except Exception as e:
+            status = _queue_call(queue, "fail", job, str(e), max_attempts)
+            print(f"❌ {job['key']} failed ({e}) - {'giving up' if status == 'failed' else 'will be retried'}")
+            if status == "failed" and job["kind"] == "page" and _queue_call(queue, "open_jobs", job["group"]) == 0:
+                _enqueue_finalize_job(queue, job)
+            continue
+        finally:
+            stop.set()
+            renewer.join()
+        if _queue_call(queue, "complete", job) and job["kind"] == "page":
+            # Last page of the patent settled: chunk and embed the whole patent
+            _enqueue_finalize_job(queue, job)
+        completed += 1
+        print(f"✅ {job['key']} done")
+    return completed
+
+
+def export_ingested_metadata(store_dir="ingestion_store", metadata_file="all_metadata.json"):
+    """
+    Merge the per-patent results of the ingestion workers into a chunk store main() can load.
+    
+    Returns:
+        list: The patents exported
+    """
+    chunks_dir = os.path.join(store_dir, "chunks")
+    exported = []
+    for file_name in sorted(os.listdir(chunks_dir)) if os.path.isdir(chunks_dir) else []:
+        if file_name.endswith(".json"):
+            with open(os.path.join(chunks_dir, file_name), 'r', encoding='utf-8', errors='replace') as f:
+                patents = json.load(f)
+            save_chunks_metadata(patents, metadata_file, verbose=False)
+            exported.extend(patents)
+    print(f"Exported {len(exported)} patent(s) from {store_dir} to {metadata_file}")
+    return exported
+
+
+def export_ingested_parquet(store_dir="ingestion_store", parquet_file="chunks.parquet", model_name="all-MiniLM-L6-v2"):
+    """
+    Export the chunks and text embeddings the ingestion workers stored as one Parquet file
+    (see export_chunks_parquet). Patents without stored embeddings are skipped.
+    
+    Returns:
+        int: Number of chunks exported
+    """
+    chunks_dir = os.path.join(store_dir, "chunks")
+    all_chunks, matrices = [], []
+    for file_name in sorted(os.listdir(chunks_dir)) if os.path.isdir(chunks_dir) else []:
+        if not file_name.endswith(".json"):
+            continue
+        with open(os.path.join(chunks_dir, file_name), 'r', encoding='utf-8', errors='replace') as f:
+            patents = json.load(f)
+        for pdf_path, entry in patents.items():
+            chunks = [chunk for chunk in entry.get("chunks", []) if chunk]
+            embedding_store = load_embeddings(ingestion_store_paths(store_dir, pdf_path)["embeddings"])
+            if not chunks or embedding_store[1] is None or embedding_store[1]["model"] != model_name:
+                print(f"⚠️ No {model_name} embeddings stored for {pdf_path}, skipped")
+                continue
+            all_chunks.extend(dict(chunk, patent=chunk.get("patent") or pdf_path) for chunk in chunks)
+            matrices.append(lookup_embeddings(embedding_store, [get_chunk_id(chunk) for chunk in chunks]))
+    if not all_chunks:
+        print(f"❌ Nothing to export from {store_dir}")
+        return 0
+    export_chunks_parquet(all_chunks, np.concatenate(matrices), parquet_file, model_name)
+    return len(all_chunks)
+
+
 # %%
 # === STEP 3: QUESTION INPUT ===
+def read_questions(questions_file):
+    """
+    Yield questions one at a time from a .txt, .jsonl or .csv file, skipping [[HIDDEN]] sections.
+    - txt: one question per line (blank lines are kept as questions)
+    - jsonl: one object per line with a "question" field; {"hidden": true} rows are skipped
+    - csv: a "question" column, or the first column when the first row is not a header with a "question" cell
+    In every format a question equal to [[HIDDEN]] / [[/HIDDEN]] opens / closes a hidden section.
+    
+    Args:
+        questions_file (str): Path to the questions file
+        
+    Yields:
+        tuple: (question number, question string)
+    """
+    import csv
+    import itertools
+    extension = os.path.splitext(questions_file)[1].lower()
+    inside_hidden = False
+    count_hidden = 0
+    with open(questions_file, 'r', encoding='utf-8', errors='replace', newline='') as f:
+        if extension == ".jsonl":
+            rows = ((json.loads(line) if line.strip() else {"question": ""}) for line in f)
+            rows = (("" if row.get("hidden") else None, str(row.get("question", "")).strip()) for row in rows)
+        elif extension == ".csv":
+            reader = csv.reader(f)
+            first_row = next(reader, None)
+            header = [cell.strip().lower() for cell in first_row or []]
+            if "question" in header:
+                column = header.index("question")
+            else:
+                # No header: the first row is question 1
+                column = 0
+                reader = itertools.chain([first_row] if first_row is not None else [], reader)
+            rows = ((None, row[column].strip() if len(row) > column else "") for row in reader)
+        else:
+            rows = ((None, line.strip()) for line in f)
+        for line_num, (skip, question) in enumerate(rows, 1):
+            if question == "[[HIDDEN]]":
+                inside_hidden = True
+                count_hidden += 1
+                continue
+            if question == "[[/HIDDEN]]":
+                inside_hidden = False
+                count_hidden += 1
+                continue
+            if not inside_hidden and skip is None:
+                yield line_num - count_hidden, question
+
+
 def load_questions(questions_file="questions.txt"):
     """
-    Load questions from a text file.
+    Load questions from a text file (.txt, .jsonl or .csv, see read_questions).
     
     Args:
         questions_file (str): Path to the questions file
@@ -480,24 +2271,11 @@ def load_questions(questions_file="questions.txt"):
         return []
     
     # Load questions from file
-    inside_hidden = False
-    count_hidden = 0
     questions = []
     try:
-        with open(questions_file, 'r', encoding='utf-8', errors='replace') as f:
-            for line_num, line in enumerate(f, 1):
-                question = line.strip()
-                if question == "[[HIDDEN]]":
-                    inside_hidden = True
-                    count_hidden += 1
-                    continue
-                if question == "[[/HIDDEN]]":
-                    inside_hidden = False
-                    count_hidden += 1
-                    continue
-                if not inside_hidden:
-                    questions.append(question)
-                    print(f"  Q{line_num - count_hidden}: {question}")
+        for number, question in read_questions(questions_file):
+            questions.append(question)
+            print(f"  Q{number}: {question}")
         
         print(f"✅ Loaded {len(questions)} questions from '{questions_file}'")
         
@@ -509,12 +2287,153 @@ def load_questions(questions_file="questions.txt"):
         print("⚠️  No questions found in file!")
         return []
     
-    return questions
+    return questions
+
+
+def stream_question_batches(questions_file, batch_size=64, prefetch_batches=4):
+    """
+    Read a (large) questions file in a background thread and yield it in batches, so
+    retrieval and generation start on the first batch while the rest is still being read.
+    
+    Args:
+        questions_file (str): Path to the questions file (.txt, .jsonl or .csv)
+        batch_size (int): Questions per batch
+        prefetch_batches (int): Batches read ahead of the consumer (bounds memory)
+        
+    Yields:
+        list: Question strings, in file order
+    """
+    import queue
+    import threading
+    batches = queue.Queue(maxsize=prefetch_batches)
+    
+    def reader():
+        try:
+            batch = []
+            for _, question in read_questions(questions_file):
+                batch.append(question)
+                if len(batch) == batch_size:
+                    batches.put(batch)
+                    batch = []
+            if batch:
+                batches.put(batch)
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+    
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+
+
+def answer_question_stream(questions_file, chunks, client, model, output_file="both_models_answers.txt",
+                           batch_size=64, route="both", semantic_cache_file=None, semantic_cache_threshold=0.95, **rag_options):
+    """
+    Answer a questions file batch by batch: prompts for the next batch are built (retrieval)
+    while the current batch is being answered, and answers are appended to output_file in
+    question order as soon as they are generated. The LLM backend is checked once, up front.
+    
+    Args:
+        questions_file (str): Path to the questions file (.txt, .jsonl or .csv)
+        chunks (list): All chunks of the patent
+        client: Qdrant client
+        model: SentenceTransformer model
+        output_file (str): File the answers are written to
+        batch_size (int): Questions per batch
+        route (str): Model routing of generate_answers ("auto", "both", "llama", "llava")
+        semantic_cache_file (str): Optional semantic cache (see load_semantic_cache), saved with the
+                                   answers of the stream once it is done
+        semantic_cache_threshold (float): Similarity at which a question reuses a cached one
+        **rag_options: Passed to process_questions_with_rag (patent_key, prompt_layout, ...)
+        
+    Returns:
+        int: Number of questions answered
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if not check_answer_models():
+        return 0
+    semantic_cache = None
+    if semantic_cache_file:
+        semantic_cache = load_semantic_cache(semantic_cache_file, threshold=semantic_cache_threshold, cache_answers=True)
+    answered = queued = 0
+    pending = None
+    
+    def answer(prompts, first_number):
+        answers = generate_answers(prompts, output_file, append=first_number > 1, start_index=first_number, route=route,
+                                   check_models=False)
+        return len(answers)
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for batch in stream_question_batches(questions_file, batch_size=batch_size):
+            next_prompts = (executor.submit(process_questions_with_rag, batch, chunks, client, model,
+                                            semantic_cache=semantic_cache, start_index=queued + 1, **rag_options), queued + 1)
+            queued += len(batch)
+            if pending is not None:
+                answered += answer(pending[0].result(), pending[1])
+            pending = next_prompts
+        if pending is not None:
+            answered += answer(pending[0].result(), pending[1])
+    if semantic_cache is not None:
+        save_semantic_cache(semantic_cache, semantic_cache_file)  # With the answers generate_answers attached
+    print(f"\n✅ Answered {answered} of {queued} questions from '{questions_file}'")
+    return answered
+
+
+# %%
+# === STEP 4: RAG PROMPT CONSTRUCTION ===
+def mmr_select(query_embedding, candidate_embeddings, top_k=3, lambda_mult=0.7):
+    """
+    Maximal Marginal Relevance: pick top_k candidates that are relevant to the query but not
+    redundant with each other. All similarities come from one matrix product; each of the top_k
+    steps updates every candidate's redundancy with one vectorized maximum.
+    
+    Args:
+        query_embedding (np.ndarray): Query vector
+        candidate_embeddings (np.ndarray): Candidate vectors, shape (num_candidates, vector_size)
+        top_k (int): Number of candidates to select
+        lambda_mult (float): 1.0 = relevance only (plain top-k), 0.0 = diversity only
+        
+    Returns:
+        list: Indices of the selected candidates, in selection order
+    """
+    vectors = np.asarray(candidate_embeddings, dtype=np.float32)
+    if len(vectors) == 0:
+        return []
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T  # The single candidate x candidate similarity matrix
+    redundancy = np.full(len(vectors), -np.inf, dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+    selected = []
+    for _ in range(min(top_k, len(vectors))):
+        penalty = redundancy if selected else 0.0  # Nothing selected yet: plain relevance
+        scores = lambda_mult * relevance - (1 - lambda_mult) * penalty
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
 
 
-# %%
-# === STEP 4: RAG PROMPT CONSTRUCTION ===
-def retrieve_relevant_chunks(question, client, model, collection_name="patent_chunks", top_k=3):
+def mmr_rerank(relevant_chunks, question_embedding, top_k=3, lambda_mult=0.7):
+    """Reduce over-fetched retrieval results (with 'embedding') to a diverse top_k with mmr_select."""
+    if len(relevant_chunks) <= 1:
+        return relevant_chunks[:top_k]
+    picks = mmr_select(question_embedding, [chunk['embedding'] for chunk in relevant_chunks], top_k, lambda_mult)
+    return [relevant_chunks[i] for i in picks]
+
+
+def retrieve_relevant_chunks(question, client, model, collection_name="patent_chunks", top_k=3, question_embedding=None,
+                             sections=None, claim_numbers=None, mmr_lambda=None, mmr_candidates=20):
     """
     Retrieve top-k relevant text chunks for a question using vector similarity.
     
@@ -524,6 +2443,12 @@ def retrieve_relevant_chunks(question, client, model, collection_name="patent_ch
         model: SentenceTransformer model
         collection_name (str): Name of Qdrant collection
         top_k (int): Number of chunks to retrieve
+        question_embedding (np.ndarray): Optional pre-computed embedding of the question
+        sections (list): Only search these sections, e.g. ["claims"] (structure-chunked patents)
+        claim_numbers (list): Only search these claims
+        mmr_lambda (float): If set, fetch mmr_candidates chunks and keep a diverse top_k of them
+                            (see mmr_select); None keeps the plain top_k by similarity
+        mmr_candidates (int): Candidate pool size of the MMR selection
         
     Returns:
         list: List of relevant chunks with metadata including embeddings of the form:
@@ -531,24 +2456,34 @@ def retrieve_relevant_chunks(question, client, model, collection_name="patent_ch
                                     'content': str,
                                     'page': int,
                                     'chunk_index': int,
+                                    'section': str,
+                                    'claim_number': int,
                                     'similarity': float,
                                     'embedding': list
                                 }
     """
+    from qdrant_client.http.models import Filter, FieldCondition, MatchValue, MatchAny
+
     # Convert question to embedding
-    question_embedding = model.encode([question])
+    if question_embedding is None:
+        question_embedding = model.encode([question])
+    else:
+        question_embedding = np.asarray(question_embedding).reshape(1, -1)
+
+    conditions = [FieldCondition(key="type", match=MatchValue(value="text"))]
+    if sections:
+        conditions.append(FieldCondition(key="section", match=MatchAny(any=list(sections))))
+    if claim_numbers:
+        conditions.append(FieldCondition(key="claim_number", match=MatchAny(any=[int(n) for n in claim_numbers])))
 
     # Search for similar chunks in Qdrant (with vectors) - using query_points (newer API)
     search_results = client.query_points(
         collection_name=collection_name,
         query=question_embedding[0].tolist(),
-        limit=top_k,
-        query_filter=Filter(
-            must=[
-                FieldCondition(key="type", match=MatchValue(value="text"))
-            ]
-        ),
-        with_vectors=True  # Include vectors in results
+        using=TEXT_VECTOR,
+        limit=top_k if mmr_lambda is None else max(top_k, mmr_candidates),
+        query_filter=Filter(must=conditions),
+        with_vectors=[TEXT_VECTOR]  # Include vectors in results
     )
     
     # Extract chunks with similarity scores and embeddings
@@ -558,16 +2493,22 @@ def retrieve_relevant_chunks(question, client, model, collection_name="patent_ch
             'content': result.payload['content'],
             'page': result.payload['page'],
             'chunk_index': result.payload['chunk_index'],
+            'section': result.payload.get('section'),
+            'claim_number': result.payload.get('claim_number'),
+            'patent': result.payload.get('patent'),
             'similarity': result.score,
-            'embedding': result.vector  # Include the stored embedding
+            'embedding': result.vector[TEXT_VECTOR]  # Include the stored embedding
         })
     
+    if mmr_lambda is not None:
+        relevant_chunks = mmr_rerank(relevant_chunks, question_embedding[0], top_k, mmr_lambda)
     return relevant_chunks
 
 
 # %%
 # TODO: Instead of taking the greatest score, we have to take the greatest for the top chosen texts chunks (For each chosen text, take the top image).
-def top_similar_images(relevant_chunks, chunks, max_images=2, client=None, collection_name="patent_chunks", max_threshold=0.4):
+def top_similar_images(relevant_chunks, chunks, max_images=2, client=None, collection_name="patent_chunks", max_threshold=0.4, embedding_store=None,
+                       question_image_embedding=None, image_threshold=0.2):
     """
     Find up to 2 most relevant image chunks based on similarity to the relevant text chunks.
     
@@ -583,6 +2524,12 @@ def top_similar_images(relevant_chunks, chunks, max_images=2, client=None, colle
         chunks (list): All chunks (text and image)
         max_images (int): Maximum number of images to return
         client: Qdrant client
+        embedding_store (tuple): Optional (matrix, index) from load_embeddings; image vectors are
+                                 then read from the memory-mapped file instead of Qdrant
+        question_image_embedding (np.ndarray): Optional question embedding from the CLIP image model.
+                                 Drawings are then scored directly against the question by their
+                                 "image" vectors instead of through their text descriptions
+        image_threshold (float): Minimum question/image cosine similarity (CLIP scores run lower)
         
     Returns:
         dict of top-k most relevant image chunks of the form:
@@ -594,53 +2541,36 @@ def top_similar_images(relevant_chunks, chunks, max_images=2, client=None, colle
                                     'embedding': list
                                 }
     """
-    
     # Find image chunks, for candidate store only the page number then compare with client Qdrant.
     candidate_images = [chunk for chunk in chunks if chunk['type'] == 'image_description']
     
     if not candidate_images:
         return []
     
+    if question_image_embedding is not None and client is not None:
+        return query_images_by_vector(client, collection_name, candidate_images, question_image_embedding, max_images, image_threshold)
+    
     # Use pre-computed embeddings from relevant chunks (no re-encoding!)
     relevant_text_embeddings = [chunk['embedding'] for chunk in relevant_chunks]
+    if not relevant_text_embeddings:
+        return []
     
-
-    # take the embeddings that match the candidate_images form client qdrant - using query_points (newer API)
-    candidates_images_results = client.query_points(
-        collection_name=collection_name,
-        query=[0.0] * 384,  # Dummy vector (not used for filtering)
-        limit=1000,  # Large limit to get all matches
-        query_filter=Filter(
-            must=[
-                FieldCondition(
-                    key="page",
-                    match=MatchAny(any=[img['page'] for img in candidate_images])
-                ),
-                FieldCondition(
-                    key="type", 
-                    match=MatchValue(value="image_description")
-                )
-            ]
-        ), with_vectors=True )
-    
-    candidates_images_embeddings = []
-    for result in candidates_images_results.points:
-        candidates_images_embeddings.append({
-            'page': result.payload['page'],
-            'content': result.payload['content'],
-            'chunk_index': result.payload['chunk_index'],
-            'similarity': result.score,
-            'embedding': result.vector
-        })
-
+    candidate_ids = [get_chunk_id(img) for img in candidate_images]
+    if embedding_store is not None:
+        # Read the image vectors straight from the memory-mapped embeddings (no Qdrant round trip)
+        image_vectors = dict(zip(candidate_ids, lookup_embeddings(embedding_store, candidate_ids)))
+    else:
+        image_vectors = {found['id']: found['embedding'] for found in query_image_embeddings(client, collection_name, candidate_images)}
+    # Vectors are matched to the sheets by chunk id; a sheet without a stored vector cannot be scored
+    candidate_images = [img for img, chunk_id in zip(candidate_images, candidate_ids) if chunk_id in image_vectors]
 
     # TODO: we need to modify this to take img from given similirity score threshold.
     
     # Calculate max similarity between each image and any relevant text chunk
     similarities = []
-    for candidate_embedding in candidates_images_embeddings:
+    for img in candidate_images:
         # Get similarity scores between this image and all relevant text chunks
-        img_similarities = cosine_similarity([candidate_embedding['embedding']], relevant_text_embeddings)[0]
+        img_similarities = cosine_similarity([image_vectors[get_chunk_id(img)]], relevant_text_embeddings)[0]
         # Take the maximum similarity (best match with any relevant text)
         max_similarity = max(img_similarities)
         similarities.append(max_similarity)
@@ -661,7 +2591,7 @@ def top_similar_images(relevant_chunks, chunks, max_images=2, client=None, colle
         # Debug: Print similarity scores
         print(f"     Top {max_images} image similarity scores (vs pre-computed relevant text embeddings):")
         for i, img in enumerate(selected_images):
-            print(f"       Image {i+1}: Page {img['page']}, Max Similarity = {img['similarity']:.3f}, Path = {img['image_path']}")
+            print(f"       Image {i+1}: Page {img['page']}, Max Similarity = {img['similarity']:.3f}, Path = {chunk_image_path(img)}")
         return selected_images
     else:
         print(f"     No images found with similarity score >= {max_threshold}")
@@ -669,7 +2599,591 @@ def top_similar_images(relevant_chunks, chunks, max_images=2, client=None, colle
 
 
 # %%
-def construct_rag_prompt(question, question_index, relevant_chunks, selected_images_chunks, max_context_bytes=2000):
+def query_images_by_vector(client, collection_name, candidate_images, question_image_embedding, max_images=2, image_threshold=0.2):
+    """
+    Score drawing sheets directly against the question with their "image" vectors in Qdrant.
+    
+    Args:
+        client: Qdrant client
+        collection_name (str): Name of Qdrant collection
+        candidate_images (list): Image description chunks to choose from
+        question_image_embedding (np.ndarray): Question embedded with the image model
+        max_images (int): Maximum number of images to return
+        image_threshold (float): Minimum cosine similarity
+        
+    Returns:
+        list: The selected image chunks with their 'similarity', or None if none pass the threshold
+    """
+    from qdrant_client.http.models import Filter, HasIdCondition
+
+    by_id = {get_chunk_id(img): img for img in candidate_images}
+    results = client.query_points(
+        collection_name=collection_name,
+        query=np.asarray(question_image_embedding, dtype=np.float32).ravel().tolist(),
+        using=IMAGE_VECTOR,
+        limit=max_images,
+        query_filter=Filter(must=[HasIdCondition(has_id=list(by_id))]),
+        score_threshold=image_threshold
+    )
+    selected_images = []
+    for result in results.points:
+        img = by_id[str(result.id)]
+        img['similarity'] = result.score
+        selected_images.append(img)
+    if not selected_images:
+        print(f"     No images found with image similarity score >= {image_threshold}")
+        return None
+    print(f"     Top {max_images} image similarity scores (question vs drawing image vectors):")
+    for i, img in enumerate(selected_images):
+        print(f"       Image {i+1}: Page {img['page']}, Similarity = {img['similarity']:.3f}, Path = {chunk_image_path(img)}")
+    return selected_images
+
+
+# %%
+def query_image_embeddings(client, collection_name, candidate_images):
+    """
+    Pull the stored vectors of the candidate image chunks back from Qdrant.
+    The points are selected by chunk id, so a collection holding several patents only
+    returns the candidates' own sheets.
+    
+    Args:
+        client: Qdrant client
+        collection_name (str): Name of Qdrant collection
+        candidate_images (list): Image description chunks
+        
+    Returns:
+        list: Dictionaries with 'id', 'page', 'content', 'chunk_index' and 'embedding'
+    """
+    from qdrant_client.http.models import Filter, HasIdCondition
+
+    candidate_ids = list({get_chunk_id(img) for img in candidate_images})
+    points, _ = client.scroll(
+        collection_name=collection_name,
+        scroll_filter=Filter(must=[HasIdCondition(has_id=candidate_ids)]),
+        limit=len(candidate_ids),
+        with_vectors=[TEXT_VECTOR]
+    )
+    
+    candidates_images_embeddings = []
+    for result in points:
+        candidates_images_embeddings.append({
+            'id': str(result.id),
+            'page': result.payload['page'],
+            'content': result.payload['content'],
+            'chunk_index': result.payload['chunk_index'],
+            'embedding': result.vector[TEXT_VECTOR]
+        })
+
+    return candidates_images_embeddings
+
+
+# %%
+# === SHARDED RETRIEVAL ===
+# Chunks are partitioned by patent into shard files (memory-mapped embeddings + payloads). Every
+# shard is pinned to its own search process, which is the only one that maps it; a query fans out
+# to these processes, each shard returns its exact top-k hits (payload and vector included), and
+# the partial lists are merged with a heap - the result is identical to an exact search over all chunks.
+def shard_of(patent, num_shards):
+    """Stable shard number of a patent (the same in every process and run)."""
+    import zlib
+    return zlib.crc32(patent.encode("utf-8")) % num_shards
+
+
+def build_vector_shards(chunks, embeddings, shard_dir="vector_shards", num_shards=4, model_name="all-MiniLM-L6-v2"):
+    """
+    Partition chunks and their embeddings by patent into num_shards shard files.
+    
+    Args:
+        chunks (list): Chunk dictionaries (all patents)
+        embeddings (np.ndarray): Text embeddings of the chunks, in chunk order
+        shard_dir (str): Directory of the shard files
+        num_shards (int): Number of shards
+        model_name (str): Model that produced the embeddings
+        
+    Returns:
+        str: Path of the shard manifest (shards.json)
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    # Unit vectors: the cosine similarity is then a plain dot product
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    rows_of_shard = {}
+    for i, chunk in enumerate(chunks):
+        rows_of_shard.setdefault(shard_of(chunk.get("patent", ""), num_shards), []).append(i)
+    files = []
+    for shard in range(num_shards):
+        rows = rows_of_shard.get(shard, [])
+        shard_file = os.path.join(shard_dir, f"shard_{shard}.npy")
+        save_embeddings(vectors[rows].reshape(len(rows), vectors.shape[1]), [get_chunk_id(chunks[i]) for i in rows],
+                        shard_file, model_name)
+        with open(shard_file.replace(".npy", "_payloads.json"), 'w', encoding='utf-8') as f:
+            json.dump([chunk_payload(chunks[i], i) for i in rows], f, ensure_ascii=False)
+        files.append(os.path.basename(shard_file))
+    manifest = {"num_shards": num_shards, "model": model_name, "dim": int(vectors.shape[1]), "files": files,
+                "patents": {patent: shard_of(patent, num_shards) for patent in {c.get("patent", "") for c in chunks}}}
+    manifest_file = os.path.join(shard_dir, "shards.json")
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"✅ Built {num_shards} shards of {len(chunks)} chunks in {shard_dir}")
+    return manifest_file
+
+
+_SHARD_CACHE = {}  # Filled in the shard processes (or in this process if the store has none)
+
+
+def _load_shard(shard_file):
+    """Memory-map a shard once per process, with its payloads and filter columns."""
+    if shard_file not in _SHARD_CACHE:
+        matrix, index = load_embeddings(shard_file)
+        with open(shard_file.replace(".npy", "_payloads.json"), 'r', encoding='utf-8') as f:
+            payloads = json.load(f)
+        _SHARD_CACHE[shard_file] = {
+            "matrix": matrix,
+            "ids": index["ids"],
+            "payloads": payloads,
+            "type": np.array([p["type"] for p in payloads], dtype=object),
+            "section": np.array([p.get("section") for p in payloads], dtype=object),
+            "claim_number": np.array([p.get("claim_number") or -1 for p in payloads]),
+            "patent": np.array([p.get("patent", "") for p in payloads], dtype=object),
+            "chunk_index": np.array([p["chunk_index"] for p in payloads]),
+        }
+    return _SHARD_CACHE[shard_file]
+
+
+def _search_shard(shard_file, queries, top_k, types=None, sections=None, claim_numbers=None, patents=None):
+    """Exact top-k of one shard for every query: lists of (similarity, chunk_index, hit) with hit in the
+    format of retrieve_relevant_chunks."""
+    shard = _load_shard(shard_file)
+    if not shard["ids"]:
+        return [[] for _ in queries]
+    mask = np.ones(len(shard["ids"]), dtype=bool)
+    for column, allowed in (("type", types), ("section", sections), ("claim_number", claim_numbers), ("patent", patents)):
+        if allowed:
+            mask &= np.isin(shard[column], list(allowed))
+    candidates = np.flatnonzero(mask)
+    if candidates.size == 0:
+        return [[] for _ in queries]
+    scores = queries @ np.asarray(shard["matrix"][candidates], dtype=np.float32).T
+    k = min(top_k, candidates.size)
+    results = []
+    chunk_indices = shard["chunk_index"][candidates]
+    for query_scores in scores:
+        # Everything scoring at least the k-th best, then equal scores in chunk order (deterministic ties)
+        threshold = query_scores[np.argpartition(-query_scores, k - 1)[:k]].min()
+        tied = np.flatnonzero(query_scores >= threshold)
+        best = tied[np.lexsort((chunk_indices[tied], -query_scores[tied]))[:k]]
+        hits = []
+        for j in best:
+            # Only the k hits of the shard cross the process boundary, with their payload and vector
+            payload = shard["payloads"][candidates[j]]
+            hits.append((float(query_scores[j]), int(chunk_indices[j]), {
+                'content': payload['content'],
+                'page': payload['page'],
+                'chunk_index': payload['chunk_index'],
+                'section': payload.get('section'),
+                'claim_number': payload.get('claim_number'),
+                'patent': payload.get('patent'),
+                'similarity': float(query_scores[j]),
+                'embedding': np.asarray(shard["matrix"][candidates[j]], dtype=np.float32).tolist()
+            }))
+        results.append(hits)
+    return results
+
+
+def _lookup_shard(shard_file, chunk_ids):
+    """Embedding rows of the chunk ids stored in one shard: {chunk_id: vector}."""
+    shard = _load_shard(shard_file)
+    if "rows" not in shard:
+        shard["rows"] = {chunk_id: row for row, chunk_id in enumerate(shard["ids"])}
+    return {chunk_id: np.asarray(shard["matrix"][shard["rows"][chunk_id]], dtype=np.float32)
+            for chunk_id in chunk_ids if chunk_id in shard["rows"]}
+
+
+def open_vector_shards(shard_dir="vector_shards", processes=True):
+    """
+    Open a sharded store for querying.
+    
+    Args:
+        shard_dir (str): Directory written by build_vector_shards
+        processes (bool): Pin every shard to its own search process, so each shard is mapped by
+                          one process only; False searches the shards one after another in this process
+        
+    Returns:
+        dict: Store handle for sharded_search / sharded_retrieve_relevant_chunks / lookup_embeddings
+    """
+    with open(os.path.join(shard_dir, "shards.json"), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    files = [os.path.join(shard_dir, name) for name in manifest["files"]]
+    executors = None
+    if processes:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        context = multiprocessing.get_context("spawn")
+        executors = [ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in files]
+    return {"manifest": manifest, "files": files, "executors": executors}
+
+
+def close_vector_shards(store):
+    """Stop the shard search processes."""
+    for executor in store["executors"] or []:
+        executor.shutdown()
+
+
+def _call_shards(store, shards, function, *args):
+    """Run function(shard_file, *args) for the given shard numbers, in the shards' own processes."""
+    if store["executors"] is None:
+        return [function(store["files"][shard], *args) for shard in shards]
+    futures = [store["executors"][shard].submit(function, store["files"][shard], *args) for shard in shards]
+    return [future.result() for future in futures]
+
+
+def sharded_search(store, query_embeddings, top_k=3, types=("text",), sections=None, claim_numbers=None, patents=None):
+    """
+    Scatter a batch of queries to the shards in parallel and gather the global top-k of each.
+    Shards holding none of the requested patents are skipped.
+    
+    Args:
+        store (dict): Handle from open_vector_shards
+        query_embeddings (np.ndarray): Query embeddings, shape (num_queries, vector_size)
+        top_k (int): Results per query
+        types, sections, claim_numbers, patents (list): Optional payload filters
+        
+    Returns:
+        list: For every query, its top-k chunks in the format of retrieve_relevant_chunks
+    """
+    queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, store["manifest"]["dim"])
+    queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    shards = range(len(store["files"]))
+    if patents:
+        shard_numbers = {store["manifest"]["patents"].get(patent) for patent in patents}
+        shards = [shard for shard in shards if shard in shard_numbers]
+    partials = _call_shards(store, shards, _search_shard, queries, top_k, types, sections, claim_numbers, patents)
+    
+    results = []
+    for q in range(len(queries)):
+        # Highest similarity first; equal scores keep the unsharded chunk order
+        merged = heapq.nlargest(top_k, (hit for partial in partials for hit in partial[q]), key=lambda hit: (hit[0], -hit[1]))
+        results.append([hit for _, _, hit in merged])
+    return results
+
+
+def sharded_retrieve_relevant_chunks(question, store, model, top_k=3, question_embedding=None, sections=None,
+                                     claim_numbers=None, patents=None):
+    """retrieve_relevant_chunks over a sharded store (see sharded_search); patents limits the search to their shards."""
+    if question_embedding is None:
+        question_embedding = model.encode([question])
+    return sharded_search(store, question_embedding, top_k, sections=sections, claim_numbers=claim_numbers, patents=patents)[0]
+
+
+def sharded_lookup_embeddings(store, chunk_ids):
+    """Embedding rows of chunk ids from a sharded store (fetched by the shard processes)."""
+    chunk_ids = list(chunk_ids)
+    rows = {}
+    for found in _call_shards(store, range(len(store["files"])), _lookup_shard, chunk_ids):
+        rows.update(found)
+    return np.asarray([rows[chunk_id] for chunk_id in chunk_ids],
+                      dtype=np.float32).reshape(len(chunk_ids), store["manifest"]["dim"])
+
+
+# %%
+# === HIERARCHICAL RETRIEVAL ===
+# Patent -> page -> chunk search for corpora of many patents. Every patent and every page gets a
+# summary vector (the normalized mean of its chunk embeddings, or of the abstract for patents);
+# a query scores the patents first, then the pages of the best patents, and compares itself
+# only with the chunks of the best pages. Text chunks are stored sorted by patent and page, so the
+# chunks of a page are one contiguous block of rows.
+def _normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def build_hierarchy_index(chunks, embeddings, index_dir="hierarchy_index", model_name="all-MiniLM-L6-v2",
+                          patent_summary="mean"):
+    """
+    Build the patent-level and page-level summary vectors of the text chunks.
+    
+    Args:
+        chunks (list): Chunk dictionaries (all patents)
+        embeddings (np.ndarray): Text embeddings of the chunks, in chunk order
+        index_dir (str): Directory of the index files
+        model_name (str): Model that produced the embeddings
+        patent_summary (str): "mean" (all chunks of the patent) or "abstract" (abstract chunks,
+                              falling back to the mean for patents without a detected abstract)
+        
+    Returns:
+        str: Path of the index manifest (hierarchy.json)
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    vectors = _normalize_rows(embeddings)
+    rows = [i for i, chunk in enumerate(chunks) if chunk["type"] == "text"]
+    rows.sort(key=lambda i: (chunks[i].get("patent", ""), int(chunks[i]["page"]), i))
+    chunk_matrix = vectors[rows].reshape(len(rows), vectors.shape[1])
+    
+    # Contiguous row ranges of every page, and page ranges of every patent
+    patents, patent_offsets, pages, page_offsets = [], [], [], []
+    for position, i in enumerate(rows):
+        patent, page = chunks[i].get("patent", ""), int(chunks[i]["page"])
+        if not patents or patents[-1] != patent:
+            patents.append(patent)
+            patent_offsets.append(len(pages))
+        if not pages or pages[-1] != [patent, page]:
+            pages.append([patent, page])
+            page_offsets.append(position)
+    patent_offsets.append(len(pages))
+    page_offsets.append(len(rows))
+    
+    page_vectors = _normalize_rows(np.add.reduceat(chunk_matrix, page_offsets[:-1], axis=0)) if rows else chunk_matrix[:0]
+    patent_vectors = []
+    for p, patent in enumerate(patents):
+        patent_rows = slice(page_offsets[patent_offsets[p]], page_offsets[patent_offsets[p + 1]])
+        summary_rows = chunk_matrix[patent_rows]
+        if patent_summary == "abstract":
+            abstract = [j for j, i in enumerate(rows[patent_rows]) if chunks[i].get("section") == "abstract"]
+            if abstract:
+                summary_rows = summary_rows[abstract]
+        patent_vectors.append(summary_rows.sum(axis=0))
+    patent_vectors = _normalize_rows(np.asarray(patent_vectors).reshape(len(patents), vectors.shape[1]))
+    
+    save_embeddings(chunk_matrix, [get_chunk_id(chunks[i]) for i in rows], os.path.join(index_dir, "chunks.npy"), model_name)
+    save_embeddings(page_vectors, [f"{patent}|{page}" for patent, page in pages], os.path.join(index_dir, "pages.npy"), model_name)
+    save_embeddings(patent_vectors, patents, os.path.join(index_dir, "patents.npy"), model_name)
+    manifest = {"model": model_name, "dim": int(vectors.shape[1]), "patent_summary": patent_summary,
+                "patents": patents, "patent_offsets": patent_offsets, "pages": pages, "page_offsets": page_offsets,
+                "payloads": [chunk_payload(chunks[i], i) for i in rows]}
+    manifest_file = os.path.join(index_dir, "hierarchy.json")
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    print(f"✅ Hierarchy index: {len(patents)} patents, {len(pages)} pages, {len(rows)} text chunks in {index_dir}")
+    return manifest_file
+
+
+def load_hierarchy_index(index_dir="hierarchy_index"):
+    """
+    Memory-map a hierarchy index written by build_hierarchy_index.
+    
+    Returns:
+        dict: Index handle for hierarchical_search / hierarchical_retrieve_relevant_chunks
+    """
+    with open(os.path.join(index_dir, "hierarchy.json"), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    for level in ("chunks", "pages", "patents"):
+        index[f"{level}_matrix"], _ = load_embeddings(os.path.join(index_dir, f"{level}.npy"))
+    index["patent_offsets"] = np.asarray(index["patent_offsets"])
+    index["page_offsets"] = np.asarray(index["page_offsets"])
+    return index
+
+
+def _top_indices(scores, k):
+    """Indices of the k highest scores, best first."""
+    if k >= scores.size:
+        return np.argsort(-scores, kind="stable")
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+def _concat_ranges(starts, ends):
+    """All integers of the half-open ranges [starts[i], ends[i]) as one array."""
+    lengths = ends - starts
+    if lengths.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return np.arange(lengths.sum()) + offsets
+
+
+def hierarchical_search(index, query_embeddings, top_k=3, top_patents=8, top_pages=20):
+    """
+    Search chunks inside the best pages of the best patents.
+    
+    Args:
+        index (dict): Handle from load_hierarchy_index
+        query_embeddings (np.ndarray): Query embeddings, shape (num_queries, vector_size)
+        top_k (int): Chunks per query
+        top_patents (int): Candidate patents per query (None: skip the patent level)
+        top_pages (int): Candidate pages per query, among the pages of the candidate patents
+                         (None: every page of the candidate patents)
+        
+    Returns:
+        list: For every query, its top-k chunks in the format of retrieve_relevant_chunks
+    """
+    queries = _normalize_rows(np.asarray(query_embeddings).reshape(-1, index["dim"]))
+    patent_offsets, page_offsets = index["patent_offsets"], index["page_offsets"]
+    patent_scores = queries @ np.asarray(index["patents_matrix"]).T if top_patents else None
+    results = []
+    for q, query in enumerate(queries):
+        # Patent level: candidate pages are the pages of the best patents
+        if top_patents:
+            patents = _top_indices(patent_scores[q], top_patents)
+            candidate_pages = _concat_ranges(patent_offsets[patents], patent_offsets[patents + 1])
+        else:
+            candidate_pages = np.arange(len(index["pages"]))
+        # Page level
+        if top_pages and candidate_pages.size > top_pages:
+            page_scores = np.asarray(index["pages_matrix"][candidate_pages]) @ query
+            candidate_pages = candidate_pages[_top_indices(page_scores, top_pages)]
+        # Chunk level: exact scores of the chunks of the candidate pages
+        if candidate_pages.size == len(index["pages"]):
+            rows = np.arange(len(index["payloads"]))  # No level applied: a flat exact search
+            chunk_scores = np.asarray(index["chunks_matrix"]) @ query
+        else:
+            rows = np.sort(_concat_ranges(page_offsets[candidate_pages], page_offsets[candidate_pages + 1]))
+            chunk_scores = np.asarray(index["chunks_matrix"][rows]) @ query
+        query_results = []
+        for j in _top_indices(chunk_scores, top_k):
+            row = int(rows[j])
+            payload = index["payloads"][row]
+            query_results.append({
+                'content': payload['content'],
+                'page': payload['page'],
+                'chunk_index': payload['chunk_index'],
+                'section': payload.get('section'),
+                'claim_number': payload.get('claim_number'),
+                'patent': payload.get('patent'),
+                'similarity': float(chunk_scores[j]),
+                'embedding': np.asarray(index["chunks_matrix"][row], dtype=np.float32).tolist()
+            })
+        results.append(query_results)
+    return results
+
+
+def hierarchical_retrieve_relevant_chunks(question, index, model, top_k=3, question_embedding=None, top_patents=8, top_pages=20):
+    """retrieve_relevant_chunks over a hierarchy index (see hierarchical_search)."""
+    if question_embedding is None:
+        question_embedding = model.encode([question])
+    return hierarchical_search(index, question_embedding, top_k, top_patents=top_patents, top_pages=top_pages)[0]
+
+
+# %%
+# === LAZY SHEET DESCRIPTIONS ===
+def create_sheet_describer(cache_file="sheet_descriptions.json", prefetch=True, radius=1, hot_pages=3):
+    """
+    Create the state for describing drawing sheets on demand instead of at ingest
+    (extract_text_and_images_from_patent(describe_sheets=False)). A sheet is described by
+    LLaVA the first time it is selected for a prompt, and the description is cached on disk.
+    With prefetch, undescribed sheets within `radius` pages of the most frequently retrieved
+    pages are described in a background thread before a question needs them.
+    
+    Args:
+        cache_file (str): JSON file of descriptions keyed by chunk id
+        prefetch (bool): Describe likely-needed sheets in the background
+        radius (int): Page distance from a frequently retrieved page that counts as neighbouring
+        hot_pages (int): Number of most frequently retrieved pages that trigger prefetch
+        
+    Returns:
+        dict: The describer state
+    """
+    import threading
+    from collections import Counter
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'r', encoding='utf-8', errors='replace') as f:
+            cache = json.load(f)
+    return {
+        "cache": cache,
+        "cache_file": cache_file,
+        "executor": ThreadPoolExecutor(max_workers=1) if prefetch else None,
+        "futures": {},
+        "page_hits": Counter(),
+        "radius": radius,
+        "hot_pages": hot_pages,
+        "lock": threading.Lock(),
+        "generated": 0,
+        "prefetched": 0
+    }
+
+
+# %%
+def _generate_sheet_description(describer, chunk_id, image_chunk):
+    """Run LLaVA on one sheet and store the description in the describer cache."""
+    image_hash, store_dir = image_chunk.get('image_hash'), image_chunk.get('image_store', "extracted_images")
+    description = stored_sheet_description(image_hash, store_dir) if image_hash else None
+    if description is None:
+        described = sheet_descriptions(None, chunk_image_path(image_chunk), image_chunk['page'],
+                                       image_text=image_chunk.get('ocr_text', image_chunk['content']))
+        description = described['content'] if described else None
+        if description and image_hash:
+            save_sheet_description(image_hash, store_dir, description)
+    with describer["lock"]:
+        if description:
+            describer["cache"][chunk_id] = description
+            describer["generated"] += 1
+        describer["futures"].pop(chunk_id, None)
+    return description
+
+
+# %%
+def describe_sheet(describer, image_chunk):
+    """
+    Return the LLaVA description of a drawing sheet, generating it on first use.
+    The description is also set on the chunk as image_chunk['description'].
+    
+    Returns:
+        str: The description, or the sheet's stored text if LLaVA failed
+    """
+    if image_chunk.get('described', True) or image_chunk.get('description'):
+        return image_chunk.get('description') or image_chunk['content']
+    chunk_id = get_chunk_id(image_chunk)
+    with describer["lock"]:
+        description = describer["cache"].get(chunk_id)
+        future = describer["futures"].get(chunk_id)
+    if description is None:
+        if future is not None:
+            description = future.result()  # Already being prefetched: wait for it
+        else:
+            print(f"   📝 Describing sheet on page {image_chunk['page']} on demand")
+            description = _generate_sheet_description(describer, chunk_id, image_chunk)
+    if description:
+        image_chunk['description'] = description
+    return description or image_chunk['content']
+
+
+# %%
+def prefetch_sheet_descriptions(describer, chunks, retrieved_pages):
+    """
+    Count the retrieved pages and queue undescribed sheets that neighbour the most
+    frequently retrieved pages for background description.
+    
+    Args:
+        describer (dict): State from create_sheet_describer
+        chunks (list): All chunks of the patent
+        retrieved_pages (list): Pages of the text chunks and sheets used by the last question
+    """
+    describer["page_hits"].update(retrieved_pages)
+    if describer["executor"] is None:
+        return
+    hot = [page for page, _ in describer["page_hits"].most_common(describer["hot_pages"])]
+    radius = describer["radius"]
+    for chunk in chunks:
+        if (not chunk or chunk['type'] != 'image_description' or chunk.get('described', True)
+                or not any(abs(chunk['page'] - page) <= radius for page in hot)):
+            continue
+        chunk_id = get_chunk_id(chunk)
+        with describer["lock"]:
+            if chunk_id in describer["cache"] or chunk_id in describer["futures"]:
+                continue
+            describer["futures"][chunk_id] = describer["executor"].submit(_generate_sheet_description, describer, chunk_id, chunk)
+            describer["prefetched"] += 1
+
+
+# %%
+def close_sheet_describer(describer, wait=True):
+    """Stop background prefetching and save the cached descriptions."""
+    if describer["executor"] is not None:
+        describer["executor"].shutdown(wait=wait, cancel_futures=not wait)
+    if describer["cache_file"]:
+        with describer["lock"]:
+            cache = dict(describer["cache"])
+        with open(describer["cache_file"] + ".tmp", 'w', encoding='utf-8', errors='replace') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        os.replace(describer["cache_file"] + ".tmp", describer["cache_file"])
+    print(f"Sheet descriptions: {describer['generated']} generated ({describer['prefetched']} prefetched), "
+          f"{len(describer['cache'])} cached")
+
+
+# %%
+def construct_rag_prompt(question, question_index, relevant_chunks, selected_images_chunks, max_context_bytes=2000,
+                         layout="legacy", max_chars=300, patent_context=""):
     """
     Construct RAG prompt with question, context, and images.
     
@@ -678,11 +3192,18 @@ def construct_rag_prompt(question, question_index, relevant_chunks, selected_ima
         relevant_chunks (list): Retrieved text chunks
         selected_images (list): Paths to relevant images
         max_context_bytes (int): Maximum context length in bytes
+        layout (str): "legacy" (question first, instructions appended by call_ollama_*) or "prefix"
+                      (see construct_prefix_prompt)
+        max_chars (int): Answer length stated in the prefix-layout instructions
+        patent_context (str): Stable per-patent block of the prefix layout (see patent_context_block)
         
     Returns:
         str1: Formatted prompt for Llava
         str2: Formatted prompt for Llama
     """
+    if layout == "prefix":
+        return construct_prefix_prompt(question, question_index, relevant_chunks, selected_images_chunks,
+                                       max_context_bytes, max_chars, patent_context)
     # Sort relevant chunks by similarity (highest first)
     relevant_chunks.sort(key=lambda x: x['similarity'], reverse=True)
     # Add relevant chunks to the context, but not exceeding the max_context_bytes limit
@@ -691,10 +3212,11 @@ def construct_rag_prompt(question, question_index, relevant_chunks, selected_ima
     for chunk in relevant_chunks:
         chunk_text = chunk['content']
         chunk_bytes = len(chunk_text.encode('utf-8'))
+        label = f"Page {chunk['page']}, Claim {chunk['claim_number']}" if chunk.get('claim_number') else f"Page {chunk['page']}"
         
         # Check if adding this chunk would exceed limit
         if total_bytes + chunk_bytes <= max_context_bytes:
-            context_parts.append(f"[Page {chunk['page']}] {chunk_text}")
+            context_parts.append(f"[{label}] {chunk_text}")
             total_bytes += chunk_bytes
         else:
             # Add partial chunk to reach exactly max_context_bytes
@@ -702,7 +3224,7 @@ def construct_rag_prompt(question, question_index, relevant_chunks, selected_ima
             if remaining_bytes > 50:  # Only add if meaningful amount remaining
                 # encode for snniping the exact amount of bytes, then decode to utf-8 back.
                 partial_text = chunk_text.encode('utf-8')[:remaining_bytes].decode('utf-8', errors='ignore')
-                context_parts.append(f"[Page {chunk['page']}] {partial_text}")
+                context_parts.append(f"[{label}] {partial_text}")
             break
 
     question_bytes = len(question.encode('utf-8'))
@@ -710,31 +3232,285 @@ def construct_rag_prompt(question, question_index, relevant_chunks, selected_ima
         images_context = []
         image_list = ""
         for index, image_chunk in enumerate(selected_images_chunks):
-            image_list += f"\nImage {index+1}: {image_chunk['image_path']}"
-            images_context.append(f"\nImage {index+1}-{image_chunk['content']}")
+            image_list += f"\nImage {index+1}: {chunk_image_path(image_chunk)}"
+            images_context.append(f"\nImage {index+1}-{image_chunk.get('description') or image_chunk['content']}")
         images_list_bytes = len("".join(image_list).encode('utf-8'))
         images_context_bytes = len("".join(images_context).encode('utf-8'))
         
         # Join the context parts with newlines.
         text_context = "\n".join(context_parts)
 
-        # Construct final prompt for Llava
-        prompt_llava = f"""Question {question_index} [bytes: {question_bytes}]:\n{question}\nText-Context [bytes: {max_context_bytes - images_list_bytes - question_bytes}]:\n{text_context.encode('utf-8')[:max_context_bytes - images_list_bytes - question_bytes].decode('utf-8', errors='ignore')}\nImages-Paths[bytes: {images_list_bytes}]: {image_list}"""
+        # Construct final prompt for Llava
+        prompt_llava = f"""Question {question_index} [bytes: {question_bytes}]:\n{question}\nText-Context [bytes: {max_context_bytes - images_list_bytes - question_bytes}]:\n{text_context.encode('utf-8')[:max_context_bytes - images_list_bytes - question_bytes].decode('utf-8', errors='ignore')}\nImages-Paths[bytes: {images_list_bytes}]: {image_list}"""
+
+        # Build context from relevant chunks for Llama:
+        images_context = "".join(images_context)
+        context_bytes_with_images = max_context_bytes - images_context_bytes - question_bytes
+        prompt_llama = f"""Question {question_index} [bytes: {question_bytes}]:\n{question}\nText-Context [bytes: {context_bytes_with_images}]:\n{text_context.encode('utf-8')[:context_bytes_with_images].decode('utf-8', errors='ignore')}\nImages-Context [bytes: {images_context_bytes}]:\n{images_context}"""
+    else:
+        prompt_llava = prompt_llama = f"""Question {question_index} [bytes: {question_bytes}]:\n{question}\nText-Context [bytes: {total_bytes}]:\n{context_parts[:max_context_bytes]}"""    
+    
+    return prompt_llava, prompt_llama
+
+
+
+# %%
+PREFIX_PROMPT_INSTRUCTIONS = (
+    "You answer questions about a patent. Use ONLY the provided context; do not use external knowledge. "
+    "Give a concise answer under {max_chars} characters."
+)
+
+
+def patent_context_block(chunks, max_bytes=1000):
+    """
+    Stable per-patent context of the prefix layout: the abstract of a structure-chunked patent,
+    else its first claim, else its first text chunk - cut to max_bytes.
+    """
+    text_chunks = [chunk for chunk in chunks if chunk and chunk['type'] == 'text']
+    block = [chunk for chunk in text_chunks if chunk.get('section') == 'abstract']
+    if not block:
+        block = [chunk for chunk in text_chunks if chunk.get('section') == 'claims' and chunk.get('claim_number') == 1]
+    if not block:
+        block = text_chunks[:1]
+    text = "\n".join(chunk['content'] for chunk in block)
+    return text.encode('utf-8')[:max_bytes].decode('utf-8', errors='ignore')
+
+
+def construct_prefix_prompt(question, question_index, relevant_chunks, selected_images_chunks, max_context_bytes=2000, max_chars=300,
+                            patent_context=""):
+    """
+    KV-cache friendly prompt layout: the parts shared between questions come first so the
+    model server can reuse the prompt prefix it already processed for the same patent.
+    1. Stable instructions, the patent id and patent_context (identical for every question of the patent)
+    2. Context chunks in document order (page, chunk) rather than by similarity, so questions
+       retrieving overlapping chunks produce the same leading context
+    3. Images, then the question itself last
+    
+    Returns:
+        str1: Formatted prompt for Llava
+        str2: Formatted prompt for Llama
+    """
+    patent = next((chunk.get('patent') for chunk in relevant_chunks if chunk.get('patent')), "")
+    prefix = PREFIX_PROMPT_INSTRUCTIONS.format(max_chars=max_chars) + f"\nPatent: {patent}\n"
+    if patent_context:
+        prefix += f"Patent-Context:\n{patent_context}\n"
+        # Retrieved chunks already in the shared block are not repeated
+        relevant_chunks = [chunk for chunk in relevant_chunks if chunk['content'] not in patent_context]
+
+    question_part = f"Question {question_index}:\n{question}\nAnswer:"
+    images = selected_images_chunks or []
+    image_list = "".join(f"\nImage {index+1}: {chunk_image_path(img)}" for index, img in enumerate(images))
+    images_context = "".join(f"\nImage {index+1}-{img.get('description') or img['content']}" for index, img in enumerate(images))
+
+    # Choose chunks by similarity within the byte budget, then lay them out in document order
+    budget = max_context_bytes - len(question.encode('utf-8')) - len(images_context.encode('utf-8'))
+    chosen, total_bytes = [], 0
+    for chunk in sorted(relevant_chunks, key=lambda x: x['similarity'], reverse=True):
+        chunk_bytes = len(chunk['content'].encode('utf-8'))
+        if total_bytes + chunk_bytes > budget:
+            break
+        chosen.append(chunk)
+        total_bytes += chunk_bytes
+    chosen.sort(key=lambda chunk: (chunk['page'], chunk.get('chunk_index', 0)))
+    text_context = "\n".join(
+        f"[Page {chunk['page']}, Claim {chunk['claim_number']}] {chunk['content']}" if chunk.get('claim_number')
+        else f"[Page {chunk['page']}] {chunk['content']}"
+        for chunk in chosen)
+
+    prompt_llava = f"{prefix}Text-Context:\n{text_context}\n"
+    prompt_llama = prompt_llava
+    if images:
+        prompt_llava += f"Images-Paths:{image_list}\n"
+        prompt_llama += f"Images-Context:{images_context}\n"
+    return prompt_llava + question_part, prompt_llama + question_part
+
+
+# %%
+# === SEMANTIC QUERY CACHE ===
+def create_semantic_cache(threshold=0.95, capacity=512, cache_answers=False):
+    """
+    Create an in-memory semantic cache for retrieval results (and optionally answers).
+    A new question reuses a cached entry of the same patent when the cosine similarity
+    of their embeddings is >= threshold, so paraphrases skip retrieval and image scoring.
+    
+    Args:
+        threshold (float): Minimum cosine similarity to count as the same question
+        capacity (int): Maximum entries per patent; the least recently used entry is evicted
+        cache_answers (bool): Also reuse the generated answers of matching questions
+        
+    Returns:
+        dict: The cache state
+    """
+    return {
+        "threshold": threshold,
+        "capacity": capacity,
+        "cache_answers": cache_answers,
+        "patents": {},
+        "hits": 0,
+        "misses": 0
+    }
+
+
+# %%
+def chunks_fingerprint(chunks):
+    """Hash of a patent's chunk ids; changes whenever any chunk is added, removed or edited."""
+    import hashlib
+    digest = hashlib.sha1()
+    for chunk_id in sorted(get_chunk_id(chunk) for chunk in chunks if chunk):
+        digest.update(chunk_id.encode("utf-8"))
+    return digest.hexdigest()
+
+
+# %%
+def _semantic_cache_patent(cache, patent_key, fingerprint, dim):
+    """Return the cache slot table of a patent, dropping it if the patent's chunks changed."""
+    from collections import OrderedDict
+    patent = cache["patents"].get(patent_key)
+    if patent is None or patent["fingerprint"] != fingerprint or patent["vectors"].shape[1] != dim:
+        if patent is not None:
+            print(f"   ♻️  Chunks of {patent_key} changed - semantic cache invalidated")
+        patent = {
+            "fingerprint": fingerprint,
+            # One row per slot: a small matrix searched with a single dot product
+            "vectors": np.zeros((cache["capacity"], dim), dtype=np.float32),
+            "entries": OrderedDict()  # slot -> entry, least recently used first
+        }
+        cache["patents"][patent_key] = patent
+    return patent
+
+
+# %%
+def semantic_cache_lookup(cache, patent_key, fingerprint, question_embedding):
+    """
+    Find the cached entry whose question is most similar to the new one.
+    
+    Args:
+        cache (dict): Cache created by create_semantic_cache
+        patent_key (str): Patent the question is asked about
+        fingerprint (str): chunks_fingerprint of the patent's current chunks
+        question_embedding (np.ndarray): Embedding of the new question
+        
+    Returns:
+        dict: The matching entry ({'question', 'relevant_chunks', 'selected_images_chunks', 'answers'}) or None
+    """
+    query = np.asarray(question_embedding, dtype=np.float32).ravel()
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    patent = _semantic_cache_patent(cache, patent_key, fingerprint, query.shape[0])
+    if not patent["entries"]:
+        cache["misses"] += 1
+        return None
+    slots = np.fromiter(patent["entries"].keys(), dtype=np.int64)
+    scores = patent["vectors"][slots] @ query
+    best = int(np.argmax(scores))
+    if scores[best] < cache["threshold"]:
+        cache["misses"] += 1
+        return None
+    slot = int(slots[best])
+    patent["entries"].move_to_end(slot)
+    cache["hits"] += 1
+    entry = patent["entries"][slot]
+    print(f"   ⚡ Semantic cache hit ({scores[best]:.3f}): '{entry['question'][:50]}...'")
+    return entry
+
+
+# %%
+def semantic_cache_store(cache, patent_key, fingerprint, question_embedding, question, relevant_chunks, selected_images_chunks):
+    """
+    Add a question and its retrieval results to the cache, evicting the least recently used entry if full.
+    
+    Returns:
+        dict: The new cache entry (its 'answers' and the 'answers_key' they were generated with are
+              filled in by generate_answers when answers are cached)
+    """
+    query = np.asarray(question_embedding, dtype=np.float32).ravel()
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    patent = _semantic_cache_patent(cache, patent_key, fingerprint, query.shape[0])
+    if len(patent["entries"]) >= cache["capacity"]:
+        slot, _ = patent["entries"].popitem(last=False)
+    else:
+        used = set(patent["entries"].keys())
+        slot = next(i for i in range(cache["capacity"]) if i not in used)
+    patent["vectors"][slot] = query
+    entry = {
+        "question": question,
+        "relevant_chunks": [dict(chunk) for chunk in relevant_chunks],
+        "selected_images_chunks": [dict(img) for img in selected_images_chunks] if selected_images_chunks else None,
+        "answers": None
+    }
+    patent["entries"][slot] = entry
+    return entry
+
+
+# %%
+def save_semantic_cache(cache, cache_file="semantic_cache.json"):
+    """Persist the semantic cache (entries in LRU order) to a JSON file."""
+    data = {key: cache[key] for key in ("threshold", "capacity", "cache_answers")}
+    data["patents"] = {
+        patent_key: {
+            "fingerprint": patent["fingerprint"],
+            "entries": [dict(entry, embedding=patent["vectors"][slot]) for slot, entry in patent["entries"].items()]
+        }
+        for patent_key, patent in cache["patents"].items()
+    }
+    # Written to a temporary file first, so an interrupted save keeps the previous cache
+    with open(cache_file + f".{os.getpid()}.tmp", 'w', encoding='utf-8', errors='replace') as f:
+        json.dump(data, f, default=lambda value: value.tolist())
+    os.replace(cache_file + f".{os.getpid()}.tmp", cache_file)
+    print(f"Semantic cache saved to {cache_file}")
+
+
+# %%
+def load_semantic_cache(cache_file="semantic_cache.json", threshold=0.95, capacity=512, cache_answers=False):
+    """
+    Load a semantic cache saved by save_semantic_cache, or create an empty one.
+    Entries of patents whose chunks changed since are dropped on their first lookup.
+    """
+    cache = create_semantic_cache(threshold, capacity, cache_answers)
+    if not os.path.exists(cache_file):
+        return cache
+    with open(cache_file, 'r', encoding='utf-8', errors='replace') as f:
+        data = json.load(f)
+    for patent_key, patent in data["patents"].items():
+        for entry in patent["entries"][-capacity:]:
+            stored = semantic_cache_store(cache, patent_key, patent["fingerprint"], entry["embedding"], entry["question"],
+                                          entry["relevant_chunks"], entry["selected_images_chunks"])
+            stored["answers"] = entry.get("answers")
+            stored["answers_key"] = entry.get("answers_key")
+    print(f"Loaded semantic cache from {cache_file}")
+    return cache
 
-        # Build context from relevant chunks for Llama:
-        images_context = "".join(images_context)
-        context_bytes_with_images = max_context_bytes - images_context_bytes - question_bytes
-        prompt_llama = f"""Question {question_index} [bytes: {question_bytes}]:\n{question}\nText-Context [bytes: {context_bytes_with_images}]:\n{text_context.encode('utf-8')[:context_bytes_with_images].decode('utf-8', errors='ignore')}\nImages-Context [bytes: {images_context_bytes}]:\n{images_context}"""
-    else:
-        prompt_llava = prompt_llama = f"""Question {question_index} [bytes: {question_bytes}]:\n{question}\nText-Context [bytes: {total_bytes}]:\n{context_parts[:max_context_bytes]}"""    
-    
-    return prompt_llava, prompt_llama
 
+def save_cached_answers(rag_prompts, patent_key, cache_file="semantic_cache.json", threshold=0.95):
+    """
+    Write the answers generate_answers attached to the prompts' cache entries into a saved semantic
+    cache. The prompts may hold copies of the entries (e.g. loaded from the stage cache), so entries
+    are matched by patent and question.
+    
+    Returns:
+        int: Number of entries whose answers were saved
+    """
+    if not os.path.exists(cache_file):
+        return 0
+    cache = load_semantic_cache(cache_file, threshold=threshold, cache_answers=True)
+    patent = cache["patents"].get(patent_key)
+    entries = {entry["question"]: entry for entry in patent["entries"].values()} if patent else {}
+    saved = 0
+    for prompt_data in rag_prompts:
+        answered = prompt_data.get('cache_entry')
+        entry = entries.get(answered["question"]) if answered and answered.get("answers") else None
+        if entry is not None and entry.get("answers_key") != answered.get("answers_key"):
+            entry["answers"], entry["answers_key"] = answered["answers"], answered.get("answers_key")
+            saved += 1
+    if saved:
+        save_semantic_cache(cache, cache_file)
+    return saved
 
 
 # %%
 # Using the models based on the question prompt.
-def process_questions_with_rag(questions, chunks, client, model):
+def process_questions_with_rag(questions, chunks, client, model, embedding_store=None, semantic_cache=None, patent_key=None,
+                               image_model=None, sheet_describer=None, prompt_layout="legacy", start_index=1,
+                               mmr_lambda=None, mmr_candidates=20):
     """
     Process all questions using RAG pipeline. (retrieve relevant chunks, top similar images, construct rag prompt)
     
@@ -743,6 +3519,17 @@ def process_questions_with_rag(questions, chunks, client, model):
         chunks (list): All chunks (text and image)
         client: Qdrant client 
         model: SentenceTransformer model
+        embedding_store (tuple): Optional memory-mapped (matrix, index) from load_embeddings
+        semantic_cache (dict): Optional cache from create_semantic_cache / load_semantic_cache
+        patent_key (str): Patent the questions are about (defaults to the chunks' patent)
+        image_model: Optional CLIP-style model used to score drawings directly against the question
+                     (the collection must have been built with create_vector_store(image_model_name=...))
+        sheet_describer (dict): Optional state from create_sheet_describer; selected sheets that were
+                                ingested without a description are described on demand
+        prompt_layout (str): "legacy" or "prefix" (stable shared prefix + per-patent session, see construct_prefix_prompt)
+        start_index (int): Number of the first question (later batches of a question stream continue the count)
+        mmr_lambda (float): Diversify the retrieved chunks with MMR (see retrieve_relevant_chunks); None = plain top-k
+        mmr_candidates (int): Candidate pool size of the MMR selection
         
     Returns:
         list: List of constructed prompts of the form:
@@ -751,6 +3538,7 @@ def process_questions_with_rag(questions, chunks, client, model):
                                     'llava_prompt': str,
                                     'llama_prompt': str,
                                     'relevant_pages': list,
+                                    'relevant_chunks': list,
                                     'selected_images_chunks': list
                                 }
     """
@@ -758,45 +3546,436 @@ def process_questions_with_rag(questions, chunks, client, model):
     print(f"Processing {len(questions)} questions...")
     
     # Clear prompt files at the start of each run
-    with open("prompt_llama.txt", "w", encoding='utf-8', errors='replace') as f:
-        f.write("")  # Clear the file
-    with open("prompt_llava.txt", "w", encoding='utf-8', errors='replace') as f:
-        f.write("")  # Clear the file
+    if start_index == 1:
+        with open("prompt_llama.txt", "w", encoding='utf-8', errors='replace') as f:
+            f.write("")  # Clear the file
+        with open("prompt_llava.txt", "w", encoding='utf-8', errors='replace') as f:
+            f.write("")  # Clear the file
     
     prompts = []
+    if patent_key is None:
+        patent_key = next((chunk.get('patent') for chunk in chunks if chunk and chunk.get('patent')), "default")
+    patent_context = patent_context_block(chunks) if prompt_layout == "prefix" else ""
+    if semantic_cache is not None:
+        fingerprint = chunks_fingerprint(chunks)
     
-    for i, question in enumerate(questions, 1):
-        print(f"\n🔍 Processing Question {i}/{len(questions)}: '{question[:50]}...'")
-        
-        # 1. Retrieve top-k relevant text chunks
-        relevant_chunks = retrieve_relevant_chunks(question, client, model, top_k=3)
-        print(f"   Retrieved {len(relevant_chunks)} relevant chunks")
+    for i, question in enumerate(questions, start_index):
+        print(f"\n🔍 Processing Question {i}/{start_index + len(questions) - 1}: '{question[:50]}...'")
         
-        # Show text similarity scores
-        for j, chunk in enumerate(relevant_chunks):
-            print(f"     Chunk {j+1}: Page {chunk['page']}, Similarity = {chunk['similarity']:.3f}")
+        # 0. Reuse the retrieval of a near-duplicate question, if cached
+        cache_entry = None
+        question_embedding = None
+        if semantic_cache is not None:
+            question_embedding = model.encode([question])[0]
+            cache_entry = semantic_cache_lookup(semantic_cache, patent_key, fingerprint, question_embedding)
         
-        # 2. Find nearby images using similarity scoring with relevant text
+        if cache_entry is not None:
+            relevant_chunks = [dict(chunk) for chunk in cache_entry['relevant_chunks']]
+            selected_images_chunks = cache_entry['selected_images_chunks']
+        else:
+            # 1. Retrieve top-k relevant text chunks
+            relevant_chunks = retrieve_relevant_chunks(question, client, model, top_k=3, question_embedding=question_embedding,
+                                                       mmr_lambda=mmr_lambda, mmr_candidates=mmr_candidates)
+            print(f"   Retrieved {len(relevant_chunks)} relevant chunks")
+            
+            # Show text similarity scores
+            for j, chunk in enumerate(relevant_chunks):
+                print(f"     Chunk {j+1}: Page {chunk['page']}, Similarity = {chunk['similarity']:.3f}")
+            
+            # 2. Find nearby images using similarity scoring with relevant text
+            question_image_embedding = image_model.encode([question])[0] if image_model is not None else None
+            selected_images_chunks = top_similar_images(relevant_chunks,chunks, max_images=2, client=client, embedding_store=embedding_store,
+                                                        question_image_embedding=question_image_embedding)
+            if semantic_cache is not None:
+                cache_entry = semantic_cache_store(semantic_cache, patent_key, fingerprint, question_embedding,
+                                                   question, relevant_chunks, selected_images_chunks)
         relevant_pages = [chunk['page'] for chunk in relevant_chunks]
-        selected_images_chunks = top_similar_images(relevant_chunks,chunks, max_images=2, client=client)
+        
+        # Lazily describe the selected sheets, and prefetch the ones likely to be needed next
+        if sheet_describer is not None:
+            for image_chunk in selected_images_chunks or []:
+                describe_sheet(sheet_describer, image_chunk)
+            prefetch_sheet_descriptions(sheet_describer, chunks,
+                                        relevant_pages + [img['page'] for img in selected_images_chunks or []])
         
         # 3. Construct prompt
-        llava_prompt, llama_prompt = construct_rag_prompt(question, i, relevant_chunks, selected_images_chunks)
-        prompts.append({
+        llava_prompt, llama_prompt = construct_rag_prompt(question, i, relevant_chunks, selected_images_chunks, layout=prompt_layout,
+                                                          patent_context=patent_context)
+        prompt_data = {
             'question': question,
             'llava_prompt': llava_prompt,
             'llama_prompt': llama_prompt,
             'relevant_pages': relevant_pages,
-            'selected_images_chunks': selected_images_chunks
-        })
+            'relevant_chunks': relevant_chunks,
+            'selected_images_chunks': selected_images_chunks,
+            'layout': prompt_layout,
+            'session': patent_key
+        }
+        if semantic_cache is not None and semantic_cache['cache_answers']:
+            prompt_data['cache_entry'] = cache_entry
+        prompts.append(prompt_data)
         
     print(f"\n✅ Constructed {len(prompts)} RAG prompts")
+    if semantic_cache is not None:
+        print(f"   Semantic cache: {semantic_cache['hits']} hits, {semantic_cache['misses']} misses")
     return prompts
 
 
+# %%
+# === LLM BACKENDS ===
+# Selected by configuration: "cli" runs `ollama run` per call, "http" talks to the ollama server
+# over pooled keep-alive connections, "stub" answers in-process (offline tests and benchmarks).
+LLM_BACKEND_CONFIG = {
+    "backend": os.environ.get("PATENT_RAG_LLM_BACKEND", "cli"),
+    "host": os.environ.get("OLLAMA_HOST", "http://localhost:11434"),
+    "pool_size": 4,
+    "keep_alive": "10m",
+    "stub_latency": 0.0,          # seconds before the first token
+    "stub_tokens_per_sec": 0.0,   # 0 = the whole answer at once
+    "stub_prefill_chars_per_sec": 0.0,  # prompt processing rate; 0 = free (prefix caching has no effect)
+    "stub_failure_rate": 0.0,     # share of calls failing like an overloaded server (scheduler retry tests)
+    "stub_models": ["llama3:latest", "llava:7b"]
+}
+_LLM_SESSION = None
+_STUB_PREFIX_CACHE = {}
+# Timing of the most recent calls: {"model", "session", "seconds", "ttft", "cached_chars"}
+LLM_CALL_LOG = deque(maxlen=1000)
+
+
+def configure_llm_backend(backend=None, **options):
+    """
+    Select the LLM backend and/or change its options (keys of LLM_BACKEND_CONFIG).
+    
+    Args:
+        backend (str): "cli", "http" or "stub"
+        **options: e.g. host="http://gpu-box:11434", stub_latency=0.5, stub_tokens_per_sec=30
+    """
+    global _LLM_SESSION
+    if backend is not None:
+        if backend not in LLM_BACKENDS:
+            raise ValueError(f"Unknown LLM backend '{backend}', expected one of {list(LLM_BACKENDS)}")
+        LLM_BACKEND_CONFIG["backend"] = backend
+    for key, value in options.items():
+        if key not in LLM_BACKEND_CONFIG:
+            raise ValueError(f"Unknown LLM backend option '{key}'")
+        LLM_BACKEND_CONFIG[key] = value
+    _LLM_SESSION = None  # Reconnect with the new settings
+    _STUB_PREFIX_CACHE.clear()
+
+
+# %%
+def _cli_generate(model, prompt, timeout, images=None, session=None):
+    """
+    One `ollama run` process per call; image paths are read from the prompt by the CLI.
+    session has no effect: the ollama server reuses a cached prompt prefix on its own.
+    """
+    process = subprocess.Popen(
+        ["ollama", "run", model],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        errors="replace"
+    )
+    try:
+        stdout, stderr = process.communicate(input=prompt, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise TimeoutError(f"{model} did not answer within {timeout}s")
+    if process.returncode != 0:
+        raise RuntimeError(stderr.strip() or f"ollama exited with code {process.returncode}")
+    return stdout, {}
+
+
+def _cli_list_models():
+    result = subprocess.run(["ollama", "list"], capture_output=True, text=True, timeout=10)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or "ollama list failed")
+    return [line.split()[0] for line in result.stdout.splitlines()[1:] if line.strip()]
+
+
+# %%
+def _http_session():
+    """Shared requests session: connections to the ollama server are kept alive and pooled."""
+    global _LLM_SESSION
+    if _LLM_SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _LLM_SESSION = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LLM_BACKEND_CONFIG["pool_size"])
+        _LLM_SESSION.mount("http://", adapter)
+        _LLM_SESSION.mount("https://", adapter)
+    return _LLM_SESSION
+
+
+def _http_generate(model, prompt, timeout, images=None, session=None):
+    # ollama reuses the KV cache of a shared prompt prefix while the model stays loaded
+    # (keep_alive), whatever the session; previous-turn "context" tokens are not sent, they
+    # would replay old answers
+    import base64
+    import requests
+    payload = {"model": model, "prompt": prompt, "stream": False, "keep_alive": LLM_BACKEND_CONFIG["keep_alive"]}
+    if images:
+        payload["images"] = []
+        for image_path in images:
+            with open(image_path, 'rb') as f:
+                payload["images"].append(base64.b64encode(f.read()).decode("ascii"))
+    try:
+        response = _http_session().post(f"{LLM_BACKEND_CONFIG['host']}/api/generate", json=payload, timeout=timeout)
+    except requests.Timeout:
+        raise TimeoutError(f"{model} did not answer within {timeout}s")
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+    result = response.json()
+    # Server-side time to the first token: prompt evaluation (nanoseconds), which shrinks when the
+    # prompt prefix is cached; a model (re)load is not part of it
+    return result["response"], {"ttft": result.get("prompt_eval_duration", 0) / 1e9}
+
+
+def _http_list_models():
+    response = _http_session().get(f"{LLM_BACKEND_CONFIG['host']}/api/tags", timeout=10)
+    response.raise_for_status()
+    return [model["name"] for model in response.json()["models"]]
+
+
+# %%
+def _stub_generate(model, prompt, timeout, images=None, session=None):
+    """
+    Deterministic in-process answer after the configured latency and token rate.
+    Prompt processing is simulated at stub_prefill_chars_per_sec; within a session the
+    prefix shared with the session's previous prompt counts as cached (no prefill cost).
+    """
+    import hashlib
+    digest = hashlib.sha1(prompt.encode("utf-8", errors="replace")).hexdigest()
+    answer = f"Stub answer from {model} ({digest[:12]}): the context describes the claimed system."
+    if LLM_BACKEND_CONFIG["stub_failure_rate"] and random.random() < LLM_BACKEND_CONFIG["stub_failure_rate"]:
+        time.sleep(LLM_BACKEND_CONFIG["stub_latency"])
+        raise RuntimeError(f"{model} is overloaded (stub)")
+    cached_chars = 0
+    if session is not None:
+        cached_chars = len(os.path.commonprefix([_STUB_PREFIX_CACHE.get((model, session), ""), prompt]))
+        _STUB_PREFIX_CACHE[(model, session)] = prompt
+    ttft = LLM_BACKEND_CONFIG["stub_latency"]
+    if LLM_BACKEND_CONFIG["stub_prefill_chars_per_sec"]:
+        ttft += (len(prompt) - cached_chars) / LLM_BACKEND_CONFIG["stub_prefill_chars_per_sec"]
+    delay = ttft
+    if LLM_BACKEND_CONFIG["stub_tokens_per_sec"]:
+        delay += len(answer.split()) / LLM_BACKEND_CONFIG["stub_tokens_per_sec"]
+    if timeout and delay > timeout:
+        time.sleep(timeout)
+        raise TimeoutError(f"{model} did not answer within {timeout}s")
+    time.sleep(delay)
+    return answer, {"ttft": ttft, "cached_chars": cached_chars}
+
+
+def _stub_list_models():
+    return list(LLM_BACKEND_CONFIG["stub_models"])
+
+
+LLM_BACKENDS = {
+    "cli": {"generate": _cli_generate, "list_models": _cli_list_models},
+    "http": {"generate": _http_generate, "list_models": _http_list_models},
+    "stub": {"generate": _stub_generate, "list_models": _stub_list_models},
+}
+
+
+# %%
+def llm_generate(model, prompt, timeout=60, images=None, session=None):
+    """
+    Generate a completion with the configured backend. Every call is timed in LLM_CALL_LOG.
+    
+    Args:
+        model (str): Model name, e.g. "llama3:latest"
+        prompt (str): Full prompt
+        timeout (float): Seconds to wait for the answer
+        images (list): Optional image paths (sent as images by the http backend)
+        session (str): Optional session handle (e.g. the patent), logged with the call. Only the stub
+                       backend uses it (its simulated prefix cache is per session); ollama (cli / http)
+                       reuses the KV cache of any matching prompt prefix, so it has no effect there
+        
+    Returns:
+        str: The raw model output
+        
+    Raises:
+        TimeoutError: If the model did not answer in time
+        RuntimeError: If the backend reported an error
+    """
+    start = time.perf_counter()
+    text, info = LLM_BACKENDS[LLM_BACKEND_CONFIG["backend"]]["generate"](model, prompt, timeout, images, session)
+    LLM_CALL_LOG.append({"model": model, "session": session, "seconds": time.perf_counter() - start,
+                         "ttft": info.get("ttft"), "cached_chars": info.get("cached_chars", 0)})
+    return text
+
+
+def llm_list_models():
+    """Return the model names available on the configured backend."""
+    return LLM_BACKENDS[LLM_BACKEND_CONFIG["backend"]]["list_models"]()
+
+
+# %%
+# === MODEL CALL SCHEDULER ===
+# Every model call of the pipeline goes through scheduled_generate: calls wait in a per-model
+# priority queue (interactive before batch before ingest-time sheet descriptions) until one of the
+# model's concurrency slots is free, are rejected when too many calls are already waiting
+# (backpressure), are retried with jittered exponential backoff on timeouts and server errors, and
+# are cancelled once their deadline passes - while queued or before a retry. With "slot_dir" the
+# slots are lock files shared by all pipelines on the host.
+MODEL_SCHEDULER_CONFIG = {
+    "concurrency": {"default": 1},   # concurrent calls per model name ("default" for the others)
+    "max_queue": 32,                  # waiting batch/ingest calls per model before new ones are rejected
+    "retries": 2,
+    "backoff": 1.0,                   # seconds before the first retry, doubled per retry, +-50% jitter
+    "backoff_max": 15.0,
+    "slot_dir": os.environ.get("PATENT_RAG_MODEL_SLOTS"),  # shared lock-file slots (None: this process only)
+}
+CALL_PRIORITIES = {"interactive": 0, "batch": 1, "ingest": 2}
+# {"model", "priority", "queued", "attempts", "status"} of the most recent scheduled calls
+SCHEDULER_LOG = deque(maxlen=1000)
+_SCHEDULER = {"lock": threading.Condition(), "queues": {}, "running": {}, "sequence": 0}
+
+
+class ModelBusyError(RuntimeError):
+    """Raised when a model's queue is full (backpressure): the caller should slow down or shed the call."""
+
+
+def configure_model_scheduler(**options):
+    """
+    Change scheduler options (keys of MODEL_SCHEDULER_CONFIG).
+    
+    Args:
+        **options: e.g. concurrency={"default": 2, "llava:7b": 1}, max_queue=8, retries=3
+    """
+    for key, value in options.items():
+        if key not in MODEL_SCHEDULER_CONFIG:
+            raise ValueError(f"Unknown scheduler option '{key}'")
+        MODEL_SCHEDULER_CONFIG[key] = value
+    with _SCHEDULER["lock"]:
+        _SCHEDULER["lock"].notify_all()
+
+
+def _model_concurrency(model):
+    limits = MODEL_SCHEDULER_CONFIG["concurrency"]
+    return max(1, int(limits.get(model, limits.get("default", 1))))
+
+
+def _acquire_host_slot(model, deadline):
+    """Lock one of the model's slot files shared by all processes on the host; None if no slot_dir."""
+    slot_dir = MODEL_SCHEDULER_CONFIG["slot_dir"]
+    if not slot_dir:
+        return None
+    try:
+        import fcntl
+    except ImportError:  # No fcntl (Windows): process-local limits only
+        return None
+    os.makedirs(slot_dir, exist_ok=True)
+    name = re.sub(r"[^\w.-]", "_", model)
+    while True:
+        for slot in range(_model_concurrency(model)):
+            handle = open(os.path.join(slot_dir, f"{name}.{slot}.lock"), 'a')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return handle
+            except OSError:
+                handle.close()
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"deadline passed waiting for a {model} slot")
+        time.sleep(0.05)
+
+
+def _admit(model, priority, deadline, first_attempt):
+    """Wait for a free slot of the model in priority order. Returns the host slot handle."""
+    lock = _SCHEDULER["lock"]
+    with lock:
+        queue = _SCHEDULER["queues"].setdefault(model, [])
+        if first_attempt and priority > 0 and len(queue) >= MODEL_SCHEDULER_CONFIG["max_queue"]:
+            raise ModelBusyError(f"{model} has {len(queue)} calls waiting")
+        _SCHEDULER["sequence"] += 1
+        ticket = (priority, _SCHEDULER["sequence"])
+        heapq.heappush(queue, ticket)
+        try:
+            while queue[0] != ticket or _SCHEDULER["running"].get(model, 0) >= _model_concurrency(model):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"deadline passed while queued for {model}")
+                lock.wait(remaining)
+        finally:
+            queue.remove(ticket)
+            heapq.heapify(queue)
+            lock.notify_all()
+        _SCHEDULER["running"][model] = _SCHEDULER["running"].get(model, 0) + 1
+    try:
+        return _acquire_host_slot(model, deadline)
+    except BaseException:
+        _release(model, None)
+        raise
+
+
+def _release(model, host_slot):
+    if host_slot is not None:
+        host_slot.close()  # Closing the file releases its lock
+    with _SCHEDULER["lock"]:
+        _SCHEDULER["running"][model] -= 1
+        _SCHEDULER["lock"].notify_all()
+
+
+def scheduled_generate(model, prompt, timeout=60, images=None, session=None, priority="batch", deadline=None):
+    """
+    llm_generate through the model call scheduler.
+    
+    Args:
+        model, prompt, images, session: See llm_generate
+        timeout (float): Seconds the whole call may take, queueing and retries included
+        priority (str): "interactive", "batch" or "ingest" (see CALL_PRIORITIES)
+        deadline (float): Optional absolute time.monotonic() deadline (overrides timeout)
+        
+    Returns:
+        str: The raw model output
+        
+    Raises:
+        ModelBusyError: If the model's queue is full (interactive calls are always queued)
+        TimeoutError: If the deadline passed (while queued, running or before a retry)
+        RuntimeError: If the last retry failed
+    """
+    rank = CALL_PRIORITIES[priority]
+    if deadline is None:
+        deadline = time.monotonic() + timeout
+    start = time.monotonic()
+    queued = 0.0
+    attempt = 0
+    while True:
+        attempt += 1
+        waiting_since = time.monotonic()
+        try:
+            host_slot = _admit(model, rank, deadline, first_attempt=attempt == 1)
+        except (ModelBusyError, TimeoutError) as e:
+            SCHEDULER_LOG.append({"model": model, "priority": priority, "queued": time.monotonic() - start,
+                                  "attempts": attempt, "status": "rejected" if isinstance(e, ModelBusyError) else "expired"})
+            raise
+        queued += time.monotonic() - waiting_since
+        try:
+            text = llm_generate(model, prompt, timeout=max(0.001, deadline - time.monotonic()), images=images, session=session)
+        except (TimeoutError, RuntimeError) as e:
+            error = e
+        else:
+            SCHEDULER_LOG.append({"model": model, "priority": priority, "queued": queued, "attempts": attempt, "status": "ok"})
+            return text
+        finally:
+            _release(model, host_slot)
+        # Retry with jittered exponential backoff, unless the retry could not finish before the deadline
+        backoff = min(MODEL_SCHEDULER_CONFIG["backoff"] * 2 ** (attempt - 1), MODEL_SCHEDULER_CONFIG["backoff_max"])
+        backoff *= random.uniform(0.5, 1.5)
+        if attempt > MODEL_SCHEDULER_CONFIG["retries"] or time.monotonic() + backoff >= deadline:
+            SCHEDULER_LOG.append({"model": model, "priority": priority, "queued": queued, "attempts": attempt, "status": "failed"})
+            raise error
+        print(f"⚠️  {model} call failed ({error}), retry {attempt} in {backoff:.1f}s")
+        time.sleep(backoff)
+
+
 # %%
 # === STEP 5: ANSWER GENERATION ===
-def call_ollama_llama(prompt, model="llama3:latest", max_chars=300):
+def call_ollama_llama(prompt, model="llama3:latest", max_chars=300, append_instructions=True, session=None, priority="batch"):
     """
     Call LLaMA via ollama for text-only questions.
     
@@ -804,37 +3983,23 @@ def call_ollama_llama(prompt, model="llama3:latest", max_chars=300):
         prompt (str): The input prompt
         model (str): LLaMA model to use
         max_chars (int): Maximum characters for the answer
+        append_instructions (bool): Append the answering instructions (prefix-layout prompts already start with them)
+        session (str): Optional session handle passed to the backend (see llm_generate)
+        priority (str): Scheduler priority class (see scheduled_generate)
         
     Returns:
         str: Generated answer
     """
     try:
-        # Prepare the command to call ollama
-        cmd = ["ollama", "run", model]
-        
         # Add instruction to limit response length
         full_prompt = f"""{prompt}
 
-Please provide a concise answer based ONLY on the provided context. Do not use external knowledge. Keep your answer under {max_chars} characters."""
-        
-        # Use subprocess to call ollama
-        process = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8',
-            errors= "replace"
-        )
+Please provide a concise answer based ONLY on the provided context. Do not use external knowledge. Keep your answer under {max_chars} characters.""" if append_instructions else prompt
+        
         with open("prompt_llama.txt", "a", encoding='utf-8', errors='replace') as f:
             f.write(full_prompt + "\n\n")
         # Send prompt and get response
-        stdout, stderr = process.communicate(input=full_prompt, timeout=60)
-        
-        if process.returncode != 0:
-            print(f"❌ Error calling ollama: {stderr}")
-            return "Error: Unable to generate answer"
+        stdout = scheduled_generate(model, full_prompt, timeout=60, session=session, priority=priority)
         
         # Clean and truncate the response
         answer = stdout.strip()
@@ -843,16 +4008,19 @@ Please provide a concise answer based ONLY on the provided context. Do not use e
         
         return answer
         
-    except subprocess.TimeoutExpired:
+    except TimeoutError:
         print("❌ Timeout calling ollama")
         return "Error: Timeout generating answer"
+    except ModelBusyError as e:
+        print(f"❌ {e}")
+        return "Error: Model busy, answer not generated"
     except Exception as e:
         print(f"❌ Error calling ollama: {e}")
         return "Error: Unable to generate answer"
 
 
 # %%
-def call_ollama_llava(prompt, model="llava:7b", max_chars=300):
+def call_ollama_llava(prompt, model="llava:7b", max_chars=300, images=None, append_instructions=True, session=None, priority="batch"):
     """
     Call LLaVA via ollama for text and image questions.
     
@@ -860,50 +4028,43 @@ def call_ollama_llava(prompt, model="llava:7b", max_chars=300):
         prompt (str): The input prompt
         model (str): LLaVA model to use
         max_chars (int): Maximum characters for the answer
+        images (list): Optional image paths of the selected drawing sheets
+        append_instructions (bool): Append the answering instructions (prefix-layout prompts already start with them)
+        session (str): Optional session handle passed to the backend (see llm_generate)
+        priority (str): Scheduler priority class (see scheduled_generate)
+        
+    Returns:
+        str: Generated answer ("Error: ..." if it could not be generated)
     """
 
     try:
-        cmd = ["ollama", "run", model]
-        
         full_prompt = f"""{prompt}
-Please provide a concise answer based ONLY on the provided context. Do not use external knowledge. Keep your answer under {max_chars} characters."""
-        
-        process = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8',
-            errors="replace"
-        )
+Please provide a concise answer based ONLY on the provided context. Do not use external knowledge. Keep your answer under {max_chars} characters.""" if append_instructions else prompt
         
         with open("prompt_llava.txt", "a", encoding='utf-8', errors='replace') as f:
             f.write(full_prompt + "\n\n")
 
-        stdout, stderr = process.communicate(input=full_prompt, timeout=120)
-        
-        if process.returncode != 0:
-            print(f"❌ Error calling ollama llava: {stderr}")
-            return 
+        stdout = scheduled_generate(model, full_prompt, timeout=120, images=images, session=session, priority=priority)
         
         answer = stdout.strip()
         if len(answer) > max_chars:
             answer = answer[:max_chars].rsplit(' ', 1)[0] + "..."
         return answer
     
-    except subprocess.TimeoutExpired:
+    except TimeoutError:
         print("❌ Timeout calling ollama llava")
-        return 
+        return "Error: Timeout generating answer"
+    except ModelBusyError as e:
+        print(f"❌ {e}")
+        return "Error: Model busy, answer not generated"
     except Exception as e:
         print(f"❌ Error calling ollama llava: {e}")
-        return 
+        return "Error: Unable to generate answer"
 
 
 # %%
 def test_ollama_models():
-    result = subprocess.run(["ollama", "list"], capture_output=True, text=True)
-    available = result.stdout.lower()
+    available = " ".join(llm_list_models()).lower()
 
     return {
         "llama3": "llama3" in available,   # catches llama3:latest / llama3:8b / llama3:70b
@@ -913,34 +4074,67 @@ def test_ollama_models():
 
 
 # %%
-# === STEP 6: ANSWERS TO FILE ===
-def generate_answers(rag_prompts, output_file="both_models_answers.txt"):
+# === MODEL ROUTING ===
+# Which of LLaMA / LLaVA answer a question. "auto" runs one model per question from signals the
+# pipeline already has; "both" (evaluation runs), "llama" and "llava" force the choice.
+ROUTER_CONFIG = {
+    "image_similarity": 0.5,  # A selected drawing at least this similar counts as relevant on its own
+}
+FIGURE_QUESTION_PATTERN = re.compile(
+    r"\b(fig(ure)?s?\.?|drawings?|diagrams?|flow ?charts?|illustrat\w*|depict\w*|shown|sketch\w*|visuali[sz]\w*|images?)\b",
+    re.IGNORECASE)
+
+
+def route_question(prompt_data, mode="auto"):
     """
-    Generate answers for all questions using ollama (LLaMA/LLaVA).
+    Decide which models answer a question.
     
     Args:
-        rag_prompts (list): List of RAG prompt dictionaries
-        output_file (str): File to save answers
+        prompt_data (dict): RAG prompt dictionary (see process_questions_with_rag)
+        mode (str): "auto", "both", "llama" or "llava"
         
     Returns:
-        list: List of answers
+        tuple: (list of models to run, "llama" and/or "llava", reason string)
     """
-    print(f"\n=== Step 5: Answer Generation ===")
-    print(f"Generating answers for {len(rag_prompts)} questions using ollama...")
-    
-    answers = []
-    
-    # Check if ollama is available and test models
-    try:
-        result = subprocess.run(["ollama", "--version"], 
-                              capture_output=True, text=True, timeout=10)
+    if mode == "both":
+        return ["llava", "llama"], "both models requested"
+    if mode in ("llama", "llava"):
+        return [mode], f"{mode} requested"
+    if mode != "auto":
+        raise ValueError(f"Unknown route '{mode}' (choose auto, both, llama or llava)")
+    images = prompt_data.get('selected_images_chunks') or []
+    if not images:
+        # Without drawings both prompts carry the same text context
+        return ["llama"], "no drawing selected"
+    if FIGURE_QUESTION_PATTERN.search(prompt_data['question']):
+        return ["llava"], "question refers to the drawings"
+    best_similarity = max(float(img.get('similarity', 0.0)) for img in images)
+    if best_similarity >= ROUTER_CONFIG["image_similarity"]:
+        return ["llava"], f"drawing similarity {best_similarity:.2f}"
+    return ["llama"], f"drawings weakly related ({best_similarity:.2f})"
 
 
-        if result.returncode != 0:
-            print("❌ Error: ollama is not available or not working properly")
-            return []
-        
-        # Test available models
+# %%
+# === STEP 6: ANSWERS TO FILE ===
+# Models generate_answers runs
+ANSWER_MODELS = {"llama": "llama3:latest", "llava": "llava:7b"}
+
+
+def answer_settings_key(prompt_data):
+    """Settings an answer depends on besides its prompt context: LLM backend, models and prompt layout."""
+    return "|".join([LLM_BACKEND_CONFIG["backend"], ANSWER_MODELS["llama"], ANSWER_MODELS["llava"],
+                     prompt_data.get('layout') or "legacy"])
+
+
+def check_answer_models():
+    """
+    Check that the LLM backend is reachable and warn about missing answer models.
+    
+    Returns:
+        bool: False if the backend cannot be reached
+    """
+    try:
+        # Test available models (fails if the backend is not reachable)
         models = test_ollama_models()
         
         if not models.get('llama3'):
@@ -951,10 +4145,49 @@ def generate_answers(rag_prompts, output_file="both_models_answers.txt"):
     except Exception as e:
         print(f"❌ Error: Cannot access ollama - {e}")
         print("   Please make sure ollama is installed and running")
+        return False
+    return True
+
+
+def generate_answers(rag_prompts, output_file="both_models_answers.txt", append=False, start_index=1, route="both",
+                     priority="batch", check_models=True):
+    """
+    Generate answers for all questions using ollama (LLaMA/LLaVA).
+    Each answer is written to output_file as soon as it is generated. The models are chosen per
+    question by route_question; a model that is not run gets a "Skipped: ..." answer (scored 0).
+    
+    Args:
+        rag_prompts (list): List of RAG prompt dictionaries
+        output_file (str): File to save answers
+        append (bool): Append to output_file instead of overwriting it (later batches of a question stream)
+        start_index (int): Number of the first question
+        route (str): "both" (every model), "auto" (only the models the question needs, see route_question),
+                     or "llama" / "llava"
+        priority (str): Scheduler priority of the model calls ("interactive" for a user waiting on the answer)
+        check_models (bool): Check the backend first (see check_answer_models); False when the
+                             caller already did, e.g. for every batch of a question stream
+        
+    Returns:
+        list: List of answers
+    """
+    print(f"\n=== Step 5: Answer Generation ===")
+    print(f"Generating answers for {len(rag_prompts)} questions using ollama...")
+    
+    answers = []
+    
+    # Check if ollama is available and test models
+    if check_models and not check_answer_models():
         return []
     
+    try:
+        answers_file = open(output_file, 'a' if append else 'w', encoding='utf-8', errors='replace')
+    except Exception as e:
+        print(f"❌ Error saving answers: {e}")
+        answers_file = None
+    
+    routed_calls = 0
     # Process each question
-    for i, prompt_data in enumerate(rag_prompts, 1):
+    for i, prompt_data in enumerate(rag_prompts, start_index):
         question = prompt_data['question']
         llava_prompt = prompt_data['llava_prompt']
         llama_prompt = prompt_data['llama_prompt']
@@ -963,18 +4196,43 @@ def generate_answers(rag_prompts, output_file="both_models_answers.txt"):
         # selected_images = prompt_data['selected_images_chunks']
         # image_paths = [img['image_path'] for img in selected_images] if selected_images else []
         
-        print(f"\n🤖 Generating answer {i}/{len(rag_prompts)}")
+        print(f"\n🤖 Generating answer {i}/{start_index + len(rag_prompts) - 1}")
         print(f"   Question: {question}")
         
-        # # ( We will use both Llama and Llava for image questions and Llama only for text questions (we have))
-        # if image_paths and len(image_paths) > 0:
-        #     print(f"   Images include, using LLaVA with {len(image_paths)} images: {image_paths}")
+        # Run only the models the question needs
+        route_models, route_reason = route_question(prompt_data, route)
+        print(f"   Route: {' + '.join(route_models)} ({route_reason})")
+        routed_calls += len(route_models)
 
-        answer_llava = call_ollama_llava(llava_prompt)
-        answer_llava = answer_llava[:300]  # Ensure answers don't exceed 300 characters and handle None values
-        
-        answer_llama = call_ollama_llama(llama_prompt)
-        answer_llama = answer_llama[:300]
+        cache_entry = prompt_data.get('cache_entry')
+        settings_key = answer_settings_key(prompt_data)
+        if (cache_entry is not None and cache_entry['answers'] and cache_entry.get('answers_key') == settings_key
+                and not any(cache_entry['answers'][name].startswith("Skipped:") for name in route_models)):
+            # A near-duplicate question was already answered (semantic cache)
+            print("   ⚡ Reusing cached answers")
+            answer_llava = cache_entry['answers']['llava']
+            answer_llama = cache_entry['answers']['llama']
+        else:
+            image_paths = [chunk_image_path(img) for img in prompt_data['selected_images_chunks'] or []]
+            # Prefix-layout prompts carry their instructions up front and share a per-patent session
+            prefix_layout = prompt_data.get('layout') == "prefix"
+            session = prompt_data.get('session') if prefix_layout else None
+            if "llava" in route_models:
+                answer_llava = call_ollama_llava(llava_prompt, model=ANSWER_MODELS["llava"], images=image_paths,
+                                                 append_instructions=not prefix_layout, session=session, priority=priority)
+                answer_llava = answer_llava[:300]  # Ensure answers don't exceed 300 characters and handle None values
+            else:
+                answer_llava = f"Skipped: routed to LLaMA ({route_reason})"
+            
+            if "llama" in route_models:
+                answer_llama = call_ollama_llama(llama_prompt, model=ANSWER_MODELS["llama"], append_instructions=not prefix_layout,
+                                                 session=session, priority=priority)
+                answer_llama = answer_llama[:300]
+            else:
+                answer_llama = f"Skipped: routed to LLaVA ({route_reason})"
+            if cache_entry is not None and not any(answer.startswith("Error:") for answer in (answer_llava, answer_llama)):
+                cache_entry['answers'] = {'llava': answer_llava, 'llama': answer_llama}
+                cache_entry['answers_key'] = settings_key
         
         # Handle None values for character counting
         llama_chars = len(answer_llama) if answer_llama else 0
@@ -986,26 +4244,28 @@ def generate_answers(rag_prompts, output_file="both_models_answers.txt"):
             'answer_llama': answer_llama or "Error: LLaMA failed",
             'answer_llava': answer_llava or "Error: LLaVA failed", 
             'char_count_llama': llama_chars,
-            'char_count_llava': llava_chars
+            'char_count_llava': llava_chars,
+            'models': route_models
         })
         
         print(f"Answer LLaVA ({llava_chars} chars):\n{answer_llava}")
         print(f"Answer LLaMA ({llama_chars} chars):\n{answer_llama}")
-    
-    # Save answers to file
-    try:
-        with open(output_file, 'w', encoding='utf-8', errors='replace') as f:
-            for ans_data in answers:
-                f.write(f"Question {ans_data['question_number']}: {ans_data['question']}\n")
-                f.write(f"Answer LLaMA ({ans_data['char_count_llama']} chars):\n{ans_data['answer_llama']}\n")
-                f.write(f"Answer LLaVA ({ans_data['char_count_llava']} chars):\n{ans_data['answer_llava']}\n")
         
+        # Save the answer right away (a long run keeps everything answered so far)
+        if answers_file is not None:
+            ans_data = answers[-1]
+            answers_file.write(f"Question {ans_data['question_number']}: {ans_data['question']}\n")
+            answers_file.write(f"Answer LLaMA ({ans_data['char_count_llama']} chars):\n{ans_data['answer_llama']}\n")
+            answers_file.write(f"Answer LLaVA ({ans_data['char_count_llava']} chars):\n{ans_data['answer_llava']}\n")
+            answers_file.flush()
+    
+    if answers_file is not None:
+        answers_file.close()
         print(f"\n✅ Answers saved to {output_file}")
-        
         print(f"   Total answers: {len(answers)}")
-        
-    except Exception as e:
-        print(f"❌ Error saving answers: {e}")
+    if answers:
+        saved = 2 * len(answers) - routed_calls
+        print(f"   Model calls saved by routing: {saved} of {2 * len(answers)} ({saved / (2 * len(answers)):.0%})")
     
     return answers
 
@@ -1065,12 +4325,12 @@ def evaluate_single_answer(prompt, answer, model_name, collection_name="prompts_
     Returns:
         float: Semantic similarity score between prompt and answer (0-1 scale)
     """
-    # Handle error cases
-    if not answer or answer.startswith("Error:"):
+    # Handle error cases and models the router skipped
+    if not answer or answer.startswith(("Error:", "Skipped:")):
         return 0.0
     
-    # Initialize model
-    model = SentenceTransformer(model_name)
+    # Initialize model (cached after the first answer)
+    model = get_sentence_model(model_name)
     
     # Encode entire prompt and answer as single embeddings
     prompt_embedding = model.encode([prompt], show_progress_bar=False)
@@ -1124,8 +4384,11 @@ def answers_eval(rag_prompts, answers, output_file="answers.txt", model_name="al
             'llava_similarity': llava_similarity
         }
         
-        llama_scores.append(llama_similarity)
-        llava_scores.append(llava_similarity)
+        # Models routed away from the question (route="auto") are left out of the averages
+        if not answer['answer_llama'].startswith("Skipped:"):
+            llama_scores.append(llama_similarity)
+        if not answer['answer_llava'].startswith("Skipped:"):
+            llava_scores.append(llava_similarity)
 
         print(f"Question {i+1} Similarity Scores:")
         print(f"  LLaMA: {llama_similarity:.4f}")
@@ -1175,14 +4438,367 @@ def answers_eval(rag_prompts, answers, output_file="answers.txt", model_name="al
     return evaluations
 
 
+# %%
+# === PIPELINE STAGES ===
+# main() runs the pipeline as a DAG of stages. The output of a stage is memoized in
+# stage_cache/<stage>/<key>.pkl, where the key hashes the stage's code (the source of the functions
+# it runs), its parameters, its input files and the keys of the stages it depends on. A re-run
+# therefore recomputes only the stages whose key changed - and, through the chained keys, the
+# stages downstream of them - and loads everything else from disk. "code" names the entry points
+# of a stage; the module functions they call are hashed with them (see stage_functions).
+# Outputs of a failed run (failed pages, missing or "Error:" answers) are not stored, nor is
+# anything computed from them, so the next run tries again.
+PIPELINE_STAGES = {
+    "extract": {"after": [], "code": ["extract_text_and_images_from_patent", "changed_pages"]},
+    # Extraction already re-chunks structured patents; this stage only drops empty slots
+    "chunk": {"after": ["extract"], "code": []},
+    "embed": {"after": ["chunk"], "code": ["embed_chunks", "merge_embeddings", "encode_texts", "get_sentence_model"]},
+    # The in-memory Qdrant collection can't be stored on disk; it is rebuilt from the embeddings (no encoding)
+    "index": {"after": ["chunk", "embed"], "code": ["create_vector_store", "chunk_point", "chunk_payload"], "persist": False},
+    "retrieve": {"after": ["chunk", "index"], "code": ["process_questions_with_rag", "retrieve_relevant_chunks", "mmr_select",
+                                                      "top_similar_images", "read_questions", "load_questions"]},
+    "prompt": {"after": ["chunk", "retrieve"], "code": ["build_stage_prompts"]},
+    "generate": {"after": ["prompt"], "code": ["generate_answers", "route_question", "call_ollama_llama", "call_ollama_llava",
+                                              "save_cached_answers"]},
+    "evaluate": {"after": ["prompt", "generate"], "code": ["answers_eval", "evaluate_single_answer", "save_similarity_results"]},
+}
+_STAGE_MEMORY = {}  # (stage, key) -> output already computed or loaded in this process
+_UNSTORED_STAGES = set()  # (stage, key) of outputs not written to the disk cache (failed runs)
+
+
+def file_fingerprint(path):
+    """sha256 of a file's content ("missing" if it does not exist)."""
+    import hashlib
+    if not os.path.exists(path):
+        return "missing"
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stage_functions(stage):
+    """
+    Names of the module functions a stage runs: its PIPELINE_STAGES "code" entries and every
+    function of this module they reference, transitively (nested functions and lambdas included).
+    """
+    import types
+    seen, pending = set(), list(PIPELINE_STAGES[stage]["code"])
+    while pending:
+        name = pending.pop()
+        function = globals().get(name)
+        if name in seen or not isinstance(function, types.FunctionType) or function.__module__ != __name__:
+            continue
+        seen.add(name)
+        codes = [function.__code__]
+        while codes:
+            code = codes.pop()
+            pending.extend(code.co_names)
+            codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+    return sorted(seen)
+
+
+def stage_code_version(stage):
+    """Hash of the source code of the functions a stage runs (see stage_functions)."""
+    import hashlib
+    import inspect
+    digest = hashlib.sha256()
+    for name in stage_functions(stage):
+        function = globals()[name]
+        try:
+            digest.update(inspect.getsource(function).encode("utf-8"))
+        except (OSError, TypeError):
+            digest.update(function.__code__.co_code)
+    return digest.hexdigest()[:16]
+
+
+def create_stage_pipeline(cache_dir="stage_cache"):
+    """
+    Create an empty stage pipeline; register its stages with add_stage.
+    
+    Returns:
+        dict: Pipeline state {"cache_dir", "run_id", "stages", "keys", "runs"}
+    """
+    return {"cache_dir": cache_dir, "run_id": f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}", "stages": {}, "keys": {},
+            "runs": {}, "timers": []}
+
+
+def add_stage(pipeline, stage, compute, params=None, files=(), cacheable=None):
+    """
+    Register a stage of PIPELINE_STAGES.
+    
+    Args:
+        pipeline (dict): State from create_stage_pipeline
+        stage (str): Stage name
+        compute (callable): compute(pipeline) -> output; gets its inputs with stage_output(pipeline, upstream)
+        params (dict): JSON-serializable parameters that change the output
+        files (tuple): Input files whose content changes the output
+        cacheable (callable): cacheable(output) -> False for the output of a failed run, which is
+                              then not written to the disk cache (default: always cacheable)
+    """
+    pipeline["stages"][stage] = {"compute": compute, "params": params or {}, "files": list(files), "cacheable": cacheable}
+
+
+def stage_key(pipeline, stage):
+    """Cache key of a stage: its code, parameters, input files and the keys of its upstream stages."""
+    import hashlib
+    if stage not in pipeline["keys"]:
+        definition = pipeline["stages"][stage]
+        key_data = {
+            "stage": stage,
+            "code": stage_code_version(stage),
+            "params": definition["params"],
+            "files": {path: file_fingerprint(path) for path in definition["files"]},
+            "after": {upstream: stage_key(pipeline, upstream) for upstream in PIPELINE_STAGES[stage]["after"]},
+        }
+        pipeline["keys"][stage] = hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:20]
+    return pipeline["keys"][stage]
+
+
+def _load_stage_manifest(cache_dir):
+    manifest_file = os.path.join(cache_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {"entries": {}, "last_run": {}}
+
+
+def _update_stage_manifest(pipeline, stage, key, status, seconds=None):
+    """Record a computed or reused stage output (compute time, reuse count, time saved)."""
+    cache_dir = pipeline["cache_dir"]
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = _load_stage_manifest(cache_dir)
+    entry = manifest["entries"].setdefault(stage, {}).setdefault(key, {"seconds": 0.0, "hits": 0, "saved_seconds": 0.0})
+    if status == "computed":
+        entry.update(seconds=seconds, created=time.strftime("%Y-%m-%d %H:%M:%S"))
+    else:
+        entry["hits"] += 1
+        entry["saved_seconds"] += entry["seconds"]
+    manifest["last_run"][stage] = {"key": key, "status": status, "run": pipeline["run_id"]}
+    manifest["latest_run"] = pipeline["run_id"]
+    manifest_file = os.path.join(cache_dir, "manifest.json")
+    with open(manifest_file + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    return entry
+
+
+def stage_output(pipeline, stage):
+    """
+    Output of a stage: from this process, from the disk cache, or computed (and stored).
+    Upstream stages are only loaded or computed when this stage has to be computed.
+    """
+    import pickle
+    key = stage_key(pipeline, stage)
+    persist = PIPELINE_STAGES[stage].get("persist", True)
+    cache_file = os.path.join(pipeline["cache_dir"], stage, f"{key}.pkl")
+    if (stage, key) in _STAGE_MEMORY:
+        if stage not in pipeline["runs"]:
+            pipeline["runs"][stage] = "cached"
+            entry = _update_stage_manifest(pipeline, stage, key, "cached")
+            print(f"♻️  Stage '{stage}': reused from memory (saved {entry['seconds']:.1f}s)")
+        return _STAGE_MEMORY[(stage, key)]
+    started = time.perf_counter()
+    if persist and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            output = pickle.load(f)
+        pipeline["runs"][stage] = "cached"
+        entry = _update_stage_manifest(pipeline, stage, key, "cached")
+        print(f"♻️  Stage '{stage}': loaded from cache (saved {entry['seconds']:.1f}s)")
+    else:
+        # Time of this stage alone: upstream stages computed or loaded on the way are subtracted
+        pipeline["timers"].append(0.0)
+        try:
+            output = pipeline["stages"][stage]["compute"](pipeline)
+        finally:
+            upstream_seconds = pipeline["timers"].pop()
+        seconds = time.perf_counter() - started - upstream_seconds
+        cacheable = pipeline["stages"][stage]["cacheable"]
+        # Neither a failed output nor anything computed from one is stored
+        store = (not any((upstream, stage_key(pipeline, upstream)) in _UNSTORED_STAGES for upstream in PIPELINE_STAGES[stage]["after"])
+                 and (cacheable is None or cacheable(output)))
+        if persist and store:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file + ".tmp", 'wb') as f:
+                pickle.dump(output, f)
+            os.replace(cache_file + ".tmp", cache_file)
+        if store:
+            _UNSTORED_STAGES.discard((stage, key))
+        else:
+            _UNSTORED_STAGES.add((stage, key))
+        pipeline["runs"][stage] = "computed" if store else "not cached"
+        _update_stage_manifest(pipeline, stage, key, "computed", seconds)
+        print(f"⚙️  Stage '{stage}': computed in {seconds:.1f}s" + ("" if store else " (failed run, not cached)"))
+    if pipeline["timers"]:
+        pipeline["timers"][-1] += time.perf_counter() - started
+    _STAGE_MEMORY[(stage, key)] = output
+    return output
+
+
+def show_stage_cache(cache_dir="stage_cache"):
+    """
+    Print which stage outputs are cached, how often they were reused and how much time that saved.
+    
+    Returns:
+        dict: The stage manifest
+    """
+    manifest = _load_stage_manifest(cache_dir)
+    print(f"=== Stage cache: {cache_dir} ===")
+    print(f"{'stage':<10} {'last run':<10} {'entries':>7} {'size':>10} {'reuses':>7} {'compute s':>10} {'saved s':>9}")
+    total_saved = 0.0
+    for stage in PIPELINE_STAGES:
+        entries = manifest["entries"].get(stage, {})
+        stage_dir = os.path.join(cache_dir, stage)
+        size = sum(os.path.getsize(os.path.join(stage_dir, name)) for name in os.listdir(stage_dir)) if os.path.isdir(stage_dir) else 0
+        last = manifest["last_run"].get(stage, {})
+        current = entries.get(last.get("key"), {})
+        status = last.get("status", "-") if last.get("run") == manifest.get("latest_run") else "not needed"
+        saved = sum(entry["saved_seconds"] for entry in entries.values())
+        total_saved += saved
+        print(f"{stage:<10} {status:<10} {len(entries):>7} {size / 1024:>8.0f}KB {sum(e['hits'] for e in entries.values()):>7} "
+              f"{current.get('seconds', 0.0):>10.1f} {saved:>9.1f}")
+    print(f"Total time saved by cached stages: {total_saved:.1f}s")
+    return manifest
+
+
+def build_stage_prompts(retrieved, prompt_layout="legacy", chunks=()):
+    """Prompts of the prompt stage: the retrieved context of every question laid out for the LLMs."""
+    prompts = []
+    patent_context = patent_context_block(chunks) if prompt_layout == "prefix" else ""
+    for i, prompt_data in enumerate(retrieved, 1):
+        llava_prompt, llama_prompt = construct_rag_prompt(prompt_data['question'], i, prompt_data['relevant_chunks'],
+                                                          prompt_data['selected_images_chunks'], layout=prompt_layout,
+                                                          patent_context=patent_context)
+        prompts.append(dict(prompt_data, llava_prompt=llava_prompt, llama_prompt=llama_prompt, layout=prompt_layout))
+    return prompts
+
+
+def build_rag_pipeline(pdf_path, questions_file="questions.txt", cache_dir="stage_cache", model_name="all-MiniLM-L6-v2",
+                       lazy_sheets=False, chunking="structure", prompt_layout="legacy", model_route="both", mmr_lambda=None,
+                       semantic_cache_file=None, semantic_cache_threshold=0.95):
+    """
+    Register the stages of the RAG pipeline (extract -> chunk -> embed -> index -> retrieve -> prompt
+    -> generate -> evaluate) for one patent. Get any stage's output with stage_output(pipeline, stage).
+    
+    Args:
+        pdf_path (str): Patent PDF
+        questions_file (str): Questions of the retrieve stage
+        cache_dir (str): Directory of the memoized stage outputs
+        model_name (str): SentenceTransformer model
+        lazy_sheets (bool): Describe drawing sheets at query time instead of at extraction
+        chunking (str): "structure" or "page" (see extract_text_and_images_from_patent)
+        prompt_layout (str): "legacy" or "prefix"
+        model_route (str): Model routing of generate_answers
+        mmr_lambda (float): MMR trade-off of the retrieval (None = plain top-3)
+        semantic_cache_file (str): Optional semantic cache (see load_semantic_cache): paraphrases of earlier
+                                   questions reuse their retrieval and answers across runs. Off by default;
+                                   identical re-runs are already served by the stage cache
+        semantic_cache_threshold (float): Similarity at which a question reuses a cached one
+        
+    Returns:
+        dict: The pipeline (see create_stage_pipeline)
+    """
+    pipeline = create_stage_pipeline(cache_dir)
+    embeddings_file = f'{pdf_path.replace(".pdf", "")}_embeddings.npy'
+    
+    def extract(pipeline):
+        all_metadata = extract_text_and_images_from_patent(pdf_path, metadata_file="all_metadata.json", chunking=chunking,
+                                                           describe_sheets=not lazy_sheets)
+        return all_metadata[pdf_path]
+    
+    def chunk(pipeline):
+        # extract_text_and_images_from_patent has already re-chunked a structured patent
+        return [dict(c) for c in stage_output(pipeline, "extract")["chunks"] if c]
+    
+    def embed(pipeline):
+        chunks = stage_output(pipeline, "chunk")
+        embeddings, _ = embed_chunks(chunks, [get_chunk_id(c) for c in chunks], get_sentence_model(model_name), model_name,
+                                     embeddings_file=embeddings_file)
+        return np.array(embeddings, dtype=np.float32)
+    
+    def index(pipeline):
+        chunks = stage_output(pipeline, "chunk")
+        # The collection is built from the memoized embeddings (memory-mapped, not re-encoded)
+        save_embeddings(stage_output(pipeline, "embed"), [get_chunk_id(c) for c in chunks], embeddings_file, model_name)
+        client, model = create_vector_store(chunks, model_name=model_name, embeddings_file=embeddings_file)
+        return client, model, load_embeddings(embeddings_file)
+    
+    def retrieve(pipeline):
+        chunks = stage_output(pipeline, "chunk")
+        client, model, embedding_store = stage_output(pipeline, "index")
+        questions = load_questions(questions_file)
+        if not questions:
+            return []
+        # Paraphrased questions reuse earlier retrievals (and answers, saved by the generate stage)
+        semantic_cache = None
+        if semantic_cache_file:
+            semantic_cache = load_semantic_cache(semantic_cache_file, threshold=semantic_cache_threshold, cache_answers=True)
+        sheet_describer = create_sheet_describer("sheet_descriptions.json") if lazy_sheets else None
+        retrieved = process_questions_with_rag(questions, chunks, client, model, embedding_store=embedding_store,
+                                               semantic_cache=semantic_cache, patent_key=pdf_path,
+                                               sheet_describer=sheet_describer, mmr_lambda=mmr_lambda)
+        if sheet_describer is not None:
+            close_sheet_describer(sheet_describer, wait=False)
+        if semantic_cache is not None:
+            save_semantic_cache(semantic_cache, semantic_cache_file)
+        return retrieved
+    
+    def prompt(pipeline):
+        return build_stage_prompts(stage_output(pipeline, "retrieve"), prompt_layout, stage_output(pipeline, "chunk"))
+    
+    def generate(pipeline):
+        rag_prompts = stage_output(pipeline, "prompt")
+        answers = generate_answers(rag_prompts, route=model_route) if rag_prompts else []
+        if semantic_cache_file:
+            save_cached_answers(rag_prompts, pdf_path, semantic_cache_file, semantic_cache_threshold)
+        return answers
+    
+    def evaluate(pipeline):
+        answers = stage_output(pipeline, "generate")
+        return answers_eval(stage_output(pipeline, "prompt"), answers) if answers else None
+    
+    add_stage(pipeline, "extract", extract, {"pdf": pdf_path, "chunking": chunking, "lazy_sheets": lazy_sheets}, files=[pdf_path],
+              cacheable=lambda entry: all(status["status"] != "failed" for status in entry["pages"].values()))
+    add_stage(pipeline, "chunk", chunk, {"chunking": chunking})
+    add_stage(pipeline, "embed", embed, {"model": model_name})
+    add_stage(pipeline, "index", index, {"model": model_name})
+    semantic_cache_params = {"file": semantic_cache_file, "threshold": semantic_cache_threshold} if semantic_cache_file else None
+    add_stage(pipeline, "retrieve", retrieve, {"mmr_lambda": mmr_lambda, "lazy_sheets": lazy_sheets,
+                                               "semantic_cache": semantic_cache_params}, files=[questions_file])
+    add_stage(pipeline, "prompt", prompt, {"layout": prompt_layout})
+    add_stage(pipeline, "generate", generate, {"route": model_route, "llm": {k: v for k, v in LLM_BACKEND_CONFIG.items() if k != "host"},
+                                               "models": ANSWER_MODELS, "semantic_cache": semantic_cache_params},
+              cacheable=lambda answers: bool(answers) and not any(
+                  answer[name].startswith("Error:") for answer in answers for name in ("answer_llama", "answer_llava")))
+    add_stage(pipeline, "evaluate", evaluate)
+    return pipeline
+
+
 # %%
 def main():
     """
-    Main function to execute the RAG pipeline steps
+    Main function to execute the RAG pipeline steps.
+    Every step is a memoized stage (see build_rag_pipeline): a re-run only recomputes the stages
+    whose inputs, code or settings changed. `python Patent_RAG.py stages` shows the cache.
+    The client and model are None when the vector store was not needed (all later stages cached).
     """
     # TODO: add stoper for the entire process
     # pdf switch
     pdf_path = "US11960514.pdf"
+    # Describe drawing sheets at query time, only when a prompt selects them
+    lazy_sheets = False
+    # "prefix": shared instructions/context first so the model server reuses the prompt prefix per patent
+    prompt_layout = "legacy"
+    # "both" answers every question with both models (evaluation compares them); "auto" runs only the model each question needs
+    model_route = "both"
+    # MMR trade-off between relevance and diversity of the retrieved chunks (None = plain top-3, e.g. 0.7 for diverse context)
+    mmr_lambda = None
+    # Semantic cache of paraphrased questions across runs (None = off), e.g. "semantic_cache.json"
+    semantic_cache_file = None
+    # Stream a large questions file batch by batch (answer_question_stream) instead of loading it at once;
+    # the retrieve / prompt / generate stages are then not memoized
+    stream_questions = False
     
     # Check if patent PDF exists
     if not os.path.exists(pdf_path):
@@ -1191,20 +4807,14 @@ def main():
     
     print("=== RAG Pipeline for Patent Analysis ===")
     print(f"Processing: {pdf_path}\n")
+    pipeline = build_rag_pipeline(pdf_path, "questions.txt", lazy_sheets=lazy_sheets, prompt_layout=prompt_layout,
+                                  model_route=model_route, mmr_lambda=mmr_lambda, semantic_cache_file=semantic_cache_file)
     
     # === STEP 1: CHUNKING ===
+    # The extract stage is checkpointed after every page: an interrupted run resumes where it
+    # stopped, and for an amended PDF only the pages whose content changed are processed again
     print("=== Step 1: Chunking the Patent ===")
-    
-    # Check if we already have processed any chunks
-    all_metadata = load_chunks_metadata()
-    if pdf_path in all_metadata:
-        print(f"Loaded existing chunks for {pdf_path}")
-        chunks = all_metadata[pdf_path]["chunks"]
-    else:
-        print("Processing patent PDF...")
-        all_metadata = extract_text_and_images_from_patent(pdf_path)
-        save_chunks_metadata(all_metadata)
-        chunks = all_metadata[pdf_path]["chunks"]
+    chunks = stage_output(pipeline, "chunk")
     
     # Print Step 1 summary
     text_chunks = [c for c in chunks if c['type'] == 'text']
@@ -1215,37 +4825,44 @@ def main():
     print(f"Text chunks: {len(text_chunks)}")
     print(f"Image chunks: {len(image_chunks)}")
     
-    # === STEP 2: VECTOR STORE ===
-    client, model = create_vector_store(chunks)
+    if stream_questions:
+        # === STEP 2-5: VECTOR STORE, then retrieval and answers per batch of questions ===
+        client, model, embedding_store = stage_output(pipeline, "index")
+        answered = answer_question_stream("questions.txt", chunks, client, model, route=model_route,
+                                          semantic_cache_file=semantic_cache_file, embedding_store=embedding_store,
+                                          patent_key=pdf_path, prompt_layout=prompt_layout, mmr_lambda=mmr_lambda)
+        print(f"\n=== Pipeline Complete ===")
+        print(f"✅ {answered} questions answered and saved")
+        return chunks, client, model, answered
     
-    # === STEP 3: QUESTION INPUT ===
-    questions = load_questions()
-    
-    # === STEP 4: RAG PROMPT CONSTRUCTION ===
-    if questions:  # Only proceed if we have questions
-        rag_prompts = process_questions_with_rag(questions, chunks, client, model)
-    else:
+    # === STEP 2-4: VECTOR STORE, QUESTIONS, RAG PROMPT CONSTRUCTION ===
+    rag_prompts = stage_output(pipeline, "prompt")
+    if not rag_prompts:
         print("⚠️  No questions to process - skipping RAG prompt construction")
-        rag_prompts = []
+    questions = [prompt_data['question'] for prompt_data in rag_prompts]
     
     # === STEP 5: ANSWER GENERATION ===
-    answers = []
-    if rag_prompts:  # Only proceed if we have prompts
-        answers = generate_answers(rag_prompts)
-    else:
+    answers = stage_output(pipeline, "generate")
+    if not rag_prompts:
         print("⚠️  No prompts to process - skipping answer generation")
     
+    # The vector store is only built when a stage needed it
+    client, model = None, None
+    if ("index", stage_key(pipeline, "index")) in _STAGE_MEMORY:
+        client, model, _ = stage_output(pipeline, "index")
+    
     print(f"\n=== Pipeline Complete ===")
     print(f"✅ Step 1: Patent chunked into {len(chunks)} pieces")
     print(f"✅ Step 2: {len(text_chunks)} text chunks vectorized and stored")
     print(f"✅ Step 3: {len(questions)} questions loaded and ready")
     print(f"✅ Step 4: {len(rag_prompts)} RAG prompts constructed")
     print(f"✅ Step 5: {len(answers)} answers generated and saved")
+    print("   Stages: " + ", ".join(f"{stage} {status}" for stage, status in pipeline["runs"].items()))
     
     # Optional: Run evaluation if answers were generated
     if answers and rag_prompts:
         print(f"\n=== Optional: Running Answer Evaluation ===")
-        evaluation_results = answers_eval(rag_prompts, answers)
+        evaluation_results = stage_output(pipeline, "evaluate")
         return chunks, client, model, questions, rag_prompts, answers, evaluation_results
     
     return chunks, client, model, questions, rag_prompts, answers
@@ -1255,7 +4872,11 @@ def main():
 
 # %%
 if __name__ == "__main__":
-    main()
+    # `python Patent_RAG.py stages` shows the memoized stages instead of running the pipeline
+    if sys.argv[1:2] == ["stages"]:
+        show_stage_cache()
+    else:
+        main()
 
 # %%
 
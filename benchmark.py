@@ -0,0 +1,960 @@
+"""
+Reproducible benchmark suite for the patent RAG pipeline.
+
+Measures every stage of Patent_RAG.py on the bundled patents (US6285999.pdf,
+US11960514.pdf) and on synthetic scaled-up copies of their chunks:
+
+    extract   - pages/sec of extract_text_and_images_from_patent, eager and with lazy
+                (query-time) sheet descriptions
+    classify  - ms/page of the layout page classifier, its page kinds, and (with OCR)
+                the cost and agreement of the old OCR + "sheet X of Y" routing
+    startup   - fresh-process import time and warm-cache (cached chunks) start time
+    embed     - chunks/sec of the SentenceTransformer encoder
+    encoders  - chunks/sec per encoder backend (torch/onnx/int8) and worker count,
+                plus cosine agreement of each backend with the torch embeddings
+    images    - drawing sheets as LLaVA descriptions vs CLIP image vectors: ms/sheet and
+                hit@1 of figure-caption queries
+    index     - seconds to build the Qdrant collection (create_vector_store)
+    retrieve  - queries/sec, p50 and p95 of retrieve_relevant_chunks / top_similar_images
+    e2e       - per-question latency of retrieval + prompt + generation (stub LLM)
+    prompts   - time to first token of the legacy vs prefix prompt layouts (stub LLM with a
+                simulated prefill rate and per-session prefix cache), shared-prefix ratio
+    bulk      - seconds to load precomputed embeddings into a Qdrant collection point by point
+                (PointStruct upsert) vs from embedding columns (bulk_upload_columns), and with
+                pyarrow the Parquet export / read time, size and round-trip check
+    shards    - queries/sec of sharded scatter-gather retrieval per shard count over a corpus
+                of synthetic patents, and agreement of its top-k with retrieve_relevant_chunks
+                on the in-memory Qdrant collection
+
+Everything runs offline on CPU: the LLM backend is switched to the in-process "stub" backend, and
+Hugging Face / EasyOCR models are loaded from the local cache only (use
+--stub-encoder and --no-ocr to skip them entirely). Results are written as JSON
+so two runs can be diffed with the `compare` command.
+
+Usage:
+    python benchmark.py run --scales 1 10 --repeats 3
+    python benchmark.py compare bench_results/old.json bench_results/new.json
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_PDFS = ["US6285999.pdf", "US11960514.pdf"]
+RESULTS_SCHEMA_VERSION = 1
+HEAVY_MODULES = ["torch", "sentence_transformers", "easyocr", "cv2", "sklearn",
+                 "qdrant_client", "langchain_text_splitters"]
+
+# Runs in a fresh interpreter: import the pipeline, then load the cached chunks.
+STARTUP_SCRIPT = """
+import contextlib, io, json, sys, time
+start = time.perf_counter()
+import Patent_RAG as rag
+imported = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    rag.load_chunks_metadata(sys.argv[1])
+loaded = time.perf_counter()
+heavy = [name for name in sys.argv[2].split(",") if name in sys.modules]
+print(json.dumps({"import": imported - start, "warm": loaded - start, "heavy": heavy}))
+"""
+
+
+# === STUB ENCODER ===
+class StubEncoder:
+    """
+    Deterministic hashing encoder with the SentenceTransformer `encode` signature.
+    Used with --stub-encoder to benchmark indexing and retrieval without any model files.
+    """
+
+    def __init__(self, model_name=None, dim=384, **kwargs):
+        self.dim = dim
+
+    def encode(self, texts, show_progress_bar=False, batch_size=32, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            if not isinstance(text, str):
+                # PIL image (image model stand-in): hash rows of a small grayscale copy
+                pixels = np.asarray(text.convert("L").resize((32, 32)))
+                text = " ".join(hashlib.md5(line.tobytes()).hexdigest()[:6] for line in pixels)
+            for token in text.lower().split():
+                bucket = int(hashlib.md5(token.encode("utf-8")).hexdigest()[:8], 16)
+                vectors[row, bucket % self.dim] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+# === HELPERS ===
+def percentile(values, q):
+    """Return the q-th percentile of a list of values (0.0 for an empty list)."""
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """Silence the pipeline's progress prints while a stage is being timed."""
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def record(results, stage, corpus, metric, value, unit, higher_is_better):
+    """Append one measurement to the results list and echo it."""
+    results.append({
+        "stage": stage,
+        "corpus": corpus,
+        "metric": metric,
+        "value": round(float(value), 6),
+        "unit": unit,
+        "higher_is_better": higher_is_better,
+    })
+    print(f"   {stage:<10} {corpus:<22} {metric:<24} {value:>12.4f} {unit}")
+
+
+def git_commit():
+    """Return the current git commit hash, or None outside a git checkout."""
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def environment_info():
+    """Collect the machine/software facts needed to compare two result files."""
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+    }
+    for module_name in ("torch", "sentence_transformers", "qdrant_client", "fitz"):
+        module = sys.modules.get(module_name)
+        if module is not None:
+            info[module_name] = getattr(module, "__version__", getattr(module, "VersionBind", None))
+    return info
+
+
+def scale_chunks(chunks, factor):
+    """
+    Build a synthetic corpus `factor` times larger than `chunks`.
+    Copy k shifts page numbers past the original document and tags the text,
+    so the copies are distinct vectors but keep realistic lengths.
+
+    Args:
+        chunks (list): Chunk dictionaries of one or more patents
+        factor (int): Number of copies
+
+    Returns:
+        list: Scaled list of chunk dictionaries
+    """
+    if factor <= 1:
+        return list(chunks)
+    max_page = max((chunk["page"] for chunk in chunks), default=0)
+    scaled = []
+    for copy in range(factor):
+        for chunk in chunks:
+            new_chunk = dict(chunk)
+            new_chunk.pop("id", None)  # copies get their own content-derived ids
+            if copy:
+                new_chunk["page"] = chunk["page"] + copy * max_page
+                new_chunk["content"] = f"{chunk['content']} (variant {copy})"
+            scaled.append(new_chunk)
+    return scaled
+
+
+# === STAGES ===
+def bench_extract(ctx, results):
+    """Pages/sec of extract_text_and_images_from_patent for every bundled PDF."""
+    rag = ctx["rag"]
+    import fitz
+
+    for pdf_name in ctx["pdfs"]:
+        with fitz.open(pdf_name) as doc:
+            pages = doc.page_count
+        timings = []
+        for _ in range(ctx["args"].extract_repeats):
+            output_dir = os.path.join(ctx["workdir"], "extracted_images", os.path.splitext(pdf_name)[0])
+            shutil.rmtree(output_dir, ignore_errors=True)
+            start = time.perf_counter()
+            with quiet(not ctx["args"].verbose):
+                metadata = rag.extract_text_and_images_from_patent(pdf_name, output_dir=output_dir)
+            timings.append(time.perf_counter() - start)
+        ctx["chunks"][pdf_name] = [c for c in metadata[pdf_name]["chunks"] if c]
+        best = min(timings)
+        record(results, "extract", pdf_name, "pages_per_sec", pages / best, "pages/s", True)
+        record(results, "extract", pdf_name, "seconds", best, "s", False)
+
+        # Lazy ingest: drawing sheets keep their OCR text, LLaVA runs at query time
+        lazy_dir = os.path.join(ctx["workdir"], "extracted_images_lazy", os.path.splitext(pdf_name)[0])
+        start = time.perf_counter()
+        with quiet(not ctx["args"].verbose):
+            rag.extract_text_and_images_from_patent(pdf_name, output_dir=lazy_dir, describe_sheets=False)
+        record(results, "extract", pdf_name, "lazy_sheets_seconds", time.perf_counter() - start, "s", False)
+
+
+def bench_classify(ctx, results):
+    """Per-page cost of classify_page, compared with the OCR-first routing it replaced."""
+    rag = ctx["rag"]
+    import fitz
+
+    for pdf_name in ctx["pdfs"]:
+        kinds, classify_times, legacy_times, agree = {}, [], [], 0
+        with fitz.open(pdf_name) as doc:
+            for page in doc:
+                start = time.perf_counter()
+                with quiet(not ctx["args"].verbose):
+                    kind, _ = rag.classify_page(page)
+                classify_times.append(time.perf_counter() - start)
+                kinds[kind] = kinds.get(kind, 0) + 1
+                if not ctx["args"].ocr:
+                    continue
+                start = time.perf_counter()
+                with quiet(not ctx["args"].verbose):
+                    text = page.get_text()
+                    if not text.strip():
+                        text = rag.ocr_text_extraction(page)
+                    legacy_drawing = bool(re.findall(rag.SHEET_PATTERN, text, flags=re.IGNORECASE))
+                legacy_times.append(time.perf_counter() - start)
+                agree += legacy_drawing == (kind == "drawing")
+        pages = len(classify_times)
+        record(results, "classify", pdf_name, "ms_per_page", 1000 * sum(classify_times) / pages, "ms", False)
+        record(results, "classify", pdf_name, "p95_ms", 1000 * percentile(classify_times, 95), "ms", False)
+        for kind, count in sorted(kinds.items()):
+            record(results, "classify", pdf_name, f"{kind}_pages", count, "pages", True)
+        if legacy_times:
+            record(results, "classify", pdf_name, "legacy_ms_per_page", 1000 * sum(legacy_times) / pages, "ms", False)
+            record(results, "classify", pdf_name, "legacy_agreement", agree / pages, "ratio", True)
+
+
+def bench_startup(ctx, results):
+    """Import and warm-cache start time of Patent_RAG in fresh interpreters."""
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    import_times, warm_times, wall_times, heavy = [], [], [], []
+    for _ in range(ctx["args"].repeats):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, ctx["metadata_file"], ",".join(HEAVY_MODULES)],
+                             cwd=ctx["workdir"], env=env, capture_output=True, text=True, timeout=600)
+        wall_times.append(time.perf_counter() - start)
+        if out.returncode != 0:
+            print(f"❌ Startup probe failed: {out.stderr.strip()[-500:]}")
+            return
+        timing = json.loads(out.stdout.strip().splitlines()[-1])
+        import_times.append(timing["import"])
+        warm_times.append(timing["warm"])
+        heavy = timing["heavy"]
+    record(results, "startup", "-", "import_seconds", percentile(import_times, 50), "s", False)
+    record(results, "startup", "-", "warm_cache_seconds", percentile(warm_times, 50), "s", False)
+    record(results, "startup", "-", "process_wall_seconds", percentile(wall_times, 50), "s", False)
+    record(results, "startup", "-", "heavy_modules_loaded", len(heavy), "modules", False)
+    if heavy:
+        print(f"   heavy modules imported on the warm-cache path: {', '.join(heavy)}")
+
+
+def bench_embed(ctx, results):
+    """Chunks/sec of the embedding model on each corpus."""
+    start = time.perf_counter()
+    encoder = ctx["rag"].get_sentence_model(ctx["args"].model)
+    record(results, "embed", "-", "model_load_seconds", time.perf_counter() - start, "s", False)
+    ctx["encoder"] = encoder
+    for corpus_name, chunks in ctx["corpora"].items():
+        texts = [chunk["content"] for chunk in chunks]
+        encoder.encode(texts[:8], show_progress_bar=False)  # warm-up
+        timings = []
+        for _ in range(ctx["args"].repeats):
+            start = time.perf_counter()
+            encoder.encode(texts, show_progress_bar=False)
+            timings.append(time.perf_counter() - start)
+        record(results, "embed", corpus_name, "chunks_per_sec", len(texts) / min(timings), "chunks/s", True)
+
+
+def bench_encoders(ctx, results):
+    """Throughput and numerical agreement of the encoder backends on the largest corpus."""
+    rag = ctx["rag"]
+    args = ctx["args"]
+    if args.stub_encoder:
+        print("   skipped: --stub-encoder replaces every backend")
+        return
+    corpus_name, chunks = max(ctx["corpora"].items(), key=lambda item: len(item[1]))
+    texts = [chunk["content"] for chunk in chunks]
+    reference = None
+    for backend in args.encoder_backends:
+        with quiet(not args.verbose):
+            model = rag.get_sentence_model(args.model, backend)
+        if backend == "onnx" and args.model in rag._ONNX_UNAVAILABLE:
+            # The ONNX export failed and the torch model was returned: nothing to measure
+            print(f"   skipped onnx: {args.model} fell back to torch")
+            continue
+        for workers in args.encode_workers:
+            start = time.perf_counter()
+            with quiet(not args.verbose):
+                embeddings = rag.encode_texts(model, texts, batch_size=args.batch_size, workers=workers,
+                                              model_name=args.model, backend=backend)
+            seconds = time.perf_counter() - start
+            record(results, "encoders", corpus_name, f"{backend}_w{workers}_chunks_per_sec",
+                   len(texts) / seconds, "chunks/s", True)
+        if reference is None:
+            reference = embeddings
+            continue
+        cosine = np.sum(embeddings * reference, axis=1) / (
+            np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1) + 1e-12)
+        record(results, "encoders", corpus_name, f"{backend}_min_cosine_vs_{args.encoder_backends[0]}",
+               float(cosine.min()), "cosine", True)
+
+
+def bench_images(ctx, results):
+    """
+    Drawing sheets as LLaVA descriptions vs CLIP image vectors: ingest cost per sheet and
+    hit@1 of figure-caption queries (the sheet whose text layer shows "FIG. n" is the answer).
+    """
+    rag = ctx["rag"]
+    args = ctx["args"]
+    import fitz
+
+    try:
+        with quiet(not args.verbose):
+            text_model = rag.get_sentence_model(args.model)
+            image_model = rag.get_sentence_model(args.image_model)
+    except Exception as e:
+        print(f"   skipped: cannot load {args.image_model} ({e})")
+        return
+    for pdf_name, chunks in ctx["chunks"].items():
+        sheets = [c for c in chunks if c["type"] == "image_description" and os.path.exists(rag.chunk_image_path(c))]
+        if not sheets:
+            continue
+        sheet_pages = [sheet["page"] for sheet in sheets]
+
+        describe_times, figure_pages = [], {}
+        with fitz.open(pdf_name) as doc:
+            for sheet in sheets:
+                page = doc[sheet["page"] - 1]
+                for figure in re.findall(r"FIGS?\.\s*(\d+[A-Z]?)", page.get_text()):
+                    figure_pages.setdefault(figure, sheet["page"])
+                start = time.perf_counter()
+                with quiet(not args.verbose):
+                    rag.sheet_descriptions(page, rag.chunk_image_path(sheet), sheet["page"])
+                describe_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        with quiet(not args.verbose):
+            image_vectors = rag.encode_images(image_model, [rag.chunk_image_path(sheet) for sheet in sheets])
+        encode_seconds = time.perf_counter() - start
+        record(results, "images", pdf_name, "describe_ms_per_sheet", 1000 * sum(describe_times) / len(sheets), "ms", False)
+        record(results, "images", pdf_name, "image_vector_ms_per_sheet", 1000 * encode_seconds / len(sheets), "ms", False)
+
+        captions = [(re.sub(r"^FIGS?\.\s*\S+\s+(is|are)\s+", "", c["content"]), figure_pages[c["figure"]])
+                    for c in chunks if c.get("figure") in figure_pages]
+        if not captions:
+            continue
+        queries = [text for text, _ in captions]
+        truth = np.array([page for _, page in captions])
+        with quiet(not args.verbose):
+            by_description = rag.cosine_similarity(text_model.encode(queries), text_model.encode([s["content"] for s in sheets]))
+            by_image = rag.cosine_similarity(image_model.encode(queries), image_vectors)
+        for method, scores in (("description", by_description), ("image_vector", by_image)):
+            hits = np.array(sheet_pages)[scores.argmax(axis=1)] == truth
+            record(results, "images", pdf_name, f"{method}_hit_at_1", float(hits.mean()), "ratio", True)
+        record(results, "images", pdf_name, "caption_queries", len(captions), "queries", True)
+
+
+def bench_index(ctx, results):
+    """Seconds for create_vector_store (model load + encode + upsert) on each corpus."""
+    rag = ctx["rag"]
+    for corpus_name, chunks in ctx["corpora"].items():
+        start = time.perf_counter()
+        with quiet(not ctx["args"].verbose):
+            client, model = rag.create_vector_store(chunks, model_name=ctx["args"].model)
+        record(results, "index", corpus_name, "build_seconds", time.perf_counter() - start, "s", False)
+        ctx["stores"][corpus_name] = (client, model)
+
+
+def bench_retrieve(ctx, results):
+    """Queries/sec and latency percentiles of text and image retrieval."""
+    rag = ctx["rag"]
+    questions = ctx["questions"]
+    for corpus_name, chunks in ctx["corpora"].items():
+        client, model = ctx["stores"][corpus_name]
+        with quiet(not ctx["args"].verbose):
+            rag.retrieve_relevant_chunks(questions[0], client, model)  # warm-up
+        text_latencies, image_latencies = [], []
+        for _ in range(ctx["args"].repeats):
+            for question in questions:
+                start = time.perf_counter()
+                relevant_chunks = rag.retrieve_relevant_chunks(question, client, model)
+                text_latencies.append(time.perf_counter() - start)
+                chunk_copies = [dict(c) for c in chunks]  # top_similar_images annotates its input
+                start = time.perf_counter()
+                with quiet(not ctx["args"].verbose):
+                    rag.top_similar_images(relevant_chunks, chunk_copies, max_images=2, client=client)
+                image_latencies.append(time.perf_counter() - start)
+        record(results, "retrieve", corpus_name, "text_qps", len(text_latencies) / sum(text_latencies), "q/s", True)
+        record(results, "retrieve", corpus_name, "text_p50_ms", percentile(text_latencies, 50) * 1000, "ms", False)
+        record(results, "retrieve", corpus_name, "text_p95_ms", percentile(text_latencies, 95) * 1000, "ms", False)
+        record(results, "retrieve", corpus_name, "image_p95_ms", percentile(image_latencies, 95) * 1000, "ms", False)
+
+
+def bench_bulk(ctx, results):
+    """Point-by-point upsert vs columnar bulk upload of precomputed embeddings, and the Parquet round trip."""
+    from qdrant_client import QdrantClient
+    from qdrant_client.http.models import Distance, VectorParams
+    rag = ctx["rag"]
+    encoder = rag.get_sentence_model(ctx["args"].model)
+    try:
+        rag._import_pyarrow()
+        has_pyarrow = True
+    except ImportError:
+        has_pyarrow = False
+        print("pyarrow not installed: skipping the Parquet timings")
+    
+    def empty_collection(name):
+        client = QdrantClient(":memory:")
+        client.create_collection(name, vectors_config={
+            rag.TEXT_VECTOR: VectorParams(size=embeddings.shape[1], distance=Distance.COSINE)})
+        return client
+    
+    for corpus_name, chunks in ctx["corpora"].items():
+        embeddings = np.asarray(encoder.encode([chunk["content"] for chunk in chunks], show_progress_bar=False),
+                                dtype=np.float32)
+        chunk_ids = [rag.get_chunk_id(chunk) for chunk in chunks]
+        # Both timings cover building the rows (PointStructs / columns) and uploading them, nothing else
+        points_timings, bulk_timings = [], []
+        for _ in range(ctx["args"].repeats):
+            client = empty_collection("points")
+            start = time.perf_counter()
+            client.upsert("points", points=[rag.chunk_point(chunk, chunk_ids[i], i, embedding, {})
+                                            for i, (chunk, embedding) in enumerate(zip(chunks, embeddings))])
+            points_timings.append(time.perf_counter() - start)
+            bulk_client = empty_collection("bulk")
+            start = time.perf_counter()
+            rag.bulk_upload_columns(bulk_client, "bulk", rag.chunk_columns(chunks, embeddings))
+            bulk_timings.append(time.perf_counter() - start)
+        record(results, "bulk", corpus_name, "points_load_seconds", min(points_timings), "s", False)
+        record(results, "bulk", corpus_name, "bulk_load_seconds", min(bulk_timings), "s", False)
+        record(results, "bulk", corpus_name, "bulk_speedup", min(points_timings) / min(bulk_timings), "x", True)
+        # Same collection contents: the top hits of a query must agree
+        hits = [[hit.id for hit in c.query_points(name, query=embeddings[0].tolist(), using=rag.TEXT_VECTOR, limit=5).points]
+                for c, name in ((client, "points"), (bulk_client, "bulk"))]
+        record(results, "bulk", corpus_name, "top5_agreement", len(set(hits[0]) & set(hits[1])) / 5, "ratio", True)
+
+        if has_pyarrow:
+            parquet_file = os.path.join(ctx["workdir"], f"{corpus_name}.parquet")
+            start = time.perf_counter()
+            with quiet(not ctx["args"].verbose):
+                rag.export_chunks_parquet(chunks, embeddings, parquet_file, ctx["args"].model)
+            record(results, "bulk", corpus_name, "parquet_write_seconds", time.perf_counter() - start, "s", False)
+            record(results, "bulk", corpus_name, "parquet_mb", os.path.getsize(parquet_file) / 2**20, "MB", False)
+            start = time.perf_counter()
+            columns = rag.read_chunks_parquet(parquet_file)
+            record(results, "bulk", corpus_name, "parquet_read_seconds", time.perf_counter() - start, "s", False)
+            # Round trip: ids, payload fields and vectors come back unchanged
+            expected = rag.chunk_columns(chunks, embeddings)
+            round_trip = (np.array_equal(columns["embedding"], expected["embedding"])
+                          and all(columns[name] == expected[name] for name in expected if name != "embedding"))
+            record(results, "bulk", corpus_name, "parquet_round_trip_ok", float(round_trip), "bool", True)
+
+
+def bench_mmr(ctx, results):
+    """Cost per query of MMR selection by candidate pool size, and the redundancy of the selected chunks."""
+    rag = ctx["rag"]
+    args = ctx["args"]
+
+    def redundancy(hits):
+        # Mean pairwise cosine similarity of the selected chunks
+        vectors = rag._normalize_rows([hit["embedding"] for hit in hits])
+        similarity = vectors @ vectors.T
+        pairs = len(hits) * (len(hits) - 1)
+        return float((similarity.sum() - np.trace(similarity)) / pairs) if pairs else 0.0
+
+    for corpus_name, chunks in ctx["corpora"].items():
+        client, model = ctx["stores"][corpus_name]
+        query_embeddings = model.encode(ctx["questions"])
+        plain = [rag.retrieve_relevant_chunks(q, client, model, top_k=3, question_embedding=e)
+                 for q, e in zip(ctx["questions"], query_embeddings)]
+        if not any(plain):
+            continue  # No text chunks (scanned patent without OCR)
+        record(results, "mmr", corpus_name, "redundancy_top3", float(np.mean([redundancy(h) for h in plain])), "cosine", False)
+        for pool in args.mmr_candidates:
+            fetch_latencies, select_latencies, selected = [], [], []
+            for question, embedding in zip(ctx["questions"], query_embeddings):
+                start = time.perf_counter()
+                candidates = rag.retrieve_relevant_chunks(question, client, model, top_k=pool, question_embedding=embedding)
+                fetch_latencies.append(time.perf_counter() - start)
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    hits = rag.mmr_rerank(candidates, embedding, 3, args.mmr_lambda)
+                    select_latencies.append(time.perf_counter() - start)
+                selected.append(hits)
+            record(results, "mmr", corpus_name, f"select_us_pool{pool}", float(np.mean(select_latencies)) * 1e6, "us", False)
+            record(results, "mmr", corpus_name, f"fetch_ms_pool{pool}", float(np.mean(fetch_latencies)) * 1000, "ms", False)
+            record(results, "mmr", corpus_name, f"redundancy_pool{pool}",
+                   float(np.mean([redundancy(h) for h in selected])), "cosine", False)
+            record(results, "mmr", corpus_name, f"relevance_pool{pool}",
+                   float(np.mean([hit["similarity"] for hits in selected for hit in hits])
+                         / np.mean([hit["similarity"] for hits in plain for hit in hits])), "ratio", True)
+
+
+def bench_e2e(ctx, results):
+    """Per-question latency of prompt construction plus (stub) answer generation."""
+    rag = ctx["rag"]
+    questions = ctx["questions"][:ctx["args"].max_questions]
+    for corpus_name, chunks in ctx["corpora"].items():
+        client, model = ctx["stores"][corpus_name]
+        latencies = []
+        rag.LLM_CALL_LOG.clear()
+        for question in questions:
+            start = time.perf_counter()
+            with quiet(not ctx["args"].verbose):
+                prompts = rag.process_questions_with_rag([question], [dict(c) for c in chunks], client, model)
+                rag.generate_answers(prompts, output_file=os.path.join(ctx["workdir"], "bench_answers.txt"), route=ctx["args"].route)
+            latencies.append(time.perf_counter() - start)
+        record(results, "e2e", corpus_name, "question_mean_ms", float(np.mean(latencies)) * 1000, "ms", False)
+        record(results, "e2e", corpus_name, "question_p95_ms", percentile(latencies, 95) * 1000, "ms", False)
+        record(results, "e2e", corpus_name, "llm_calls_per_question", len(rag.LLM_CALL_LOG) / len(questions), "calls", False)
+
+
+def bench_prompts(ctx, results):
+    """Time to first token of the legacy and prefix prompt layouts, answering the same questions per patent."""
+    rag = ctx["rag"]
+    questions = ctx["questions"][:ctx["args"].max_questions]
+    for corpus_name, chunks in ctx["corpora"].items():
+        client, model = ctx["stores"][corpus_name]
+        for layout in ("legacy", "prefix"):
+            with quiet(not ctx["args"].verbose):
+                prompts = rag.process_questions_with_rag(questions, [dict(c) for c in chunks], client, model,
+                                                         patent_key=corpus_name, prompt_layout=layout)
+                rag.LLM_CALL_LOG.clear()
+                rag.generate_answers(prompts, output_file=os.path.join(ctx["workdir"], "bench_answers.txt"), route="both")
+            calls = list(rag.LLM_CALL_LOG)
+            prompt_chars = sum(len(p["llama_prompt"]) + len(p["llava_prompt"]) for p in prompts)
+            cached_chars = sum(call["cached_chars"] for call in calls)
+            record(results, "prompts", corpus_name, f"{layout}_ttft_mean_ms",
+                   float(np.mean([call["ttft"] for call in calls])) * 1000, "ms", False)
+            record(results, "prompts", corpus_name, f"{layout}_cached_prefix_ratio",
+                   cached_chars / prompt_chars if prompt_chars else 0.0, "ratio", True)
+
+
+def bench_scheduler(ctx, results):
+    """Queueing of model calls under load: waits per priority class, rejections and retries (stub LLM)."""
+    import threading
+    rag = ctx["rag"]
+    args = ctx["args"]
+    saved_backend, saved_scheduler = dict(rag.LLM_BACKEND_CONFIG), dict(rag.MODEL_SCHEDULER_CONFIG)
+    rag.configure_llm_backend("stub", stub_latency=args.sched_latency, stub_tokens_per_sec=0.0,
+                              stub_failure_rate=args.sched_failure_rate)
+    try:
+        for concurrency in args.sched_concurrency:
+            rag.configure_model_scheduler(concurrency={"default": concurrency}, max_queue=args.sched_max_queue,
+                                          backoff=args.sched_latency, slot_dir=None)
+            rag.SCHEDULER_LOG.clear()
+            
+            def client(priority, calls):
+                for i in range(calls):
+                    try:
+                        rag.scheduled_generate("llama3:latest", f"{priority} {i}", timeout=60, priority=priority)
+                    except (rag.ModelBusyError, TimeoutError, RuntimeError):
+                        time.sleep(args.sched_latency)  # Back off after a rejection, like a pipeline would
+            
+            # Batch and ingest clients saturate the model; one interactive user asks now and then
+            threads = [threading.Thread(target=client, args=("batch" if i % 2 else "ingest", args.sched_calls))
+                       for i in range(args.sched_clients)]
+            threads.append(threading.Thread(target=client, args=("interactive", max(1, args.sched_calls // 2))))
+            start = time.perf_counter()
+            with quiet(not args.verbose):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            seconds = time.perf_counter() - start
+            log = list(rag.SCHEDULER_LOG)
+            name = f"{concurrency}_slots"
+            ok = [entry for entry in log if entry["status"] == "ok"]
+            record(results, "scheduler", name, "calls_per_sec", len(ok) / seconds, "calls/s", True)
+            for priority in ("interactive", "batch", "ingest"):
+                waits = [entry["queued"] for entry in ok if entry["priority"] == priority]
+                if waits:
+                    record(results, "scheduler", name, f"{priority}_wait_p95_ms", percentile(waits, 95) * 1000, "ms", False)
+            record(results, "scheduler", name, "rejected", sum(entry["status"] == "rejected" for entry in log), "calls", False)
+            record(results, "scheduler", name, "failed", sum(entry["status"] == "failed" for entry in log), "calls", False)
+            record(results, "scheduler", name, "retries", sum(entry["attempts"] - 1 for entry in log), "calls", False)
+    finally:
+        rag.LLM_BACKEND_CONFIG.update(saved_backend)
+        rag.MODEL_SCHEDULER_CONFIG.update(saved_scheduler)
+
+
+def same_top_k(hits, reference, atol=1e-5):
+    """Same scores rank by rank, and the same chunks up to a reordering among exactly tied scores."""
+    scores = np.array([hit["similarity"] for hit in hits])
+    reference_scores = np.array([hit["similarity"] for hit in reference])
+    if len(scores) != len(reference_scores) or not np.allclose(scores, reference_scores, atol=atol):
+        return False
+    # Any of the chunks tied with the last score may fill the last places; the ones above must agree
+    cutoff = reference_scores[-1] + atol if len(reference_scores) else 0.0
+    return ({(hit["patent"], hit["chunk_index"]) for hit in hits if hit["similarity"] > cutoff} ==
+            {(hit["patent"], hit["chunk_index"]) for hit in reference if hit["similarity"] > cutoff})
+
+
+def bench_shards(ctx, results):
+    """Throughput of sharded retrieval by shard count, and exactness against the Qdrant search."""
+    rag = ctx["rag"]
+    args = ctx["args"]
+    # Every copy of the bundled chunks becomes its own patent, so the shards get filled evenly
+    base = [chunk for chunks in ctx["chunks"].values() for chunk in chunks]
+    chunks = scale_chunks(base, args.shard_patents)
+    for i, chunk in enumerate(chunks):
+        chunk["patent"] = f"{chunk.get('patent', '')}#{i // len(base)}"
+    corpus_name = f"patents_x{args.shard_patents}"
+    model = rag.get_sentence_model(args.model)
+    with quiet(not args.verbose):
+        embeddings = model.encode([chunk["content"] for chunk in chunks], batch_size=args.batch_size)
+    questions = model.encode(ctx["questions"])
+    queries = np.tile(questions, (max(1, args.shard_queries // len(questions)), 1))
+    # Reference: exact search of the unsharded collection, as retrieve_relevant_chunks answers it
+    with quiet(not args.verbose):
+        client, _ = rag.bulk_load_vector_store(rag.chunk_columns(chunks, embeddings), model_name=args.model)
+    reference = [rag.retrieve_relevant_chunks(None, client, model, top_k=5, question_embedding=question) for question in questions]
+    for num_shards in args.shard_counts:
+        shard_dir = os.path.join(ctx["workdir"], f"shards_{num_shards}")
+        with quiet(not args.verbose):
+            rag.build_vector_shards(chunks, embeddings, shard_dir, num_shards)
+        store = rag.open_vector_shards(shard_dir)
+        try:
+            hits = rag.sharded_search(store, queries[:1], top_k=5)  # warm-up: start the shard processes, map shards
+            start = time.perf_counter()
+            hits = []
+            for batch_start in range(0, len(queries), args.shard_batch):
+                hits.extend(rag.sharded_search(store, queries[batch_start:batch_start + args.shard_batch], top_k=5))
+            seconds = time.perf_counter() - start
+        finally:
+            rag.close_vector_shards(store)
+        record(results, "shards", corpus_name, f"qps_{num_shards}_shards", len(queries) / seconds, "q/s", True)
+        record(results, "shards", corpus_name, f"exact_{num_shards}_shards",
+               float(np.mean([same_top_k(query_hits, reference[q % len(questions)]) for q, query_hits in enumerate(hits)])),
+               "ratio", True)
+
+
+def bench_hierarchy(ctx, results):
+    """Latency and recall of patent -> page -> chunk retrieval against an exact search over all chunks."""
+    rag = ctx["rag"]
+    args = ctx["args"]
+    rng = np.random.default_rng(0)
+    # Synthetic patents: the text chunks of a bundled patent shifted towards a random per-patent topic
+    # direction, so patents are distinguishable the way real ones are by their subject matter
+    base = [[chunk for chunk in chunks if chunk["type"] == "text"] for chunks in ctx["chunks"].values()]
+    base = [chunks for chunks in base if chunks]
+    model = rag.get_sentence_model(args.model)
+    with quiet(not args.verbose):
+        base_embeddings = [rag._normalize_rows(model.encode([c["content"] for c in chunks], batch_size=args.batch_size))
+                           for chunks in base]
+    chunks, embeddings = [], []
+    for p in range(args.hier_patents):
+        source = p % len(base)
+        topic = rag._normalize_rows(rng.standard_normal(base_embeddings[source].shape[1]))
+        for chunk in base[source]:
+            chunks.append(dict(chunk, patent=f"{chunk.get('patent', '')}#{p}"))
+        embeddings.append(rag._normalize_rows(base_embeddings[source] + args.hier_topic_weight * topic))
+    embeddings = np.vstack(embeddings)
+    # Queries: a random chunk of a random patent, plus noise
+    picks = rng.integers(0, len(chunks), args.hier_queries)
+    queries = rag._normalize_rows(embeddings[picks] + 0.5 * rag._normalize_rows(rng.standard_normal((len(picks), embeddings.shape[1]))))
+    corpus_name = f"patents_x{args.hier_patents}"
+    print(f"   {corpus_name}: {len(chunks)} chunks")
+
+    start = time.perf_counter()
+    with quiet(not args.verbose):
+        rag.build_hierarchy_index(chunks, embeddings, os.path.join(ctx["workdir"], "hierarchy"))
+    record(results, "hierarchy", corpus_name, "build_seconds", time.perf_counter() - start, "s", False)
+    index = rag.load_hierarchy_index(os.path.join(ctx["workdir"], "hierarchy"))
+    
+    def timed(top_patents, top_pages):
+        hits, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            hits.append({hit["chunk_index"] for hit in rag.hierarchical_search(index, query, 5, top_patents, top_pages)[0]})
+            latencies.append(time.perf_counter() - start)
+        return hits, latencies
+
+    exact, latencies = timed(None, None)
+    flat_ms = float(np.mean(latencies)) * 1000
+    record(results, "hierarchy", corpus_name, "flat_query_ms", flat_ms, "ms", False)
+    for top_patents in args.hier_top_patents:
+        for top_pages in args.hier_top_pages:
+            hits, latencies = timed(top_patents, top_pages)
+            name = f"{top_patents}pat_{top_pages}pg"
+            query_ms = float(np.mean(latencies)) * 1000
+            record(results, "hierarchy", corpus_name, f"query_ms_{name}", query_ms, "ms", False)
+            record(results, "hierarchy", corpus_name, f"speedup_{name}", flat_ms / query_ms, "x", True)
+            record(results, "hierarchy", corpus_name, f"recall@5_{name}",
+                   float(np.mean([len(a & b) / len(b) for a, b in zip(hits, exact)])), "ratio", True)
+
+
+STAGES = {
+    "extract": bench_extract,
+    "classify": bench_classify,
+    "startup": bench_startup,
+    "embed": bench_embed,
+    "encoders": bench_encoders,
+    "images": bench_images,
+    "index": bench_index,
+    "bulk": bench_bulk,
+    "retrieve": bench_retrieve,
+    "mmr": bench_mmr,
+    "e2e": bench_e2e,
+    "prompts": bench_prompts,
+    "shards": bench_shards,
+    "scheduler": bench_scheduler,
+    "hierarchy": bench_hierarchy,
+}
+
+
+# Stages that only need the PDFs, not the extracted chunks
+PDF_STAGES = ("extract", "classify")
+# Stages that need neither
+STANDALONE_STAGES = ("scheduler",)
+
+
+# === RUN / COMPARE ===
+def build_corpora(ctx):
+    """
+    Build the named corpora used by the embed/index/retrieve/e2e stages:
+    one per bundled PDF plus `all_x<scale>` synthetic corpora of both patents.
+    """
+    all_chunks = [chunk for chunks in ctx["chunks"].values() for chunk in chunks]
+    corpora = {pdf_name: chunks for pdf_name, chunks in ctx["chunks"].items() if chunks}
+    for factor in ctx["args"].scales:
+        if factor > 1:
+            corpora[f"all_x{factor}"] = scale_chunks(all_chunks, factor)
+    ctx["corpora"] = corpora
+    print("Corpora: " + ", ".join(f"{name}={len(chunks)} chunks" for name, chunks in corpora.items()))
+
+
+def load_cached_chunks(ctx):
+    """Fall back to the repo's all_metadata.json when the extract stage is skipped."""
+    rag = ctx["rag"]
+    metadata_file = os.path.join(REPO_DIR, "all_metadata.json")
+    if not os.path.exists(metadata_file):
+        return
+    with quiet(not ctx["args"].verbose):
+        all_metadata = rag.load_chunks_metadata(metadata_file)
+    for pdf_name in ctx["pdfs"]:
+        if pdf_name in all_metadata:
+            ctx["chunks"][pdf_name] = [c for c in all_metadata[pdf_name]["chunks"] if c]
+
+
+def run_benchmarks(args):
+    """
+    Run the selected stages inside a scratch directory and write a result file.
+
+    Args:
+        args (argparse.Namespace): Parsed `run` arguments
+
+    Returns:
+        str: Path of the written JSON result file
+    """
+    if not args.online:
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    if args.threads:
+        os.environ["OMP_NUM_THREADS"] = str(args.threads)
+
+    sys.path.insert(0, REPO_DIR)
+    import Patent_RAG as rag
+
+    rag.configure_llm_backend("stub", stub_latency=args.llm_latency, stub_tokens_per_sec=args.llm_tokens_per_sec,
+                              stub_prefill_chars_per_sec=args.llm_prefill_chars_per_sec)
+    if not args.ocr:
+        rag.ocr_text_extraction = lambda page, image_indicator=False, clip=None: ""
+    if args.stub_encoder:
+        rag.get_sentence_model = lambda model_name="all-MiniLM-L6-v2", backend="torch": StubEncoder(model_name)
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    np.random.seed(args.seed)
+
+    results = []
+
+    workdir = tempfile.mkdtemp(prefix="patent_rag_bench_")
+    previous_cwd = os.getcwd()
+    try:
+        for pdf_name in BUNDLED_PDFS:
+            shutil.copy(os.path.join(REPO_DIR, pdf_name), workdir)
+        os.chdir(workdir)
+        with quiet(not args.verbose):
+            questions = rag.load_questions(os.path.join(REPO_DIR, "questions.txt"))
+        ctx = {
+            "args": args,
+            "rag": rag,
+            "workdir": workdir,
+            "pdfs": list(BUNDLED_PDFS),
+            "questions": [q for q in questions if q],
+            "chunks": {},
+            "stores": {},
+            "metadata_file": os.path.join(workdir, "all_metadata.json"),
+        }
+        stages = args.stages or list(STAGES)
+        if "extract" in stages:
+            print("\n=== extract ===")
+            STAGES["extract"](ctx, results)
+        else:
+            load_cached_chunks(ctx)
+        if "classify" in stages:
+            print("\n=== classify ===")
+            STAGES["classify"](ctx, results)
+        if any(stage not in PDF_STAGES + STANDALONE_STAGES for stage in stages):
+            if not ctx["chunks"]:
+                print("❌ No chunks available: run the extract stage or create all_metadata.json first")
+                return None
+            with quiet(not args.verbose):
+                rag.save_chunks_metadata({pdf_name: {"chunks": chunks} for pdf_name, chunks in ctx["chunks"].items()},
+                                         ctx["metadata_file"])
+            build_corpora(ctx)
+        for stage in stages:
+            if stage in PDF_STAGES:
+                continue
+            if stage in ("retrieve", "mmr", "e2e", "prompts") and not ctx["stores"]:
+                STAGES["index"](ctx, [])
+            print(f"\n=== {stage} ===")
+            STAGES[stage](ctx, results)
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "schema_version": RESULTS_SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "environment": environment_info(),
+        "config": vars(args),
+        "results": results,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    tag = f"-{args.tag}" if args.tag else ""
+    output_file = os.path.join(args.output_dir, f"bench-{time.strftime('%Y%m%d-%H%M%S')}{tag}.json")
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✅ Benchmark results saved to {output_file}")
+    return output_file
+
+
+def compare_results(baseline_file, candidate_file, threshold=0.10):
+    """
+    Diff two result files metric by metric.
+
+    Args:
+        baseline_file (str): Older result JSON
+        candidate_file (str): Newer result JSON
+        threshold (float): Relative change counted as a regression/improvement
+
+    Returns:
+        int: Number of regressions found
+    """
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(candidate_file, "r", encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    def keyed(report):
+        return {(r["stage"], r["corpus"], r["metric"]): r for r in report["results"]}
+
+    old, new = keyed(baseline), keyed(candidate)
+    print(f"Baseline:  {baseline_file} ({baseline.get('git_commit')})")
+    print(f"Candidate: {candidate_file} ({candidate.get('git_commit')})\n")
+    print(f"{'stage':<10} {'corpus':<22} {'metric':<24} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    regressions = 0
+    for key in sorted(set(old) | set(new)):
+        if key not in old or key not in new:
+            status = "added" if key not in old else "removed"
+            print(f"{key[0]:<10} {key[1]:<22} {key[2]:<24} {'':>12} {'':>12} {status:>9}")
+            continue
+        before, after = old[key]["value"], new[key]["value"]
+        change = (after - before) / before if before else 0.0
+        worse = change < -threshold if new[key]["higher_is_better"] else change > threshold
+        better = change > threshold if new[key]["higher_is_better"] else change < -threshold
+        flag = "  ❌ regression" if worse else "  ✅ improved" if better else ""
+        regressions += int(worse)
+        print(f"{key[0]:<10} {key[1]:<22} {key[2]:<24} {before:>12.4f} {after:>12.4f} {change:>+8.1%}{flag}")
+    print(f"\n{regressions} regression(s) beyond {threshold:.0%}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the patent RAG pipeline stages.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Run the benchmark suite")
+    run.add_argument("--stages", nargs="+", choices=list(STAGES), help="Stages to run (default: all)")
+    run.add_argument("--scales", nargs="+", type=int, default=[1, 10],
+                     help="Synthetic corpus scale factors (copies of both patents)")
+    run.add_argument("--repeats", type=int, default=3, help="Repetitions for embed/retrieve timings")
+    run.add_argument("--extract-repeats", type=int, default=1, help="Repetitions for the extract stage")
+    run.add_argument("--max-questions", type=int, default=10, help="Questions used by the e2e stage")
+    run.add_argument("--model", default="all-MiniLM-L6-v2", help="SentenceTransformer model name")
+    run.add_argument("--stub-encoder", action="store_true", help="Use a hashing encoder instead of the model")
+    run.add_argument("--encoder-backends", nargs="+", default=["torch", "onnx", "int8"],
+                     help="Backends compared by the encoders stage (the first one is the reference)")
+    run.add_argument("--encode-workers", nargs="+", type=int, default=[1, max(1, (os.cpu_count() or 1) // 2)],
+                     help="Worker process counts compared by the encoders stage")
+    run.add_argument("--shard-counts", nargs="+", type=int, default=[1, 2, 4, 8], help="Shard counts of the shards stage")
+    run.add_argument("--shard-patents", type=int, default=32, help="Synthetic patents in the shards stage corpus")
+    run.add_argument("--shard-queries", type=int, default=512, help="Queries per shard count")
+    run.add_argument("--shard-batch", type=int, default=32, help="Queries fanned out per scatter-gather call")
+    run.add_argument("--mmr-lambda", type=float, default=0.7, help="MMR relevance/diversity trade-off of the mmr stage")
+    run.add_argument("--mmr-candidates", nargs="+", type=int, default=[10, 20, 50], help="MMR candidate pool sizes")
+    run.add_argument("--sched-concurrency", nargs="+", type=int, default=[1, 2], help="Slots per model in the scheduler stage")
+    run.add_argument("--sched-clients", type=int, default=8, help="Concurrent batch/ingest clients of the scheduler stage")
+    run.add_argument("--sched-calls", type=int, default=10, help="Calls per client")
+    run.add_argument("--sched-latency", type=float, default=0.02, help="Stub seconds per call in the scheduler stage")
+    run.add_argument("--sched-failure-rate", type=float, default=0.1, help="Share of stub calls failing (retried)")
+    run.add_argument("--sched-max-queue", type=int, default=4, help="Queue depth before batch/ingest calls are rejected")
+    run.add_argument("--hier-patents", type=int, default=1000, help="Synthetic patents in the hierarchy stage corpus")
+    run.add_argument("--hier-queries", type=int, default=200, help="Queries of the hierarchy stage")
+    run.add_argument("--hier-topic-weight", type=float, default=0.5,
+                     help="Weight of the per-patent topic direction of the synthetic hierarchy corpus")
+    run.add_argument("--hier-top-patents", nargs="+", type=int, default=[4, 16, 64], help="Candidate patents per query")
+    run.add_argument("--hier-top-pages", nargs="+", type=int, default=[10, 40], help="Candidate pages per query")
+    run.add_argument("--image-model", default="clip-ViT-B-32", help="CLIP-style model used by the images stage")
+    run.add_argument("--batch-size", type=int, default=32, help="Encoder batch size")
+    run.add_argument("--no-ocr", dest="ocr", action="store_false",
+                     help="Skip EasyOCR during extraction (scanned pages then yield no text)")
+    run.add_argument("--route", default="both", choices=["auto", "both", "llama", "llava"],
+                     help="Model routing of the e2e stage (default both, like the pipeline)")
+    run.add_argument("--llm-prefill-chars-per-sec", type=float, default=2000.0,
+                     help="Stub LLM prompt processing rate; uncached prompt characters cost TTFT")
+    run.add_argument("--llm-latency", type=float, default=0.0, help="Seconds before the stub LLM's first token")
+    run.add_argument("--llm-tokens-per-sec", type=float, default=0.0, help="Stub LLM generation rate (0 = instant)")
+    run.add_argument("--threads", type=int, default=0, help="Pin torch/OpenMP thread count")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--online", action="store_true", help="Allow Hugging Face downloads")
+    run.add_argument("--output-dir", default=os.path.join(REPO_DIR, "bench_results"))
+    run.add_argument("--tag", default="", help="Suffix added to the result file name")
+    run.add_argument("--verbose", action="store_true", help="Keep the pipeline's progress output")
+
+    compare = subparsers.add_parser("compare", help="Diff two result files")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.add_argument("--threshold", type=float, default=0.10, help="Relative change flagged (default 0.10)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "run":
+        return 0 if run_benchmarks(args) else 1
+    return 1 if compare_results(args.baseline, args.candidate, args.threshold) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Distributed ingestion of patents over a job queue.
+
+A coordinator enqueues per-patent (or per-page) jobs, and any number of stateless workers -
+on one box or on hosts sharing the queue database and the store directory - lease them and
+run extraction, OCR, sheet descriptions and embedding (see the DISTRIBUTED INGESTION section
+of Patent_RAG.py). Jobs are delivered at least once and all writes are idempotent, so a
+worker that dies mid-job is simply replaced by the next one to claim the expired lease.
+
+Usage:
+    python ingest.py enqueue US6285999.pdf US11960514.pdf [--per-page] [--retry-failed]
+    python ingest.py worker [--lease-seconds 900] [--no-describe] [--qdrant-url http://host:6333]
+    python ingest.py status
+    python ingest.py export --metadata-file all_metadata.json [--parquet chunks.parquet]
+"""
+
+import argparse
+
+import Patent_RAG as rag
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest patents with a job queue and stateless workers.")
+    parser.add_argument("--queue", default="ingestion_queue.db", help="Job queue location (SQLite database file)")
+    parser.add_argument("--queue-backend", default="sqlite", choices=list(rag.JOB_QUEUE_BACKENDS))
+    parser.add_argument("--store-dir", default="ingestion_store", help="Shared directory the workers write results to")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = subparsers.add_parser("enqueue", help="Enqueue patents (coordinator)")
+    enqueue.add_argument("pdfs", nargs="+")
+    enqueue.add_argument("--per-page", action="store_true", help="One job per page instead of one per patent")
+    enqueue.add_argument("--retry-failed", action="store_true", help="Run the failed jobs of unchanged patents again")
+
+    worker = subparsers.add_parser("worker", help="Run a worker until the queue is empty")
+    worker.add_argument("--worker-id", default=None, help="Lease owner name (default: host:pid)")
+    worker.add_argument("--lease-seconds", type=float, default=900)
+    worker.add_argument("--max-attempts", type=int, default=3)
+    worker.add_argument("--max-jobs", type=int, default=None)
+    worker.add_argument("--wait", action="store_true", help="Keep polling for new jobs instead of exiting when idle")
+    worker.add_argument("--no-describe", dest="describe_sheets", action="store_false",
+                        help="Store drawing sheets without LLaVA descriptions (describe lazily at query time)")
+    worker.add_argument("--no-embed", dest="embed", action="store_false", help="Only extract, do not embed")
+    worker.add_argument("--model", default="all-MiniLM-L6-v2", help="SentenceTransformer model name")
+    worker.add_argument("--image-model", default=None, help="Optional CLIP-style model for drawing sheets")
+    worker.add_argument("--qdrant-url", default=None, help="Shared Qdrant server the points are upserted to")
+    worker.add_argument("--collection", default="patent_chunks")
+    worker.add_argument("--model-budget-mb", type=float, default=None,
+                        help="Memory budget of the loaded models (OCR, encoders); least recently used ones are unloaded")
+    worker.add_argument("--model-idle-seconds", type=float, default=None, help="Unload models idle for this long")
+
+    subparsers.add_parser("status", help="Show the number of jobs per status")
+
+    export = subparsers.add_parser("export", help="Merge the ingested patents into a chunk store")
+    export.add_argument("--metadata-file", default="all_metadata.json")
+    export.add_argument("--parquet", default=None, help="Also write chunks and text embeddings to this Parquet file (needs pyarrow)")
+    export.add_argument("--model", default="all-MiniLM-L6-v2", help="Model of the exported embeddings")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    queue = rag.open_job_queue(args.queue, args.queue_backend)
+    if args.command == "enqueue":
+        rag.enqueue_ingestion_jobs(queue, args.pdfs, per_page=args.per_page, retry_failed=args.retry_failed)
+    elif args.command == "worker":
+        rag.configure_model_resources(args.model_budget_mb, args.model_idle_seconds)
+        completed = rag.run_ingestion_worker(queue, args.store_dir, worker_id=args.worker_id, lease_seconds=args.lease_seconds,
+                                             max_attempts=args.max_attempts, exit_when_idle=not args.wait, max_jobs=args.max_jobs,
+                                             describe_sheets=args.describe_sheets, embed=args.embed, model_name=args.model,
+                                             image_model_name=args.image_model, qdrant_url=args.qdrant_url,
+                                             collection_name=args.collection)
+        print(f"\nWorker finished: {completed} job(s) completed")
+        for event in rag.MODEL_EVENTS:
+            print(f"   {event['event']:<6} {event['model']} ({event['bytes'] / 2**20:.0f} MB, {event['reason']})")
+    elif args.command == "status":
+        status = rag.job_queue_status(queue)
+        for name in ("pending", "leased", "done", "failed"):
+            print(f"{name:<8} {status['counts'].get(name, 0)}")
+        for key, error in status["failed"].items():
+            print(f"❌ {key}: {error}")
+    elif args.command == "export":
+        rag.export_ingested_metadata(args.store_dir, args.metadata_file)
+        if args.parquet:
+            rag.export_ingested_parquet(args.store_dir, args.parquet, args.model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Offline retrieval-quality evaluation for the patent RAG pipeline.
+
+Runs labeled questions through retrieval only (no LLM calls) and sweeps a grid of
+retrieval parameters:
+
+    chunk_size / chunk_overlap - structure chunking of the stored page texts
+    top_k                      - text chunks retrieved per question (retrieve_relevant_chunks)
+    image_threshold            - minimum similarity of a drawing sheet (top_similar_images)
+
+For every configuration it reports recall@k, hit@k and MRR against the labeled pages /
+chunks, the context size handed to the LLM, and retrieval latency, then recommends the
+cheapest configuration that meets --target-recall.
+
+Labels are JSONL, one question per line:
+
+    {"patent": "US6285999.pdf", "question": "...", "pages": [7, 8]}
+    {"patent": "US6285999.pdf", "question": "...", "snippets": ["transition probability matrix A"]}
+
+"pages" are the 1-based pages holding the answer, "snippets" are passages a relevant chunk
+must contain (independent of the chunk size), "image_pages" optionally the drawing sheets
+that should be selected. A retrieved chunk is relevant if its page is labeled or it
+contains a labeled snippet.
+
+Usage:
+    python retrieval_eval.py --labels retrieval_labels.jsonl --top-k 1 3 5 --chunk-sizes 300 500 800
+    python retrieval_eval.py --stub-encoder --image-thresholds 0.3 0.4 0.5
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from benchmark import REPO_DIR, StubEncoder, environment_info, git_commit, percentile, quiet
+
+RESULTS_SCHEMA_VERSION = 1
+
+
+# === LABELS / CORPUS ===
+def load_labels(labels_file):
+    """
+    Read the labeled questions.
+
+    Args:
+        labels_file (str): JSONL file of {"patent", "question", "pages"/"snippets"/"image_pages"}
+
+    Returns:
+        list: Label dictionaries (blank lines skipped)
+    """
+    labels = []
+    with open(labels_file, "r", encoding="utf-8") as f:
+        for line_num, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            label = json.loads(line)
+            if not (label.get("pages") or label.get("snippets")):
+                raise ValueError(f"{labels_file}:{line_num}: label needs 'pages' or 'snippets'")
+            labels.append(label)
+    return labels
+
+
+def load_patent_entry(rag, pdf_path, metadata_file, workdir, args):
+    """
+    The chunk-store entry of a patent with its page texts: taken from metadata_file when it has
+    them, otherwise extracted into workdir (drawing sheets are not described, no LLM is called).
+    """
+    entry = (rag.load_chunks_metadata(metadata_file) or {}).get(pdf_path) if os.path.exists(metadata_file) else None
+    if entry and any(status.get("text") for status in entry.get("pages", {}).values()):
+        return entry
+    pdf_file = pdf_path if os.path.isabs(pdf_path) else os.path.join(REPO_DIR, pdf_path)
+    print(f"Extracting {pdf_path} (no page texts in {metadata_file})...")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        shutil.copy(pdf_file, pdf_path)
+        with quiet(not args.verbose):
+            return rag.extract_text_and_images_from_patent(pdf_path, metadata_file=os.path.join(workdir, "eval_metadata.json"),
+                                                           describe_sheets=False)[pdf_path]
+    finally:
+        os.chdir(cwd)
+
+
+def build_chunks(rag, pdf_path, entry, chunk_size, chunk_overlap):
+    """Re-chunk the patent's stored page texts with the given splitter size; drawing sheets are kept as they are."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                              length_function=len, separators=["\n", " ", ""])
+    page_texts = [(int(page), status["text"]) for page, status in sorted(entry["pages"].items(), key=lambda item: int(item[0]))
+                  if status.get("text")]
+    chunks = rag.chunk_patent_structure(page_texts, pdf_path, splitter)
+    chunks += [dict(chunk) for chunk in entry["chunks"] if chunk["type"] == "image_description"]
+    return chunks
+
+
+# === METRICS ===
+def normalize(text):
+    """Lower-case and collapse whitespace so snippets match across PDF line breaks."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def score_retrieval(label, retrieved):
+    """
+    Recall, hit and reciprocal rank of one question's retrieved chunks.
+
+    Args:
+        label (dict): The labeled question
+        retrieved (list): Retrieved chunks in rank order
+
+    Returns:
+        tuple: (recall, hit, reciprocal rank)
+    """
+    pages = set(label.get("pages", []))
+    snippets = [normalize(snippet) for snippet in label.get("snippets", [])]
+    contents = [normalize(chunk["content"]) for chunk in retrieved]
+    relevant = [chunk["page"] in pages or any(snippet in content for snippet in snippets)
+                for chunk, content in zip(retrieved, contents)]
+    found = len(pages & {chunk["page"] for chunk in retrieved})
+    found += sum(1 for snippet in snippets if any(snippet in content for content in contents))
+    recall = found / (len(pages) + len(snippets))
+    rank = relevant.index(True) + 1 if any(relevant) else None
+    return recall, float(rank is not None), 1.0 / rank if rank else 0.0
+
+
+# === SWEEP ===
+def evaluate_grid(rag, labels, args, workdir):
+    """
+    Evaluate every configuration of the grid.
+
+    Returns:
+        list: One result dictionary per (chunk_size, chunk_overlap, top_k, image_threshold)
+    """
+    by_patent = {}
+    for label in labels:
+        by_patent.setdefault(label["patent"], []).append(label)
+    entries = {pdf_path: load_patent_entry(rag, pdf_path, args.metadata_file, workdir, args) for pdf_path in by_patent}
+
+    results = []
+    for chunk_size in args.chunk_sizes:
+        for chunk_overlap in args.chunk_overlaps:
+            if chunk_overlap >= chunk_size:
+                continue
+            # Per-question measurements of this chunking, keyed by (top_k, image_threshold)
+            measurements = {}
+            index_seconds, num_chunks = 0.0, 0
+            for pdf_path, patent_labels in by_patent.items():
+                chunks = build_chunks(rag, pdf_path, entries[pdf_path], chunk_size, chunk_overlap)
+                num_chunks += len(chunks)
+                start = time.perf_counter()
+                with quiet(not args.verbose):
+                    client, model = rag.create_vector_store(chunks, model_name=args.model)
+                index_seconds += time.perf_counter() - start
+                question_embeddings = model.encode([label["question"] for label in patent_labels])
+                for top_k in args.top_k:
+                    for label, question_embedding in zip(patent_labels, question_embeddings):
+                        start = time.perf_counter()
+                        retrieved = rag.retrieve_relevant_chunks(label["question"], client, model, top_k=top_k,
+                                                                 question_embedding=question_embedding)
+                        text_seconds = time.perf_counter() - start
+                        recall, hit, reciprocal_rank = score_retrieval(label, retrieved)
+                        for threshold in args.image_thresholds:
+                            start = time.perf_counter()
+                            with quiet(not args.verbose):
+                                images = rag.top_similar_images(retrieved, [dict(c) for c in chunks], max_images=2,
+                                                                client=client, max_threshold=threshold) or []
+                            image_seconds = time.perf_counter() - start
+                            image_pages = set(label.get("image_pages", []))
+                            measurements.setdefault((top_k, threshold), []).append({
+                                "recall": recall,
+                                "hit": hit,
+                                "reciprocal_rank": reciprocal_rank,
+                                "image_recall": (len(image_pages & {img["page"] for img in images}) / len(image_pages)
+                                                 if image_pages else None),
+                                "context_chars": sum(len(chunk["content"]) for chunk in retrieved)
+                                                 + sum(len(img.get("description") or img["content"]) for img in images),
+                                "images": len(images),
+                                "seconds": text_seconds + image_seconds,
+                            })
+            for (top_k, threshold), rows in sorted(measurements.items()):
+                latencies = [row["seconds"] for row in rows]
+                image_recalls = [row["image_recall"] for row in rows if row["image_recall"] is not None]
+                results.append({
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": chunk_overlap,
+                    "top_k": top_k,
+                    "image_threshold": threshold,
+                    "questions": len(rows),
+                    "chunks": num_chunks,
+                    "recall_at_k": float(np.mean([row["recall"] for row in rows])),
+                    "hit_at_k": float(np.mean([row["hit"] for row in rows])),
+                    "mrr": float(np.mean([row["reciprocal_rank"] for row in rows])),
+                    "image_recall": float(np.mean(image_recalls)) if image_recalls else None,
+                    "images_per_question": float(np.mean([row["images"] for row in rows])),
+                    "context_chars": float(np.mean([row["context_chars"] for row in rows])),
+                    "index_seconds": index_seconds,
+                    "retrieve_p50_ms": percentile(latencies, 50) * 1000,
+                    "retrieve_p95_ms": percentile(latencies, 95) * 1000,
+                })
+    return results
+
+
+def recommend(results, target_recall):
+    """Cheapest configuration (smallest LLM context, then fastest retrieval) with recall@k >= target_recall."""
+    passing = [result for result in results if result["recall_at_k"] >= target_recall]
+    if not passing:
+        return None
+    return min(passing, key=lambda result: (result["context_chars"], result["retrieve_p95_ms"], result["index_seconds"]))
+
+
+def print_table(results, best):
+    """Echo the grid as a table, marking the recommended configuration."""
+    print(f"\n{'chunk':>6} {'overlap':>7} {'k':>3} {'img_thr':>7} {'recall@k':>9} {'hit@k':>6} {'MRR':>6} "
+          f"{'img_rec':>7} {'ctx_chars':>9} {'p95_ms':>8}")
+    for result in results:
+        image_recall = f"{result['image_recall']:.3f}" if result["image_recall"] is not None else "-"
+        flag = "  <- recommended" if result is best else ""
+        print(f"{result['chunk_size']:>6} {result['chunk_overlap']:>7} {result['top_k']:>3} {result['image_threshold']:>7.2f} "
+              f"{result['recall_at_k']:>9.3f} {result['hit_at_k']:>6.3f} {result['mrr']:>6.3f} {image_recall:>7} "
+              f"{result['context_chars']:>9.0f} {result['retrieve_p95_ms']:>8.2f}{flag}")
+
+
+# === RUN ===
+def run_evaluation(args):
+    """
+    Run the sweep and write a result file.
+
+    Returns:
+        str: Path of the result file
+    """
+    if not args.online:
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    import Patent_RAG as rag
+    if not args.ocr:
+        rag.ocr_text_extraction = lambda page, image_indicator=False, clip=None: ""
+    if args.stub_encoder:
+        rag.get_sentence_model = lambda model_name="all-MiniLM-L6-v2", backend="torch": StubEncoder(model_name)
+
+    labels = load_labels(args.labels)
+    print(f"Loaded {len(labels)} labeled questions from {args.labels}")
+    workdir = tempfile.mkdtemp(prefix="patent_rag_eval_")
+    try:
+        results = evaluate_grid(rag, labels, args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    best = recommend(results, args.target_recall)
+    print_table(results, best)
+    if best is None:
+        print(f"\n⚠️  No configuration reaches recall@k >= {args.target_recall}")
+    else:
+        print(f"\n✅ Cheapest configuration with recall@k >= {args.target_recall}: chunk_size={best['chunk_size']}, "
+              f"chunk_overlap={best['chunk_overlap']}, top_k={best['top_k']}, image_threshold={best['image_threshold']}")
+
+    report = {
+        "schema_version": RESULTS_SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "environment": environment_info(),
+        "config": vars(args),
+        "results": results,
+        "recommended": best,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    tag = f"-{args.tag}" if args.tag else ""
+    output_file = os.path.join(args.output_dir, f"retrieval-eval-{time.strftime('%Y%m%d-%H%M%S')}{tag}.json")
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Evaluation results saved to {output_file}")
+    return output_file
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep retrieval parameters against labeled questions (no LLM calls).")
+    parser.add_argument("--labels", default=os.path.join(REPO_DIR, "retrieval_labels.jsonl"), help="Labeled questions (JSONL)")
+    parser.add_argument("--metadata-file", default=os.path.join(REPO_DIR, "all_metadata.json"),
+                        help="Chunk store with the page texts (patents missing from it are extracted)")
+    parser.add_argument("--top-k", nargs="+", type=int, default=[1, 3, 5, 10])
+    parser.add_argument("--chunk-sizes", nargs="+", type=int, default=[300, 500, 800])
+    parser.add_argument("--chunk-overlaps", nargs="+", type=int, default=[100])
+    parser.add_argument("--image-thresholds", nargs="+", type=float, default=[0.3, 0.4, 0.5])
+    parser.add_argument("--target-recall", type=float, default=0.8, help="Quality target for the recommendation")
+    parser.add_argument("--model", default="all-MiniLM-L6-v2", help="SentenceTransformer model name")
+    parser.add_argument("--stub-encoder", action="store_true", help="Use a hashing encoder instead of the model")
+    parser.add_argument("--no-ocr", dest="ocr", action="store_false", help="Skip OCR when a patent has to be extracted")
+    parser.add_argument("--online", action="store_true", help="Allow Hugging Face downloads")
+    parser.add_argument("--output-dir", default=os.path.join(REPO_DIR, "bench_results"))
+    parser.add_argument("--tag", default="", help="Suffix added to the result file name")
+    parser.add_argument("--verbose", action="store_true", help="Keep the pipeline's progress output")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run_evaluation(parse_args())